@@ -0,0 +1,122 @@
+########################################################
+##    Convergence-based sampling for LDR filter steps ##
+##  Primary goal: do not spend the same number of     ##
+##  points on every filter step. Bright steps stop    ##
+##  early, noisy dark steps get extra chunks of       ##
+##  points until the standard error of the mean       ##
+##  reaches the requested relative precision.         ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import numpy as np
+from AutoRange import is_overflow
+from LDRAnalysis import combine_statistics, statistics_anomaly
+
+
+# Standard error of the mean of a window of current values
+def sem(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) < 2:
+        return np.inf
+    return np.std(values, ddof=1) / np.sqrt(len(values))
+
+
+class AdaptiveSampler:
+    def __init__(self, SMU, sampling_time, base_points, target_precision=0.005, chunk_points=16, max_points=512):
+        self.SMU = SMU
+        self.sampling_time = sampling_time
+        self.base_points = base_points  # trigger count of the normal acquisition, restored after extra chunks
+        self.target_precision = target_precision  # relative SEM (e.g. 0.005 = 0.5 %) at which a step is done
+        self.chunk_points = chunk_points
+        self.max_points = max_points  # cap on the points in the evaluated window, converged or not
+        self.steps = 0
+        self.steps_extended = 0
+        self.steps_capped = 0
+        self.extra_points = 0
+
+    # Relative precision of the window. offset is subtracted from the mean first (e.g. dark current), so the
+    # precision refers to the photocurrent and not to the total current.
+    def relative_sem(self, window, offset=0):
+        signal = np.abs(np.mean(window) - offset)
+        if signal == 0:
+            return np.inf
+        return sem(window) / signal
+
+    def converged(self, window, offset=0, target_precision=None):
+        target = self.target_precision if target_precision is None else target_precision
+        return self.relative_sem(window, offset) <= target
+
+    # Acquires extra chunks (light conditions unchanged) until the window converges or reaches max_points.
+    # Returns the extra currents and their times, continuing the time axis after t_last. target_precision overrides
+    # the one of the sampler for this step only (e.g. tighter near the knee of an LDR sweep).
+    def extend(self, window, offset=0, t_last=0, target_precision=None):
+        self.steps += 1
+        window = list(window)
+        extra_curr = []
+        extra_time = []
+        chunks = 0
+        while not self.converged(window, offset, target_precision) and len(window) < self.max_points:
+            count = min(self.chunk_points, self.max_points - len(window))
+            self.SMU.trigger_settings(mtype="TIMer", count=count, period=self.sampling_time)
+            self.SMU.initiate('ACQuire', timeout=1000)
+            chunks += 1
+            chunk = self.SMU.get_current()
+            chunk_time = self.SMU.get_time()
+            if is_overflow(chunk):  # the light changed under us, keep what was measured so far
+                print("Overflow in adaptive chunk, keeping the points measured so far")
+                break
+            t_start = (extra_time[-1] if extra_time else t_last) + self.sampling_time
+            extra_time.extend([t_start + t - chunk_time[0] for t in chunk_time])
+            extra_curr.extend(chunk)
+            window.extend(chunk)
+        if chunks:  # also after a chunk that overflowed and was not kept
+            self.SMU.trigger_settings(mtype="TIMer", count=self.base_points, period=self.sampling_time)
+        if extra_curr:
+            self.steps_extended += 1
+            self.extra_points += len(extra_curr)
+        if not self.converged(window, offset, target_precision):
+            self.steps_capped += 1
+        return extra_curr, extra_time
+
+    # Relative precision from the statistics of a window ({"mean", "std", "count"}, population std) instead of its
+    # values
+    def relative_sem_statistics(self, statistics, offset=0):
+        signal = np.abs(statistics["mean"] - offset)
+        if signal == 0 or statistics["count"] < 2:
+            return np.inf
+        return statistics["std"] / np.sqrt(statistics["count"] - 1) / signal
+
+    # extend() for a step measured with on-instrument statistics (SMUDevice.get_statistics): the chunks are
+    # acquired into the trace buffer and only their statistics are fetched. Returns the statistics of the window and
+    # all the chunks. A chunk that overflows or holds an outlier is left out and ends the extension.
+    def extend_statistics(self, statistics, offset=0, target_precision=None):
+        self.steps += 1
+        target = self.target_precision if target_precision is None else target_precision
+        extra_points = 0
+        chunks = 0
+        while self.relative_sem_statistics(statistics, offset) > target and statistics["count"] < self.max_points:
+            count = min(self.chunk_points, self.max_points - statistics["count"])
+            self.SMU.trigger_settings(mtype="TIMer", count=count, period=self.sampling_time)
+            self.SMU.trace_buffer(count)
+            self.SMU.initiate('ACQuire', timeout=1000)
+            chunks += 1
+            chunk = self.SMU.get_statistics()
+            anomaly = statistics_anomaly(chunk)
+            if anomaly:
+                print(f"{anomaly.capitalize()} in adaptive chunk, keeping the points measured so far")
+                break
+            statistics = combine_statistics(statistics, chunk)
+            extra_points += chunk["count"]
+        if chunks:
+            self.SMU.trigger_settings(mtype="TIMer", count=self.base_points, period=self.sampling_time)
+        if extra_points:
+            self.steps_extended += 1
+            self.extra_points += extra_points
+        if self.relative_sem_statistics(statistics, offset) > target:
+            self.steps_capped += 1
+        return statistics
+
+    def report(self):
+        print(f"Adaptive sampling: {self.steps_extended}/{self.steps} steps needed extra points "
+              f"({self.extra_points} pts in total), {self.steps_capped} steps stopped at the cap of "
+              f"{self.max_points} pts before reaching {100 * self.target_precision} % precision.")
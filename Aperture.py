@@ -0,0 +1,98 @@
+########################################################
+##      NPLC (aperture) choice per measurement step   ##
+##  Primary goal: measure the noise of the connected  ##
+##  DUT vs NPLC once per current range, keep the      ##
+##  table on disk, and give each step the fastest     ##
+##  NPLC and sampling period that still reach the     ##
+##  target signal-to-noise ratio.                     ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import json
+import os
+import time
+import numpy as np
+
+# NPLC values tried by the characterisation (SMU.py accepts 5e-4 to 100)
+NPLC_CANDIDATES = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10]
+
+
+class ApertureOptimizer:
+    def __init__(self, file_path="Aperture_Table.json", max_age=7 * 24 * 3600, nplcs=NPLC_CANDIDATES, points=16,
+                 line_frequency=50):
+        self.file_path = file_path
+        self.line_frequency = line_frequency  # in Hz, set on the SMU: the aperture of an NPLC depends on it
+        self.max_age = max_age  # in s. Older tables are measured again.
+        self.nplcs = nplcs
+        self.points = points  # points per NPLC value in the characterisation
+        self.entries = {}
+        self.characterisations = 0
+        self.choices = {}  # NPLC: number of steps it was chosen for
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as file:
+                self.entries = json.load(file)
+
+    # Tables measured at another line frequency have other apertures for the same NPLC values, so it is in the key
+    def key(self, device, voltage, current_range):
+        return f"{device}|{voltage}V|{current_range}A|{self.line_frequency:g}Hz"
+
+    # Noise table of a device/voltage/range ({"timestamp", "rows": [{nplc, std, point_time}]}), None if there is no
+    # recent one
+    def table(self, device, voltage, current_range):
+        entry = self.entries.get(self.key(device, voltage, current_range))
+        if entry is None or time.time() - entry["timestamp"] > self.max_age:
+            return None
+        return entry
+
+    # Measures `points` readings back to back (AINT trigger) at every NPLC, under the conditions the DUT is in now,
+    # on the range that is set. point_time is the time per reading from the SMU timestamps (aperture + overhead).
+    # Changes NPLC and trigger settings: the caller sets them again afterwards.
+    def characterise(self, SMU, device, voltage, current_range):
+        print(f"Characterising noise vs NPLC on the {current_range} A range ...")
+        rows = []
+        for nplc in self.nplcs:
+            SMU.measurement_speed(nplc)
+            SMU.trigger_settings(mtype="AINT", count=self.points)
+            SMU.initiate('ACQuire', timeout=1000)
+            current = np.asarray(SMU.get_current(), dtype=float)
+            ttime = np.asarray(SMU.get_time(), dtype=float)
+            rows.append({"nplc": nplc, "std": float(np.std(current, ddof=1)),
+                         "point_time": float(np.median(np.diff(ttime)))})
+            print(f"  NPLC {nplc}: noise {rows[-1]['std']:.3g} A, {1e3 * rows[-1]['point_time']:.3g} ms per point")
+        entry = {"timestamp": time.time(), "rows": rows}
+        self.entries[self.key(device, voltage, current_range)] = entry
+        self.characterisations += 1
+        return entry
+
+    # NPLC and sampling period (in s) for a step with the expected signal (in A) and `points` readings in its mean.
+    # The fastest period whose SNR (|signal| x sqrt(points) / noise) reaches target_snr wins, at equal periods the
+    # lowest noise. If none reaches it, the lowest noise. min_period: the period is never shorter (e.g. for a
+    # shutter), max_period: slower NPLCs are not used, min_nplc: nor faster ones. line_period: periods of a line
+    # period or more are rounded up to whole line periods (LineFrequency.py). Returns (None, None) without a table
+    # or an expected signal (first step): the settings stay as they are.
+    def choose(self, device, voltage, current_range, signal, target_snr, points, min_period=0, max_period=None,
+               min_nplc=0, line_period=None):
+        entry = self.table(device, voltage, current_range)
+        if entry is None or signal is None:
+            return None, None
+        candidates = []
+        for row in entry["rows"]:
+            period = max(np.ceil(row["point_time"] * 1e3) / 1e3, min_period)  # rounded up to whole ms
+            if line_period and period >= line_period:
+                period = float(f"{np.ceil(period / line_period - 1e-6) * line_period:.6g}")
+            if row["nplc"] >= min_nplc and (max_period is None or period <= max_period):
+                candidates.append((period, row["std"], row["nplc"]))
+        if not candidates:
+            return None, None
+        good = [c for c in candidates if c[1] == 0 or abs(signal) * np.sqrt(points) / c[1] >= target_snr]
+        period, _, nplc = min(good, key=lambda c: (c[0], c[1])) if good else min(candidates, key=lambda c: c[1])
+        self.choices[nplc] = self.choices.get(nplc, 0) + 1
+        return nplc, float(period)
+
+    def save(self):
+        with open(self.file_path, 'w') as file:
+            json.dump(self.entries, file, indent=1)
+
+    def report(self):
+        choices = ", ".join(f"NPLC {nplc}: {n}" for nplc, n in sorted(self.choices.items()))
+        print(f"Aperture optimiser: {self.characterisations} ranges characterised, steps per NPLC: {choices or '-'}.")
@@ -0,0 +1,93 @@
+########################################################
+##     Predictive current-range selection for the SMU ##
+##  Primary goal: choose the range of the next filter ##
+##  step BEFORE acquiring it, from the previous step  ##
+##  photocurrent x the ratio of incident powers, so   ##
+##   overflows (and their re-measurements) are rare   ##
+##     and the range can also go down again.          ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import bisect
+import numpy as np
+
+# Ranges (in A) used by the scripts, lowest to highest. SMU.py also accepts 2e-12, but it is too noisy to be useful.
+CURRENT_RANGES = [20e-12, 200e-12, 2e-9, 20e-9, 200e-9, 2e-6, 20e-6, 200e-6, 2e-3, 20e-3]
+
+
+# Smallest range that holds the current. Same result as the old linear scan, found by bisection.
+def detect_range(current, ranges=CURRENT_RANGES):
+    k = bisect.bisect_left(ranges, np.abs(current))
+    if k >= len(ranges) or np.isnan(current):
+        print("Could not detect current range.")
+        return None
+    return ranges[k]
+
+
+# Overflowed readings come back as NaN or as +9.9e37, anything above 1 A cannot be a real reading here
+def is_overflow(meas_curr):
+    meas_curr = np.asarray(meas_curr, dtype=float)
+    return bool(np.any(np.isnan(meas_curr)) or np.any(meas_curr > 1))
+
+
+class RangePredictor:
+    def __init__(self, initial_range, headroom=1.3, ranges=CURRENT_RANGES):
+        self.ranges = ranges
+        self.headroom = headroom  # predicted current is multiplied by this before the range is chosen
+        self.current_range = initial_range
+        self.last_pinc = None
+        self.last_photocurrent = None
+        self.dark_current = 0
+        self.legacy_range = initial_range  # range the old "only go up, after the fact" rule would be on
+        self.remeasurements = 0  # overflows that actually happened
+        self.legacy_remeasurements = 0  # overflows the old rule would have had on the same data
+        self.range_decreases = 0
+
+    # Photocurrent expected at pinc from the previous step (None before the first one)
+    def expected_photocurrent(self, pinc):
+        if self.last_photocurrent is None or not self.last_pinc:
+            return None
+        return self.last_photocurrent * (pinc / self.last_pinc)
+
+    # Forecasts the current of the next step and returns the range to set before acquiring it
+    def predict(self, pinc):
+        photocurrent = self.expected_photocurrent(pinc)
+        if photocurrent is None:
+            return self.current_range  # nothing to extrapolate from yet
+        expected = self.dark_current + photocurrent
+        largest = max(abs(expected), abs(self.dark_current))  # the trace may hold a dark segment as well
+        predicted_range = detect_range(self.headroom * largest, self.ranges)
+        if predicted_range is None:
+            predicted_range = self.ranges[-1]
+        if predicted_range < self.current_range:
+            self.range_decreases += 1
+        self.current_range = predicted_range
+        return predicted_range
+
+    # Called after an overflow: one range up, to re-measure the step
+    def overflow(self):
+        self.remeasurements += 1
+        k = self.ranges.index(self.current_range) if self.current_range in self.ranges else len(self.ranges) - 2
+        self.current_range = self.ranges[min(k + 1, len(self.ranges) - 1)]
+        return self.current_range
+
+    # Feeds back the result of a finished step. peak_current is the largest |current| of the whole trace.
+    def update(self, pinc, light_current, dark_current=0, peak_current=None):
+        if peak_current is None:
+            peak_current = max(abs(light_current), abs(dark_current))
+        legacy_range = self.legacy_range
+        while legacy_range < peak_current and legacy_range < self.ranges[-1]:
+            legacy_range *= 10  # old rule: re-measure one decade higher until it fits
+            self.legacy_remeasurements += 1
+        next_legacy = detect_range(1.2 * light_current, self.ranges)
+        self.legacy_range = max(legacy_range, next_legacy) if next_legacy is not None else legacy_range
+        self.last_pinc = pinc
+        self.last_photocurrent = light_current - dark_current
+        self.dark_current = dark_current
+
+    def saved_remeasurements(self):
+        return max(self.legacy_remeasurements - self.remeasurements, 0)
+
+    def report(self):
+        print(f"Auto-range: {self.remeasurements} re-measurements after overflow, {self.range_decreases} range "
+              f"decreases, {self.saved_remeasurements()} re-measurements saved compared to increase-only ranging.")
@@ -0,0 +1,226 @@
+"""
+Aim: Measure the throughput of the acquisition scripts without the optical bench.\n
+The scripts run unchanged against the simulated SMU, wheel set, flippers and powermeter of Simulators.py, which
+wait as long as the real instruments would (times time_scale). Reported per flow: wall time, the fraction of it
+in which no instrument was busy (script/Python overhead), and the time spent on file output and plots per step.\n
+==================\n
+Suggestions:\n
+1. This script depends on libraries: Simulators.py, Timing.py and all libraries of the benchmarked scripts.\n
+2. No instrument drivers (XiLab, Kinesis, TLPM, Keysight) are needed, only pyvisa (for its error types).\n
+3. The scripts run with the values in their own data entry sections. Compare results at the same time_scale
+   only: the overhead does not shrink with time_scale, the instrument times do.\n
+4. Save a baseline (save_baseline = True) on a known-good version, later runs flag regressions against it.\n
+"""
+
+import matplotlib
+matplotlib.use("Agg")  # plots are drawn and saved as in the lab, but no windows open
+import matplotlib.figure
+import matplotlib.pyplot as plt
+import contextlib
+import functools
+import json
+import os
+import runpy
+import shutil
+import tempfile
+import threading
+import time
+import tkinter
+import tkinter.filedialog
+import tkinter.messagebox
+import traceback
+import warnings
+import DataWriter
+import RunStore
+import Checkpoint
+import DarkCurrent
+import Simulators
+from Simulators import OpticalBench
+from Timing import timeline
+
+### USER TO SET/DEFINE VALUES HERE ###
+flows = ['LDR-LOW', 'LDR-HIGH', 'CURR-TIME', 'CURR-VOLT', 'NDF-CALIB']  # scripts to run, see FLOWS below
+time_scale = 0.02  # simulated instruments (and time.sleep in the scripts) run this many times the real time
+latency = {}  # changes to the latency model of Simulators.LATENCY, e.g. {'opm_read': 0.3, 'wheel_speed': 200}
+device = {}  # changes to the simulated DUT, e.g. {'saturation_current': 1e-4} (see Simulators.OpticalBench)
+results_folder = ''  # folder for the results and the data written by the scripts ('' asks for one)
+baseline_file = 'Benchmark_Baseline.json'  # earlier results to compare with (in results_folder), '' to skip
+regression_tolerance = 0.2  # relative increase of time per step, I/O per step or idle fraction that is flagged
+save_baseline = False  # "true": the results of this run become the new baseline
+###### END OF DATA ENTRY SECTION ######
+
+# flow: (script, counter of the simulated bench that counts its steps, what a step is)
+FLOWS = {
+    'LDR-LOW': ('EXP_LDR-LOW.py', 'Filters.step', 'filter step'),
+    'LDR-HIGH': ('EXP_LDR-HIGH.py', 'Filters.step', 'filter step'),
+    'CURR-TIME': ('EXP_CURR-TIME.py', 'SMU.acquire', 'trace'),
+    'CURR-VOLT': ('EXP_CURR-VOLT.py', 'SMU.acquire', 'sweep'),
+    'NDF-CALIB': ('CALIB_MW-NDFs.py', 'Filters.step', 'filter step'),
+}
+# File output and plot saving of the scripts, timed as "io" spans (calls inside another one are not counted again)
+IO_CALLS = [(DataWriter, "write_columns"), (DataWriter.RawDataWriter, "write_row"),
+            (DataWriter.RawDataWriter, "close"), (RunStore.RunStore, "write_step"), (RunStore.RunStore, "flush"),
+            (Checkpoint.RunCheckpoint, "save"), (DarkCurrent.DarkCurrentCache, "save"),
+            (matplotlib.figure.Figure, "savefig")]
+repo_folder = os.path.dirname(os.path.abspath(__file__))
+
+
+# Stands in for the tkinter root window of the scripts (no display needed)
+class NoWindow:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def withdraw(self):
+        pass
+
+    def destroy(self):
+        pass
+
+
+_io_depth = threading.local()
+
+
+def timed_io(function, name):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if getattr(_io_depth, "depth", 0):
+            return function(*args, **kwargs)
+        _io_depth.depth = 1
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _io_depth.depth = 0
+            timeline.record(name, "io", start, time.perf_counter() - start)
+    return wrapper
+
+
+# Time on the acquisition (main) thread that went into output and plots, and time of the output thread
+def io_times(main_thread):
+    main, background = 0.0, 0.0
+    for event in timeline.events:
+        if event.get("ph") != "X":
+            continue
+        if event["tid"] == main_thread and event["cat"] in ("io", "plot", "output"):
+            main += event["dur"] / 1e6
+        elif event["tid"] != main_thread and event["cat"] == "output":
+            background += event["dur"] / 1e6
+    return main, background
+
+
+def run_flow(name, output_folder):
+    script, step_counter, step_name = FLOWS[name]
+    run_folder = os.path.join(output_folder, name)
+    os.makedirs(run_folder, exist_ok=True)
+    shutil.copy(os.path.join(repo_folder, "Wheel_Calibration.txt"), run_folder)  # scripts read it from the cwd
+    bench = OpticalBench(latency=latency, time_scale=time_scale, **device)
+    Simulators.install(bench)
+    tkinter.filedialog.askdirectory = lambda *args, **kwargs: run_folder
+    timeline.events.clear()
+    timeline.durations.clear()
+    timeline.enable()
+    cwd = os.getcwd()
+    os.chdir(run_folder)
+    error = None
+    start = time.perf_counter()
+    try:
+        with open(os.path.join(run_folder, f"{name}.log"), 'w') as log, contextlib.redirect_stdout(log), \
+                warnings.catch_warnings():
+            warnings.simplefilter("ignore")  # non-interactive backend warnings of plt.show()/pause()
+            runpy.run_path(os.path.join(repo_folder, script), run_name="__main__")
+    except SystemExit:
+        pass
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+    end = time.perf_counter()
+    os.chdir(cwd)
+    Simulators.uninstall()
+    plt.close('all')
+    wall = end - start
+    busy = bench.busy(start, end)
+    io_main, io_background = io_times(threading.get_ident())
+    steps = max(bench.counts.get(step_counter, 0), 1)
+    # In lab time every simulated wait (instruments, time.sleep) is 1/time_scale longer, the overhead stays the same
+    lab_time = wall + busy["waiting"] * (1 / time_scale - 1)
+    return {"script": script, "error": error, "steps": steps, "step": step_name, "wall_s": wall,
+            "per_step_s": wall / steps, "idle_fraction": 1 - busy["any"] / wall,
+            "smu_idle_fraction": 1 - busy.get("SMU", 0) / wall, "lab_time_s": lab_time,
+            "lab_idle_fraction": 1 - busy["any"] / time_scale / lab_time, "io_main_per_step_s": io_main / steps,
+            "io_background_per_step_s": io_background / steps, "counts": dict(bench.counts)}
+
+
+def report(results, baseline):
+    print(f"\nBenchmark at time_scale {time_scale} (instruments {1 / time_scale:g}x faster than real)")
+    print(f"{'flow':<11}{'steps':>7}{'wall s':>9}{'s/step':>9}{'idle %':>8}{'SMU idle %':>11}{'lab s':>9}"
+          f"{'lab idle %':>11}{'I/O ms/step':>12}{'bg ms/step':>11}")
+    for name, r in results.items():
+        if r["error"]:
+            print(f"{name:<11} FAILED: {r['error']} (see {name}.log)")
+            continue
+        print(f"{name:<11}{r['steps']:>7}{r['wall_s']:>9.2f}{r['per_step_s']:>9.3f}{100 * r['idle_fraction']:>8.1f}"
+              f"{100 * r['smu_idle_fraction']:>11.1f}{r['lab_time_s']:>9.0f}{100 * r['lab_idle_fraction']:>11.1f}"
+              f"{1e3 * r['io_main_per_step_s']:>12.2f}{1e3 * r['io_background_per_step_s']:>11.2f}")
+    regressions = []
+    for name, r in results.items():
+        old = baseline.get("flows", {}).get(name)
+        if old is None or r["error"] or baseline.get("time_scale") != time_scale:
+            continue
+        for metric in ("per_step_s", "idle_fraction", "io_main_per_step_s"):
+            if r[metric] > (1 + regression_tolerance) * old[metric] and r[metric] - old[metric] > 1e-3:
+                regressions.append(f"{name}: {metric} {old[metric]:.4g} -> {r[metric]:.4g}")
+    if baseline and baseline.get("time_scale") != time_scale:
+        print(f"Baseline was taken at time_scale {baseline.get('time_scale')}, not compared.")
+    for regression in regressions:
+        print("REGRESSION", regression)
+    if baseline and not regressions:
+        print("No regressions against the baseline.")
+    return regressions
+
+
+start_time = time.time()
+
+if not results_folder:
+    root = tkinter.Tk()
+    root.withdraw()
+    results_folder = tkinter.filedialog.askdirectory()
+    print("Selected folder path to save results to:", results_folder)
+    if not results_folder:
+        print('File selection cancelled.')
+        quit()
+output_folder = tempfile.mkdtemp(prefix="Benchmark ", dir=results_folder)
+baseline_path = os.path.join(results_folder, baseline_file) if baseline_file else ''
+baseline = {}
+if baseline_path and os.path.exists(baseline_path):
+    with open(baseline_path, 'r') as file:
+        baseline = json.load(file)
+
+# The scripts run in this process, with windows and dialogs replaced and file output timed
+originals = [(owner, attribute, getattr(owner, attribute)) for owner, attribute in IO_CALLS]
+for owner, attribute, function in originals:
+    setattr(owner, attribute, timed_io(function, f"{getattr(owner, '__name__', owner)}.{attribute}"))
+tk_functions = (tkinter.Tk, tkinter.filedialog.askdirectory, tkinter.messagebox.showinfo)
+tkinter.Tk = NoWindow
+tkinter.messagebox.showinfo = lambda *args, **kwargs: 'ok'
+results = {}
+for name in flows:
+    print(f"Running {name} ({FLOWS[name][0]}) ...")
+    results[name] = run_flow(name, output_folder)
+tkinter.Tk, tkinter.filedialog.askdirectory, tkinter.messagebox.showinfo = tk_functions
+for owner, attribute, function in originals:
+    setattr(owner, attribute, function)
+timeline.enabled = False
+
+regressions = report(results, baseline)
+summary = {"time_scale": time_scale, "latency": dict(Simulators.LATENCY, **latency), "device": device,
+           "date": time.ctime(), "flows": results, "regressions": regressions}
+with open(os.path.join(output_folder, "Benchmark results.json"), 'w') as file:
+    json.dump(summary, file, indent=1)
+if save_baseline and baseline_path:
+    with open(baseline_path, 'w') as file:
+        json.dump(summary, file, indent=1)
+    print(f"Baseline saved to {baseline_path}")
+print(f"Data and logs of the benchmarked scripts are in {output_folder}")
+
+duration = time.time() - start_time
+print("The script took ", duration, " seconds to run.")
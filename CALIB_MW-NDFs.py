@@ -22,7 +22,7 @@ from TLPM import TLPM
 import numpy as np
 import time
 import os
-import csv
+from DataWriter import RawDataWriter, write_columns
 
 
 ### USER TO SET/DEFINE VALUES HERE ###
@@ -93,11 +93,7 @@ print("Average Optical Power in Dark condition:", average_power_dark)
 print("Note that this is actually the offset within the OPM.")
 D_file_name = f"Results dump/RawData_PM-t_{measurement_name}_{number_of_points}pts_{measurement_interval}s_0-0.csv"
 D_file_path = os.path.join(folder_path, D_file_name)
-with open(D_file_path, 'w', newline='') as file:
-    writer = csv.writer(file, delimiter='\t')
-    writer.writerow(["Time", "Optical power"])  # write header
-    for t, pwr in zip(Ttime_dark, Optical_power_dark):
-        writer.writerow([t, pwr])  # write data
+write_columns(D_file_path, ["Time", "Optical power"], Ttime_dark, Optical_power_dark)
 print(f"Data for dark condition saved to {D_file_path}")  # status update
 # *******************************************************************
 
@@ -137,24 +133,20 @@ for i in range(len(filter_pos)):
         print("Moving to: ", filter_pos[i])
     Ttime = []
     Optical_power = []
-    for j in range(N_meas): # Measures optical power for "number_of_points" points, one-by-one
-        power = c_double()
-        tlPM.measPower(byref(power))
-        Optical_power.append(power.value)
-        Ttime.append(time.time() - start_time)
-        time.sleep(measurement_interval)
-        # *******************************************************************
-        # Save Optical power versus time for each filter combination (i)
-        file_name = f"Results dump/RawData_PM-t_{measurement_name}_{number_of_points}pts_" \
-                    f"{measurement_interval}s_{filter_pos[i]}.csv"
-        file_path = os.path.join(folder_path, file_name)
-        # Write data to the CSV file
-        with open(file_path, 'w', newline='') as file:
-            writer = csv.writer(file, delimiter='\t')
-            writer.writerow(["Time", "Optical power"])  # write header
-            for t, pwr in zip(Ttime, Optical_power):
-                writer.writerow([t, pwr])  # write data
-   
+    # Save Optical power versus time for each filter combination (i). The file is opened once and every point is
+    # appended as it is measured, instead of rewriting the whole file for every new point.
+    file_name = f"Results dump/RawData_PM-t_{measurement_name}_{number_of_points}pts_" \
+                f"{measurement_interval}s_{filter_pos[i]}.csv"
+    file_path = os.path.join(folder_path, file_name)
+    with RawDataWriter(file_path, ["Time", "Optical power"]) as raw_writer:
+        for j in range(N_meas): # Measures optical power for "number_of_points" points, one-by-one
+            power = c_double()
+            tlPM.measPower(byref(power))
+            Optical_power.append(power.value)
+            Ttime.append(time.time() - start_time)
+            raw_writer.write_row([Ttime[-1], Optical_power[-1]])  # write data
+            time.sleep(measurement_interval)
+
     # Store the lists
     all_optical_power.append(Optical_power)
     all_Ttime.append(Ttime)
@@ -175,10 +167,8 @@ else:
 # Saving data of Filter-wheel combination as "Average Optical Power | Filter Combination"
 file_name = f"PM_T-ratios_{measurement_name}_{number_of_points}pts_{measurement_interval}s.csv"
 file_path = os.path.join(folder_path, file_name)
-with open(file_path, 'w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerow(["Average Optical Power", "Filter-Combination", "Transmitivity(0to1)"])  # Header
-    writer.writerows([(avg_power, filter_pos[i], ratios[i]) for i, avg_power in enumerate(averages)])
+write_columns(file_path, ["Average Optical Power", "Filter-Combination", "Transmitivity(0to1)"],
+              averages, filter_pos, ratios, delimiter=',')
 print(f"Results saved to {file_path}")
 # *******************************************************************
 
@@ -0,0 +1,84 @@
+########################################################
+##       Checkpointing of long multi-loop LDR runs    ##
+##  Primary goal: after every filter step, keep the   ##
+##  results measured so far, the optical references   ##
+##  and the SMU state on disk, so a crashed run can   ##
+##  be started again and continues at the next        ##
+##           unmeasured filter step.                  ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import json
+import os
+import time
+
+
+class RunCheckpoint:
+    # settings: everything that has to be the same for a run to be resumed (device, voltage, NPLC, points, ...).
+    # A checkpoint last saved more than max_age (in s) ago is left from an older crash and not resumed.
+    def __init__(self, file_path, settings, max_age=12 * 3600):
+        self.file_path = file_path
+        self.settings = json.loads(json.dumps(settings))  # as stored in JSON, so it compares with the file
+        self.state = {"settings": self.settings, "loops": {}}
+        self.resumed = False
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as file:
+                state = json.load(file)
+            age = time.time() - os.path.getmtime(file_path)
+            if state.get("settings") != self.settings:
+                print(f"Checkpoint {file_path} belongs to other settings, starting a new run.")
+            elif age > max_age:
+                print(f"Checkpoint {file_path} is {age / 3600:.1f} h old (more than {max_age / 3600:g} h), "
+                      f"starting a new run.")
+            else:
+                self.state = state
+                self.resumed = True
+                print(f"RESUMING a crashed run of {self.settings.get('device')} from checkpoint {file_path}, "
+                      f"saved {age / 60:.0f} min ago: {self.summary()}")
+
+    def _loop(self, meas_num):
+        return self.state["loops"].setdefault(str(meas_num), {"references": None, "steps": {}, "done": False})
+
+    def summary(self):
+        loops = self.state["loops"].values()
+        return f"{sum(loop['done'] for loop in loops)} loops done, " \
+               f"{sum(len(loop['steps']) for loop in loops if not loop['done'])} steps of the open loop done."
+
+    def loop_done(self, meas_num):
+        return self._loop(meas_num)["done"]
+
+    # Optical references (OPM offset, laser power) and SMU state of a loop, None if not measured yet
+    def references(self, meas_num):
+        return self._loop(meas_num)["references"]
+
+    def set_references(self, meas_num, **references):
+        self._loop(meas_num)["references"] = references
+        self.save()
+
+    # Results of filter step i of a loop, None if it has not been measured
+    def step(self, meas_num, i):
+        return self._loop(meas_num)["steps"].get(str(i))
+
+    def save_step(self, meas_num, i, **results):
+        results["timestamp"] = time.time()
+        self._loop(meas_num)["steps"][str(i)] = {name: float(value) if isinstance(value, (int, float)) else value
+                                                  for name, value in results.items()}
+        self.save()
+
+    def finish_loop(self, meas_num):
+        self._loop(meas_num)["done"] = True
+        self.save()
+
+    # Whole run done: the checkpoint is not needed any more
+    def finish(self):
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    # Written to a temporary file first and then renamed, so a crash while saving keeps the previous checkpoint
+    def save(self):
+        temp_path = self.file_path + ".tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(self.state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.file_path)
@@ -0,0 +1,76 @@
+########################################################
+##        Dark-current cache for LDR measurements     ##
+##  Primary goal: measure the dark current of a DUT   ##
+##  once per (device, voltage, NPLC, current range),  ##
+##  keep it with a timestamp, and re-use it across    ##
+##  filter steps and runs until it is too old or the  ##
+##        DUT is seen to drift.                       ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import json
+import os
+import time
+import numpy as np
+
+
+class DarkCurrentCache:
+    def __init__(self, file_path="Dark_Current_Cache.json", max_age=1800, refresh_every=8, drift_sigma=3):
+        self.file_path = file_path
+        self.max_age = max_age  # in s. Older entries are measured again.
+        self.refresh_every = refresh_every  # re-measure after this many steps that used the cached value (0: never)
+        self.drift_sigma = drift_sigma  # a new dark value this many standard errors away from the cache is drift
+        self.entries = {}
+        self.uses = {}  # steps served from the cache since the last measurement, per key
+        self.drifting = set()  # keys whose last measurement drifted, they are measured again on the next step
+        self.hits = 0
+        self.misses = 0
+        self.drifts = 0
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as file:
+                self.entries = json.load(file)
+
+    @staticmethod
+    def key(device, voltage, nplc, current_range):
+        return f"{device}|{voltage}V|NPLC {nplc}|{current_range}A"
+
+    # Cached entry ({mean, std, n, timestamp}) if it may still be used, else None (a dark window must be measured)
+    def lookup(self, device, voltage, nplc, current_range):
+        key = self.key(device, voltage, nplc, current_range)
+        entry = self.entries.get(key)
+        if entry is None or key in self.drifting or time.time() - entry["timestamp"] > self.max_age \
+                or (self.refresh_every and self.uses.get(key, 0) >= self.refresh_every):
+            self.misses += 1
+            return None
+        self.uses[key] = self.uses.get(key, 0) + 1
+        self.hits += 1
+        return entry
+
+    # Stores a freshly measured dark window. Returns True if it drifted away from the previous cached value.
+    def store(self, device, voltage, nplc, current_range, dark_window):
+        key = self.key(device, voltage, nplc, current_range)
+        dark_window = np.asarray(dark_window, dtype=float)
+        entry = {"mean": float(np.mean(dark_window)), "std": float(np.std(dark_window)), "n": int(len(dark_window)),
+                 "timestamp": time.time()}
+        drifted = False
+        old = self.entries.get(key)
+        if old is not None and old["n"] > 0 and entry["n"] > 0:
+            standard_error = np.sqrt(old["std"] ** 2 / old["n"] + entry["std"] ** 2 / entry["n"])
+            if abs(entry["mean"] - old["mean"]) > self.drift_sigma * standard_error:
+                drifted = True
+                self.drifts += 1
+                print(f"Dark current drift at {key}: {old['mean']} A -> {entry['mean']} A")
+        self.entries[key] = entry
+        self.uses[key] = 0
+        if drifted:
+            self.drifting.add(key)
+        else:
+            self.drifting.discard(key)
+        return drifted
+
+    def save(self):
+        with open(self.file_path, 'w') as file:
+            json.dump(self.entries, file, indent=1)
+
+    def report(self):
+        print(f"Dark current cache: {self.hits} dark windows skipped, {self.misses} measured, {self.drifts} drifts.")
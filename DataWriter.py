@@ -0,0 +1,64 @@
+########################################################
+##     Append-only writer for raw measurement data    ##
+##   Primary goal: write each datapoint once, as it   ##
+##   arrives, instead of rewriting the whole CSV file ##
+##            for every new measured sample.          ##
+##   THIS FILE ACTS AS A LIBRARY FOR ALL EXP_/CALIB_  ##
+##                      SCRIPTS.                      ##
+########################################################
+
+import csv
+import os
+
+
+class RawDataWriter:
+    def __init__(self, file_path, header, delimiter='\t', flush_every=64):
+        self.file_path = file_path
+        self.flush_every = flush_every  # rows kept in the buffer before they are pushed to the OS
+        self.rows_written = 0
+        self.pending = 0  # rows written since the last flush
+        self.file = open(file_path, 'w', newline='')
+        self.writer = csv.writer(self.file, delimiter=delimiter)
+        self.writer.writerow(header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+        self.rows_written += 1
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    # Pushes buffered rows to the OS, so a crash only loses the last few points
+    def flush(self):
+        self.file.flush()
+        self.pending = 0
+
+    # fsync makes sure the data is really on disk before the file is closed
+    def close(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        try:
+            os.fsync(self.file.fileno())
+        except OSError:
+            pass  # some network drives do not support fsync, data is still flushed
+        self.file.close()
+        self.file = None
+
+
+# One-shot helper for data that is already complete (e.g. a full trace fetched from the SMU)
+def write_columns(file_path, header, *columns, delimiter='\t'):
+    with RawDataWriter(file_path, header, delimiter=delimiter) as writer:
+        writer.write_rows(zip(*columns))
+    return file_path
@@ -3,20 +3,27 @@ By:  Giedrius Puidokas and Siddhartha Saggar \n
 Aim: Measure dark current from DUT as a function of time.\n
 ==================\n
 Suggestions:\n
-1. This script depends on libraries: SMU.py.\n
+1. This script depends on libraries: SMU.py, NoiseSpectrum.py, LineFrequency.py.\n
 2. Install KKeysight software and drivers for controlling the SMU.\n
 3. Ensure dark condition: either manually trigger Light-blocker to cut light beam path, or turn-off LD.\n
 4. Raw data is saved in a new folder named "Dark Current" within the folder location chosen by the user.\n
+5. With noise_analysis, the current noise spectral density (averaged over the N_meas traces) and D* are saved
+   there as well. The lowest frequency is 1/(N_pts x del_t), the highest 1/(2 x del_t).\n
+6. With line_sync, del_t is rounded to a whole number of mains periods, so mains pickup does not alias into
+   slow beats in the traces. Keep NPLC a whole number as well.\n
 """
 
-from SMU import SMUDevice
+from SMU import SMUDevice, SMUGroup
 from FlipMirror import FlipMirror
 from LightBlock import LightBlock
 import tkinter as tk
 from tkinter import filedialog
 import numpy as np
 import matplotlib.pyplot as plt
-import csv
+from DataWriter import write_columns
+from LivePlot import LivePlot
+from NoiseSpectrum import NoiseSpectrum, specific_detectivity
+from LineFrequency import LineFrequency
 import time
 import os
 
@@ -28,7 +35,12 @@ voltage = 0.5 # applied voltage bias in V, where - or + is also dependent on the
 NPLC = 5  # Number of Power Line Cycles. Duration of 1NPLC = 1/national-powergrid-AC-frequency-in-Hz.
 N_meas = 15  # Number of current-time traces to be recorded. Records N_pts at del_t sampling, N_meas times.
 save_plots = True  # "true" for plots to be saved as .png files.
+extra_devices = []  # further DUTs measured at the same time: [('name', 'VISA address of its SMU', channel), ...]
 show_plots = [True, 0.1]  # "true" for plots to be shown after each measurement. Second number shows duration in s.
+noise_analysis = [True, 'welch']  # [on/off, 'welch' or 'lomb' (Lomb-Scargle, if the SMU timestamps are uneven)]
+responsivity = 0  # in A/W at the wavelength of interest, for the specific detectivity D*. 0: no D*.
+device_area = 0.01  # active area of the DUT in cm^2, for D*.
+line_sync = [False, 0]  # [on/off, mains frequency in Hz (50 or 60), 0: found from the mains pickup of the DUT]
 ###### END OF DATA ENTRY SECTION ######
 
 start_time = time.time()  # Only to keep a check on how long time the script takes to be executed.
@@ -49,26 +61,70 @@ if not os.path.exists(os.path.join(folder_path, 'Dark Current')):
 # Device initialization and abbreviating (giving shorthand alias to) instrument-names for ease of command-writing
 SMU = SMUDevice()
 SMU.connect()
+# Further DUTs: a second channel of a connected SMU shares its connection, another SMU gets its own
+duts = {device_name: SMU}
+connected = {SMU.address: SMU}
+for name, address, channel in extra_devices:
+    if address in connected:
+        duts[name] = connected[address].channel_device(channel)
+    else:
+        duts[name] = connected[address] = SMUDevice(address, channel)
+        duts[name].connect()
+group = SMUGroup(list(duts.values()))  # configures, starts and fetches all DUTs together (see SMU.py)
 time.sleep(0.3)
-SMU.write_command(f":SOURce:VOLTage:LEVel:IMMediate:AMPLitude {voltage}")
+group.call("write_command", f":SOURce:VOLTage:LEVel:IMMediate:AMPLitude {voltage}")
 time.sleep(0.3)
+# Mains frequency (see LineFrequency.py), set on every SMU. del_t becomes a whole number of line periods.
+mains = LineFrequency()
+if line_sync[0]:
+    if line_sync[1]:
+        mains.frequency = line_sync[1]
+    else:
+        mains.detect(SMU)  # on the first DUT
+    group.call("line_frequency", mains.frequency)
+    del_t = mains.sync_period(del_t)
+    mains.check_nplc(NPLC)
 # *******************************************************************
 
 # Some arrays to store results and some definitions
 output_current = []
 output_time = []
-def show_currenttime_plot(otime, ocurrent, sname):
-    plt.plot(otime, ocurrent)
-    plt.xlabel('Time (s)')
-    plt.ylabel('Current (A)')
-    plt.title(f'{device_name} ')
+# One figure for all traces, each new trace replaces the previous one on the existing line
+ct_fig, ct_ax = plt.subplots()
+ct_plot = LivePlot(ct_fig, min_interval=0)
+for name in duts:
+    ct_plot.add_series(name, ct_ax, fmt='-', label=name)
+ct_ax.set_xlabel('Time (s)')
+ct_ax.set_ylabel('Current (A)')
+ct_ax.set_title(f'{", ".join(duts)} ')
+if len(duts) > 1:
+    ct_ax.legend()
+# Noise spectral density of each DUT, averaged over the traces measured so far
+spectra = {name: NoiseSpectrum(noise_analysis[1]) for name in duts}
+if noise_analysis[0]:
+    psd_fig, psd_ax = plt.subplots()
+    psd_plot = LivePlot(psd_fig, min_interval=0)
+    for name in duts:
+        psd_plot.add_series(name, psd_ax, fmt='-', label=name)
+    psd_ax.set_xscale('log')
+    psd_ax.set_yscale('log')
+    psd_ax.set_xlim(1 / (N_pts * del_t), 1 / (2 * del_t))
+    psd_ax.set_ylim(1e-16, 1e-12)  # until the first trace is in
+    psd_ax.set_xlabel('Frequency (Hz)')
+    psd_ax.set_ylabel('Current noise (A/Hz$^{1/2}$)')
+    psd_ax.set_title(f'Noise spectral density, {voltage} V')
+    if len(duts) > 1:
+        psd_ax.legend()
+def show_currenttime_plot(traces, sname):
+    for name, (ocurrent, otime) in traces.items():
+        ct_plot.set_series(name, otime, ocurrent)
+    ct_plot.refresh(force=True)
     if save_plots:
         fig_path = os.path.join(folder_path, sname)
-        plt.savefig(fig_path)
+        ct_fig.savefig(fig_path)
     if show_plots[0]:
         plt.show(block=False)
         plt.pause(show_plots[1])
-        plt.close()
 # Detect range function. It is vulnerable to float conversion errors, change to string handling for redundancy
 def detect_range(current):
     allowed_ranges = [20e-12, 200e-12, 2e-9, 20e-9, 200e-9, 2e-6, 20e-6, 200e-6, 2e-3, 20e-3]
@@ -83,35 +139,63 @@ def detect_range(current):
 # *******************************************************************
 
 # Record current-time traces, based on the user-set conditions 
-SMU.set_current_range("AUTO")
-SMU.measurement_speed("MED")
-SMU.trigger_settings(mtype="AINT", count=10)
-SMU.initiate("ACQuire")
-IRange = detect_range(np.max(SMU.get_current()))
-SMU.set_current_range(IRange)
-SMU.measurement_speed(NPLC)
-SMU.trigger_settings(mtype="TIMer", count=N_pts, period=del_t)
+group.call("set_current_range", "AUTO")
+group.call("measurement_speed", "MED")
+group.trigger_settings(mtype="AINT", count=10)
+group.initiate("ACQuire")
+for device, (range_current, range_time) in zip(group.devices, group.fetch()):
+    device.set_current_range(detect_range(np.max(range_current)))  # each DUT gets its own range
+group.call("measurement_speed", NPLC)
+group.trigger_settings(mtype="TIMer", count=N_pts, period=del_t)
 print("Measurement starts now")
 for idx in range(N_meas):
-    SMU.initiate("ACQuire", timeout=600)
-    output_current = SMU.get_current()
-    output_time = SMU.get_time()
-    print("Measured", device_name, "; for N:", N_pts, " ; del-t:", del_t, " ; version:", idx+1, "/", N_meas,".")
-    file_name = f"Dark Current/IT_{device_name}_{voltage}V_{del_t}s_{N_pts}pts_{idx+1}.csv" # for saving the raw data
-    file_path = os.path.join(folder_path, file_name)
-    with open(file_path, 'w', newline='') as file:
-        writer = csv.writer(file, delimiter='\t')
-        writer.writerow(["Time", "Current"])  # write header
-        for t, c in zip(output_time, output_current):
-            writer.writerow([t, c])  # write data
+    group.initiate("ACQuire", timeout=600)
+    traces = dict(zip(duts, group.fetch()))  # {name: (current, time)}, fetched from all SMUs at once
+    for name, (output_current, output_time) in traces.items():
+        print("Measured", name, "; for N:", N_pts, " ; del-t:", del_t, " ; version:", idx+1, "/", N_meas,".")
+        file_name = f"Dark Current/IT_{name}_{voltage}V_{del_t}s_{N_pts}pts_{idx+1}.csv" # for saving the raw data
+        file_path = os.path.join(folder_path, file_name)
+        write_columns(file_path, ["Time", "Current"], output_time, output_current)
+        if noise_analysis[0]:
+            frequencies, psd = spectra[name].add(output_current, output_time)
+            if psd is not None:
+                print(f"Noise of {name}: {spectra[name].band_noise():.3g} A/Hz^1/2 (average of {spectra[name].count}"
+                      f" traces)")
+                psd_plot.set_series(name, frequencies[1:], np.sqrt(psd[1:]))  # without DC
+    if noise_analysis[0]:
+        psd_plot.refresh(force=True)
     plot_name = f"{device_name}_{voltage}V_{del_t}s_{N_pts}pts_{idx+1}.png"
-    show_currenttime_plot(output_time, output_current, plot_name)
+    show_currenttime_plot(traces, plot_name)
 # **********************************************************************
 
+# Noise spectral density (and D*) averaged over all traces
+if noise_analysis[0]:
+    for name, spectrum in spectra.items():
+        spectrum.report(name)
+        if spectrum.psd is None:
+            continue
+        columns = [spectrum.frequencies, spectrum.psd, spectrum.noise_density()]
+        header = ["Frequency", "PSD", "Noise_Density"]
+        if responsivity:
+            columns.append(specific_detectivity(responsivity, device_area, spectrum.noise_density()))
+            header.append("Detectivity")
+            print(f"Specific detectivity of {name}: "
+                  f"{specific_detectivity(responsivity, device_area, spectrum.band_noise()):.3g} Jones")
+        file_name = f"Dark Current/Noise_{name}_{voltage}V_{del_t}s_{N_pts}pts_{spectrum.method}.csv"
+        write_columns(os.path.join(folder_path, file_name), header, *columns)
+    if save_plots:
+        psd_fig.savefig(os.path.join(folder_path, f"Noise_{device_name}_{voltage}V_{del_t}s_{N_pts}pts.png"))
+    plt.close(psd_fig)
+# **********************************************************************
+
+plt.close(ct_fig)
+
 # Disconnect with the instruments
-SMU.write_command(":SOURce:VOLTage:LEVel:IMMediate:AMPLitude 0")
+group.call("write_command", ":SOURce:VOLTage:LEVel:IMMediate:AMPLitude 0")
 time.sleep(0.2)
-SMU.disconnect()
+group.close()
+for device in connected.values():  # channels sharing a connection are closed with it
+    device.disconnect()
 
 duration = time.time() - start_time
 print("The script took ", duration, " seconds to run.")
\ No newline at end of file
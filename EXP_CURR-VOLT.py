@@ -4,10 +4,12 @@ Aim: Measure current as function of applied voltage bias, from steady-state phot
 Illumination condition is either dark or CW mode incident light of known wavelength and optical power. \n
 ==================\n
 Suggestions:\n
-1. This script depends on libraries: SMU.py.\n
+1. This script depends on libraries: SMU.py, Hysteresis.py.\n
 2. Install KKeysight software and drivers for controlling the SMU.\n
 3. Steady state illumination condition is not a variable in this experiment, it is to be recorded by the user. \n
 4. For dark condition: either manually trigger Light-blocker to cut light beam path, or turn-off LD.\n
+5. Voc, Isc, rectification ratio and ideality factor of every sweep (both halves of double sweeps, with their
+   hysteresis index) are saved in one summary file, I-V_summary_... (or I-V_hysteresis_... for pulsed sweeps).\n
 """
 
 from SMU import SMUDevice
@@ -17,7 +19,8 @@ import time
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import messagebox
-import csv
+from DataWriter import write_columns
+from Hysteresis import split_sweeps, sweep_summary
 import os
 
 ### USER TO SET/DEFINE VALUES HERE ###
@@ -26,7 +29,13 @@ illum_cond = 'D' # Illumination Condition. Filename of saved rawdata includes th
 V_stt = 1 # Starting value of the applied voltage bias range, in Volts.
 V_end = -1 # End value of the applied voltage bias range, in Volts.
 N_pts = 201 # Number of points to be recorded in single sweep across the voltage bias range.
+sweep_type = ['linear', 0, 0.1, 0.5]  # 'linear': evenly spaced, or ['dense', V_center, half width in V, fraction of
+# N_pts within V_center +- half width]. 'dense' is a list sweep, points are put where the IV curve bends (0 V, Voc).
+pulsed_sweep = [False, [1e-3, 1e-2, 1e-1], 5e-4, 2e-3]  # [on/off, step periods in s (one double sweep each, sets
+# the sweep rate), pulse width in s (None: DC steps), fixed current range in A (auto-range is too slow for this)]
 save_plots = True  # "true" for plots to be saved as .png files.
+double_sweep = [False, 1]  # [on/off (sweeps there and back, for the hysteresis), number of sweeps in a row]
+temperature = 295  # of the DUT in K, for the ideality factor
 show_plots = [True, 10]  # "true" for plots to be shown after each measurement. Second number shows duration in s.
 ###### END OF DATA ENTRY SECTION ######
 
@@ -50,43 +59,130 @@ if not folder_path:
     quit()
 # *******************************************************************
 
+# Voltage list with a dense part around v_center and a coarse part over the rest of the range, in sweep direction.
+# A few points fewer than N_pts can come out, where the coarse and the dense part coincide.
+def dense_voltage_list(v_start, v_end, n_pts, v_center, half_width, dense_fraction):
+    n_dense = int(round(n_pts * dense_fraction))
+    low, high = min(v_start, v_end), max(v_start, v_end)
+    coarse = np.linspace(low, high, n_pts - n_dense)
+    dense = np.linspace(max(low, v_center - half_width), min(high, v_center + half_width), n_dense)
+    voltages = np.unique(np.round(np.concatenate([coarse, dense]), 6))  # sorted, duplicates removed
+    return (voltages if v_start <= v_end else voltages[::-1]).tolist()
+
+# Prints the summary of sweep_summary (see Hysteresis.py), one line per sweep. names: what the sweeps are called.
+def print_summary(summary, names):
+    for k, name in enumerate(names):
+        line = f"{name}:"
+        if "Hysteresis_Index" in summary:
+            line += (f" hysteresis index {summary['Hysteresis_Index'][k]:.3g}, loop area {summary['Loop_Area'][k]:.3g}"
+                     f" AV, max. |I_fwd - I_rev| {summary['Max_Difference'][k]:.3g} A at "
+                     f"{summary['V_Max_Difference'][k]} V;")
+        for branch in ("Fwd", "Rev"):
+            if f"Voc_{branch}" in summary:
+                voc, isc = summary[f"Voc_{branch}"][k], summary[f"Isc_{branch}"][k]
+                ratio, ideality = summary[f"Rectification_{branch}"][k], summary[f"Ideality_{branch}"][k]
+                line += (f" {branch.lower()}: Voc {voc:.3g} V, Isc {isc:.3g} A, rectification {ratio:.3g}, "
+                         f"ideality {ideality:.3g};")
+        print(line.rstrip(";") + ".")
+
+# Fast double sweeps at several sweep rates, with the hysteresis metrics of each (see Hysteresis.py)
+def pulsed_iv():
+    SMU.set_current_range(pulsed_sweep[3])
+    plt.figure(figsize=(10, 6))
+    plt.grid(True, which="both")
+    rates, sources, currents = [], [], []
+    for period in pulsed_sweep[1]:
+        SMU.transient_sweep(V_stt, V_end, N_pts, period, pulse_width=pulsed_sweep[2], double=True)
+        SMU.initiate("ALL")
+        source, current, ttime = SMU.get_arrays()
+        rates.append(abs(V_end - V_stt) / ((N_pts - 1) * period))  # in V/s
+        sources.extend(source)
+        currents.extend(current)
+        plt.semilogy(source, np.abs(current), '-', label=f'{rates[-1]:.3g} V/s')
+        write_columns(os.path.join(folder_path, f"I-V_pulsed_{device_name}_{illum_cond}_{rates[-1]:.3g}Vps.csv"),
+                      ["Time", "Source", "Current"], ttime, source, current)
+    summary = sweep_summary(sources, currents, N_pts, double=True, temperature=temperature)
+    summary.pop("Sweep")
+    print_summary(summary, [f"Sweep rate {rate:.3g} V/s" for rate in rates])
+    write_columns(os.path.join(folder_path, f"I-V_hysteresis_{device_name}_{illum_cond}.csv"),
+                  ["Sweep_Rate", "Period"] + list(summary), rates, pulsed_sweep[1], *summary.values())
+    SMU.write_command(":SOURce:FUNCtion:SHAPe DC")  # back to DC for the next scripts
+    plt.title(f'I-V_pulsed_{device_name}_{illum_cond}')
+    plt.xlabel('Source')
+    plt.ylabel('Current')
+    plt.legend()
+    if save_plots:
+        plt.savefig(os.path.join(folder_path, f"I-V_pulsed_{device_name}_{illum_cond}.png"))
+    if show_plots[0]:
+        plt.show(block=False)
+        plt.pause(show_plots[1])
+        plt.close()
+
 # ******************Measurements***********************************
-SMU.vs_function(ftype="SINGle", vstart=V_stt, vend=V_end  , points=N_pts, speed=measurement_speed)
-time.sleep(0.2)
-SMU.set_current_range("AUTO")
-time.sleep(0.2)
-SMU.initiate("ALL")     # ACQuire = measurement, TRANsient = source, ALL = both. For IV we need both
-source = SMU.get_source()   # This just gets the measured data from Keysight
-current = SMU.get_current()
+if pulsed_sweep[0]:
+    pulsed_iv()
+else:
+    sweep_points = N_pts  # points of one sweep (one direction)
+    if sweep_type[0] == 'dense':
+        V_list = dense_voltage_list(V_stt, V_end, N_pts, *sweep_type[1:])
+        sweep_points = len(V_list)
+        print(f"List sweep: {len(V_list)} points, {int(round(N_pts * sweep_type[3]))} of them within "
+              f"{sweep_type[1]} +- {sweep_type[2]} V.")
+        if double_sweep[0]:
+            V_list = V_list + V_list[::-1]  # same turning point twice, as in the double staircase
+        SMU.vs_function(ftype="LIST", voltages=V_list, speed=measurement_speed)
+    else:
+        SMU.vs_function(ftype="DOUBle" if double_sweep[0] else "SINGle", vstart=V_stt, vend=V_end, points=N_pts,
+                        speed=measurement_speed)
+    time.sleep(0.2)
+    SMU.set_current_range("AUTO")
+    time.sleep(0.2)
+    source, current = [], []
+    for sweep in range(double_sweep[1]):
+        SMU.initiate("ALL")     # ACQuire = measurement, TRANsient = source, ALL = both. For IV we need both
+        source.extend(SMU.get_source())   # This just gets the measured data from Keysight
+        current.extend(SMU.get_current())
 
-# Create the plot
-plt.figure(figsize=(10, 6))
-plt.grid(True, which="both")    # "both" probably redundant, too lazy to check
-plt.semilogy(source, np.abs(current), 'b-')  # abs(current) to make sure its plottable in log
-# Add title and labels
-plt.title(f'I-V_meas_{device_name}_{illum_cond}')
-plt.xlabel('Source')
-plt.ylabel('Current')
-if save_plots:
-    plot_path = os.path.join(folder_path, f"I-V_meas_{device_name}_{illum_cond}.png")
-    plt.savefig(plot_path)
-if show_plots[0]:
-    plt.show(block=False)
-    plt.pause(show_plots[1])
-    plt.close()
+    # Create the plot: one colour per sweep, reverse halves of double sweeps dashed
+    plt.figure(figsize=(10, 6))
+    plt.grid(True, which="both")    # "both" probably redundant, too lazy to check
+    voltages, currents = split_sweeps(source, current, sweep_points, double=double_sweep[0])
+    for k, (v_sweep, i_sweep) in enumerate(zip(voltages, currents)):
+        for branch, style in zip(range(len(v_sweep)), ['-', '--']):
+            label = f"sweep {k + 1}" + (" fwd" if branch == 0 else " rev") * double_sweep[0]
+            plt.semilogy(v_sweep[branch], np.abs(i_sweep[branch]), style, color=f'C{k}', label=label)  # abs for log
+    if len(voltages) > 1 or double_sweep[0]:
+        plt.legend()
+    # Add title and labels
+    plt.title(f'I-V_meas_{device_name}_{illum_cond}')
+    plt.xlabel('Source')
+    plt.ylabel('Current')
+    if save_plots:
+        plot_path = os.path.join(folder_path, f"I-V_meas_{device_name}_{illum_cond}.png")
+        plt.savefig(plot_path)
+    if show_plots[0]:
+        plt.show(block=False)
+        plt.pause(show_plots[1])
+        plt.close()
 
-# Saving rawdata
-file_name = f"I-V_meas_{device_name}_{illum_cond}.csv"
-file_path = os.path.join(folder_path, file_name)
-# Write data to the CSV file
-with open(file_path, 'w', newline='') as file:
-    writer = csv.writer(file, delimiter='\t')
-    writer.writerow(["Source", "Current"])  # write header
-    for s, c in zip(source, current):
-        writer.writerow([s, c])  # write data
-# # ******************************************************************************
+    # Saving rawdata
+    file_name = f"I-V_meas_{device_name}_{illum_cond}.csv"
+    file_path = os.path.join(folder_path, file_name)
+    # Write data to the CSV file
+    if double_sweep[0] or double_sweep[1] > 1:
+        sweep_number = np.repeat(np.arange(1, double_sweep[1] + 1), len(source) // double_sweep[1])
+        write_columns(file_path, ["Sweep", "Source", "Current"], sweep_number, source, current)
+    else:
+        write_columns(file_path, ["Source", "Current"], source, current)
+    # Voc, Isc, rectification ratio, ideality factor (and hysteresis) of every sweep in one file
+    summary = sweep_summary(source, current, sweep_points, double=double_sweep[0], temperature=temperature)
+    print_summary(summary, [f"Sweep {k}" for k in summary["Sweep"]])
+    write_columns(os.path.join(folder_path, f"I-V_summary_{device_name}_{illum_cond}.csv"), list(summary),
+                  *summary.values())
+    # # ******************************************************************************
 
 # Disconnect with the instruments
+SMU.vs_function(ftype="OFF")
 SMU.write_command(":SOURce:VOLTage:LEVel:IMMediate:AMPLitude 0")
 SMU.disconnect()
 
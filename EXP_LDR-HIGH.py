@@ -12,6 +12,10 @@ Suggestions:\n
 6. Similarly Keysight's software with drivers for controlling the SMU.\n
 7. Measured current under CW illumination is recorded under the name "Output_Current" in the script.\n
     and under "Current" in the saved rawdata file.\n
+8. With statistics_fetch on, the SMU keeps each trace in its buffer and sends only its mean, std, min, max and count.\n
+    Raw traces are then fetched (and saved) only for steps whose statistics show an overflow or an outlier.\n
+9. Raw data is saved as one CSV per filter position by default. raw_data_format = 'hdf5' keeps all raw traces of a run\n
+    in one file instead, and needs the h5py package (pip install h5py).\n
 """
 
 from FlipMirror import FlipMirror
@@ -27,7 +31,20 @@ from TLPM import TLPM
 import math
 import time
 import os
-import csv
+from DataWriter import write_columns
+from RunStore import RunStore
+from OutputPipeline import OutputPipeline
+from LivePlot import LivePlot
+from AutoRange import RangePredictor, detect_range, is_overflow
+from AdaptiveSampling import AdaptiveSampler
+from DarkCurrent import DarkCurrentCache
+from Aperture import ApertureOptimizer
+from Checkpoint import RunCheckpoint
+from Linearity import LinearityMonitor
+from RunResults import RunResults
+from LineFrequency import LineFrequency
+from Timing import timeline, instrument
+from LDRAnalysis import linear_dynamic_range, glitch_flags, statistics_anomaly
 import threading
 
 ### USER TO SET/DEFINE VALUES HERE ###
@@ -37,12 +54,25 @@ N_pts = 32  # Number of points to be recorded as a function of time. Should be 2
 sampling_time = 0.1  # Time period (in s) between any two adjacent data points recorded.
 voltage = 0.5 # Applied voltage bias in V, where - or + is also dependent on the connections made in the setup.
 i_d = 3e-13 # Mean dark current (in A) at same voltage bias. Prefer scientific format: 3.4mA as "3.4e-3".
+use_dark_cache = [False, 1800]  # [on/off, max. age in s] dark current measured by EXP_LDR-LOW.py used instead of i_d
 measurement_speed = 5  # denotes NPLC. Duration of 1NPLC = 1/national-powergrid-AC-frequency-in-Hz.
 save_plots = True  # "true" for plots to be saved as .png files.
 show_plots = [True, 10]  # "true" for plots to be shown after each measurement. Second number shows duration in s.
+raw_data_format = 'csv'  # 'csv': one file per filter position. 'hdf5': all raw traces of a run in one file (h5py).
+adaptive_sampling = [False, 0.005, 8, 256]  # [on/off, target relative SEM of photocurrent, min & max pts per step]
+aperture_optimizer = [False, 200]  # [on/off, target SNR of a step (photocurrent/SEM, 200 = adaptive_sampling 0.5 %)]
+linearity_monitor = [False, 0.1, 2]  # [on/off, allowed deviation from the linear fit, steps past a knee to stop]
+robust_estimator = [False, 'sigma_clip', 2]  # [on/off, 'sigma_clip'/'median'/'hampel', max. re-acquisitions of a step]
+line_sync = [False, 0]  # [on/off, mains frequency in Hz (50 or 60), 0: found from the mains pickup of the DUT]
+statistics_fetch = [False, 4]  # [on/off, outlier threshold in std] on: SMU sends step statistics, not raw traces
+resume_run = [False, 12]  # [on/off, max. age in h] a crashed run with the same settings continues where it stopped.
+timing = False  # "true": every instrument call is timed, saved as a Chrome trace and summed up per operation.
 number_of_measurements = 1  # in number of loops. Repeats the whole experiment again and saves all data uniquely.
 ###### END OF DATA ENTRY SECTION ######
 
+# With adaptive sampling each step starts with the minimum and is extended until it is precise enough.
+acq_points = adaptive_sampling[2] if adaptive_sampling[0] else N_pts
+
 start_time = time.time()  # Only to keep a check on how long time the script takes to be executed.
 
 # Importing calibration stuff (If trying to understand the code, check out the file)
@@ -81,18 +111,29 @@ if not folder_path:
 # Create folder for results if it doesn't already exist
 if not os.path.exists(os.path.join(folder_path, 'Results dump')):
     os.makedirs(os.path.join(folder_path, 'Results dump'))
+# Disk writes are handed to an output pipeline, so the SMU does not wait for them
+pipeline = OutputPipeline(maxsize=8)
+# Dark currents measured by EXP_LDR-LOW.py for the same device, voltage, NPLC and range (see DarkCurrent.py), with
+# its results saved to the same folder. This script never measures dark, so entries are only limited by their age.
+dark_cache = DarkCurrentCache(os.path.join(folder_path, "Dark_Current_Cache.json"), max_age=use_dark_cache[1],
+                              refresh_every=0)
 
-# Detect range function. It is vulnerable to float conversion errors, change to string handling for redundancy
-def detect_range(current):
-    allowed_ranges = [20e-12, 200e-12, 2e-9, 20e-9, 200e-9, 2e-6, 20e-6, 200e-6, 2e-3, 20e-3]
-    detected_range = None
-    for current_range in allowed_ranges:  # Loop through all ranges from lowest to highest
-        if np.abs(current) <= current_range:
-            detected_range = current_range
-            break  # stop when correct range found
-    if detected_range is None:
-        print("Could not detect current range.")
-    return detected_range
+# Sets up the live LDR plot of one loop. Each filter step only appends its points to it (see LivePlot.py).
+def create_ldr_plot():
+    fig, (ax1, ax2) = plt.subplots(2, 1)
+    live = LivePlot(fig, min_interval=0.5)
+    live.add_series("dark", ax1, yerr=False, label='Dark Current')
+    live.add_series("light", ax1, yerr=True, label='Light Current')
+    live.add_series("photo", ax2, yerr=False)
+    # Set log-log or log-linear scale
+    ax1.set_xscale('log')
+    ax2.set_xscale('log')
+    ax2.set_yscale('log')
+    ax1.grid(True)
+    ax2.grid(True)
+    ax1.legend()
+    plt.show(block=False)
+    return fig, live
 # *******************************************************************
 
 # Device initialization and abbreviating (giving shorthand alias to) instrument-names for ease of command-writing
@@ -118,44 +159,86 @@ tlPM.setWavelength(OPM_wl)
 print("Wavelength on OPM set to:", wl, "nm")
 tlPM.setPowerUnit(c_int16(0))
 print("Unit of optical power set to: Watt (W).")
+if timing:
+    instrument(SMU, WH, FM, LB, tlPM)  # see Timing.py
+# Mains frequency on SMU and OPM (see LineFrequency.py). Sampling periods become whole numbers of line periods.
+mains = LineFrequency()
+if line_sync[0]:
+    mains.setup(SMU, tlPM, line_sync[1])
+    sampling_time = mains.sync_period(sampling_time)
+    mains.check_nplc(measurement_speed)
+# Noise vs NPLC per range, measured once and kept in Aperture_Table.json of the results folder (see Aperture.py)
+apertures = ApertureOptimizer(os.path.join(folder_path, "Aperture_Table.json"), line_frequency=mains.frequency)
+# With 'hdf5', the raw traces of the run go into one HDF5 file, one dataset per filter position (see RunStore.py)
+run_store = None
+if raw_data_format == 'hdf5':
+    run_store = RunStore(os.path.join(folder_path, f"Raw data {device_name} LDR-High {voltage}V {measurement_speed} "
+                                                   f"{N_pts}pts {sampling_time}s.h5"),
+                         device=device_name, wavelength_nm=wl, voltage_V=voltage, NPLC=measurement_speed,
+                         sampling_time_s=sampling_time, points=N_pts)
+# Completed steps, optical references and SMU range are saved after every filter step (see Checkpoint.py)
+checkpoint = None
+if resume_run[0]:
+    checkpoint_name = f"Checkpoint {device_name} LDR-High {voltage}V {measurement_speed} {N_pts}pts " \
+                      f"{sampling_time}s.json"
+    checkpoint = RunCheckpoint(os.path.join(folder_path, checkpoint_name),
+                               settings=dict(device=device_name, wavelength_nm=wl, voltage_V=voltage, i_d_A=i_d,
+                                             NPLC=measurement_speed, N_pts=N_pts, sampling_time_s=sampling_time,
+                                             number_of_measurements=number_of_measurements),
+                               max_age=resume_run[1] * 3600)
+# Raw traces and step results of all loops, in arrays allocated once (see RunResults.py). The arrays grow if the
+# adaptive points make a trace longer than expected (with statistics_fetch, only steps with an anomaly have one).
+results = RunResults(number_of_measurements, int(np.count_nonzero(~np.isnan(np.array(calibration, dtype=float)))),
+                     0 if statistics_fetch[0] else acq_points + (adaptive_sampling[3] if adaptive_sampling[0] else 0))
+step_names = ["Dark_Current", "Dark_Error", "Output_Current", "Current_Error", "Photocurrent", "Photocurrent_Error"]
 # *******************************************************************
 
 
 # EXPERIMENTATIONS ARE NOW ON !!!
 
 for meas_num in range(number_of_measurements):
+    if checkpoint is not None and checkpoint.loop_done(meas_num):
+        print(f"Measurement loop number {meas_num+1} was completed before, skipping it.")
+        continue
+    references = checkpoint.references(meas_num) if checkpoint is not None else None
     # 1st step -- Initial steps to re-orient Motorized-wheel
     print("Blocking the light beam path to prevent DUT exposure to maximum optical power.")
     LB.move('block')  # block the light beam path, preventing DUT exposure to maximum optical power.
     WH.calibrate()  # ensures slot#1 on both wheels (No NDFs) in to the light beam path.
-    # 2nd step -- Record optical power in dark (OPM_dark)
-    print("Beam-splitter moved in to the light beam path.")
-    FM.move('on')  # move beam-splitter into the light beam path.
-    print('Initiating optical power measurement in dark condition.')
-    Optical_power_dark = []
-    OPM_dark = []  # optical power (in W) when light-beam blocked by blocker (LB).
-    for j in range(11):  # Measures optical power in dark, for number_of_points one-by-one
-        power = c_double()
-        tlPM.measPower(byref(power))
-        Optical_power_dark.append(power.value)
-        print("Dark measurement", j + 1, "/11:", Optical_power_dark[j], "W")
-        time.sleep(1) # makes the script wait 1 second before taking next record of the optical power.
-        OPM_dark = np.mean(Optical_power_dark[1:]) # Helps take average of the last 10 datapoints measured.
-    print("Average Optical Power in Dark condition:", OPM_dark, "W")
-    print("Technically, this is the offset within the OPM (powermeter).")
-    # 3rd step -- Record maximum optical power (laser_power)
-    print("Now, unblocking the light beam path to record optical power.")
-    LB.move('unblock')  # unblocks the light beam path.
-    power_meas_1 = [] # a list to store floating point numbers
-    ginti = 0 # Counter for measuring max. opticalpower. Average of 10 measurements is considered.
-    while ginti < 11: # to record optical power 11 times.
-        power_1 = c_double()
-        tlPM.measPower(byref(power_1))
-        power_meas_1.append(power_1.value)
-        print("Measurement", ginti + 1, "/11:", power_meas_1[ginti], "W")
-        ginti += 1
-        time.sleep(1) # hold time (in s) between two adjacent optical power measurements.
-    laser_power = np.mean(power_meas_1[1:]) - OPM_dark # Takes average of the last 10 datapoints measured.
+    # 2nd and 3rd step -- Record optical power in dark (OPM_dark) and maximum optical power (laser_power).
+    # A resumed loop uses the references it measured before.
+    if references is None:
+        # 2nd step -- Record optical power in dark (OPM_dark)
+        print("Beam-splitter moved in to the light beam path.")
+        FM.move('on')  # move beam-splitter into the light beam path.
+        print('Initiating optical power measurement in dark condition.')
+        Optical_power_dark = []
+        OPM_dark = []  # optical power (in W) when light-beam blocked by blocker (LB).
+        for j in range(11):  # Measures optical power in dark, for number_of_points one-by-one
+            power = c_double()
+            tlPM.measPower(byref(power))
+            Optical_power_dark.append(power.value)
+            print("Dark measurement", j + 1, "/11:", Optical_power_dark[j], "W")
+            time.sleep(1) # makes the script wait 1 second before taking next record of the optical power.
+            OPM_dark = np.mean(Optical_power_dark[1:]) # Helps take average of the last 10 datapoints measured.
+        print("Average Optical Power in Dark condition:", OPM_dark, "W")
+        print("Technically, this is the offset within the OPM (powermeter).")
+        # 3rd step -- Record maximum optical power (laser_power)
+        print("Now, unblocking the light beam path to record optical power.")
+        LB.move('unblock')  # unblocks the light beam path.
+        power_meas_1 = [] # a list to store floating point numbers
+        ginti = 0 # Counter for measuring max. opticalpower. Average of 10 measurements is considered.
+        while ginti < 11: # to record optical power 11 times.
+            power_1 = c_double()
+            tlPM.measPower(byref(power_1))
+            power_meas_1.append(power_1.value)
+            print("Measurement", ginti + 1, "/11:", power_meas_1[ginti], "W")
+            ginti += 1
+            time.sleep(1) # hold time (in s) between two adjacent optical power measurements.
+        laser_power = np.mean(power_meas_1[1:]) - OPM_dark # Takes average of the last 10 datapoints measured.
+    else:
+        OPM_dark, laser_power = references["OPM_dark"], references["laser_power"]
+        print("Resumed loop, average Optical Power in Dark condition:", OPM_dark, "W")
     print(f"Mean of max. optical power = {laser_power} W")
     calibration = np.array(calibration)  #
     Pinc = calibration[~np.isnan(calibration)]  # Remove 'nan' values. They are used to skip measurements
@@ -176,29 +259,31 @@ for meas_num in range(number_of_measurements):
     IRange = detect_range(1.03 * I_for_range)  # the multiplier is used to give some room to avoid overflow.
     SMU.set_current_range(IRange)  # sets detected current range.
     print(f"SMU condition. Current range set to: {IRange} A.")  # for troubleshooting.
-    SMU.trigger_settings(mtype="TIMer", count=N_pts, period=sampling_time) # set SMU condition for experiments.
+    SMU.trigger_settings(mtype="TIMer", count=acq_points, period=sampling_time) # set SMU condition for experiments.
     print(f"SMU condition. Sampling time set to:  {sampling_time} s.")  # for troubleshooting.
-    print(f"SMU condition. Total points per scan set to: {N_pts} pts. (Datapoints reqd.:  {N_pts} pts)")
+    print(f"SMU condition. Total points per scan set to: {acq_points} pts. (Datapoints reqd.:  {N_pts} pts)")
     SMU.measurement_speed(measurement_speed)
     print(f"SMU condition. NPLC set to: {measurement_speed}.")  # for troubleshooting.
-    need_range_change = False  # a bool, used to check whether range change is needed, so no to do it every time.
+    ranger = RangePredictor(IRange)  # predicts the range of each filter step from the previous one (AutoRange.py)
+    sampler = AdaptiveSampler(SMU, sampling_time, acq_points, target_precision=adaptive_sampling[1],
+                              chunk_points=acq_points, max_points=adaptive_sampling[3])
+    linearity = LinearityMonitor(tolerance=linearity_monitor[1], confirm=linearity_monitor[2])
+    step_nplc = measurement_speed  # NPLC set on the SMU, changed per step by the aperture optimiser
+    if checkpoint is not None and references is None:
+        checkpoint.set_references(meas_num, OPM_dark=OPM_dark, laser_power=laser_power, IRange=IRange)
     # *******************************************************************
 
-    # Some arrays to store results
-    Output_Current = []
-    Current_Error = []
-    Dark_Current = []
-    Dark_Error = []
-    Photocurrent = []
-    Photocurrent_Error = []
     LB.move('block')  # blocks the light beam path.
 
     # Create a figure and axis
-    fig, (ax1, ax2) = plt.subplots(2, 1)
+    fig, live = create_ldr_plot()
 
     # Loop over each position (see file)
     for i in range(len(filter_pos)):
         WH.move(move_pos[i])
+        if linearity_monitor[0] and linearity.stopped:  # past the knee: the wheel still makes the remaining moves
+            linearity.skipped_steps += int(not np.isnan(calibration[i]))
+            continue
         LB.move('unblock') # allowing the light beam to be incident on the DUT.
         print("Moving to: ", filter_pos[i], "for measurement loop number", meas_num+1)
         # In some cases, for the wheel to move to the required position, two moves are needed. To avoid measuring after
@@ -206,17 +291,100 @@ for meas_num in range(number_of_measurements):
         if np.isnan(calibration[i]):
             print("NaN detected - skipping measurement (normal procedure)")
             continue
-        if need_range_change:  # This is to prevent sending set range command every time
+        # Steps measured before a crash are taken from the checkpoint (the wheel still moves through them, its
+        # position depends on the moves before)
+        done = checkpoint.step(meas_num, i) if checkpoint is not None else None
+        if done is not None:
+            print("Measured before (checkpoint) - skipping measurement")
+            LB.move('block')
+            results.append(meas_num, Incident_Power=Pinc[results.count[meas_num]], Current_Range=done["current_range"],
+                           **{name: done[name] for name in step_names})
+            last = results.step(meas_num)
+            ranger.update(last["Incident_Power"], last["Output_Current"], last["Dark_Current"])
+            linearity.update(last["Incident_Power"], last["Photocurrent"], last["Photocurrent_Error"])
+            ranger.current_range = done["current_range"]
+            live.append("dark", last["Incident_Power"], last["Dark_Current"])
+            live.append("light", last["Incident_Power"], last["Output_Current"], last["Current_Error"])
+            live.append("photo", last["Incident_Power"], last["Photocurrent"])
+            continue
+        timeline.begin(f"step {filter_pos[i]}")
+        pinc = Pinc[results.count[meas_num]]  # incident power of this step
+        # The range for this step is predicted (previous photocurrent x ratio of incident powers) before acquiring,
+        # so it can go up ahead of an overflow, and down again if the light gets weaker.
+        next_range = ranger.predict(pinc)
+        if next_range != IRange:  # This is to prevent sending set range command every time
+            IRange = next_range
             SMU.set_current_range(IRange)
-            need_range_change = False
+        # NPLC and sampling period of this step (Aperture.py): the fastest that reaches the target SNR on this range,
+        # so bright steps are not integrated longer than needed
+        if aperture_optimizer[0]:
+            resend = apertures.table(device_name, voltage, IRange) is None
+            if resend:
+                apertures.characterise(SMU, device_name, voltage, IRange)  # under the light of this step
+                step_nplc = None  # NPLC and trigger settings are sent again
+            nplc, period = apertures.choose(device_name, voltage, IRange,
+                                            ranger.expected_photocurrent(pinc),
+                                            aperture_optimizer[1], acq_points,
+                                            line_period=mains.period if line_sync[0] else None)
+            if nplc is None:  # nothing to go by yet (first step): the settings of the data entry section
+                nplc, period = measurement_speed, sampling_time
+            if nplc != step_nplc:
+                SMU.measurement_speed(nplc)
+                step_nplc = nplc
+            if resend or period != sampler.sampling_time:
+                SMU.trigger_settings(mtype="TIMer", count=acq_points, period=period)
+                sampler.sampling_time = period
+        # Dark current of this step: cached value (with its uncertainty) if there is a recent one, else i_d
+        cached_dark = dark_cache.lookup(device_name, voltage, step_nplc, IRange) if use_dark_cache[0] else None
+        dark_mean, dark_std = (cached_dark["mean"], cached_dark["std"]) if cached_dark is not None else (i_d, 0)
+        # With statistics_fetch the SMU keeps the trace in its buffer and only sends its statistics. The trace is
+        # fetched after all if they show an overflow or an outlier, and then goes through the checks below.
+        if statistics_fetch[0]:
+            SMU.trace_buffer(acq_points)
         SMU.initiate('ACQuire', timeout=1000)
-        meas_curr = SMU.get_current()
-        ttime = SMU.get_time()  # double t to avoid confusing with other functions
+        stats = SMU.get_statistics() if statistics_fetch[0] else None
+        anomaly = statistics_anomaly(stats, statistics_fetch[1]) if stats is not None else None
+        if anomaly:
+            print(f"{anomaly.capitalize()} in the step statistics, fetching the raw trace")
+            stats = None
+        if stats is None:
+            meas_curr = SMU.get_current()
+            ttime = SMU.get_time()  # double t to avoid confusing with other functions
+        else:
+            meas_curr, ttime = [], []  # not fetched
+        # A glitch (range switch, spike) makes the plain and robust estimates disagree, only then the step is repeated.
+        retries = 0
+        while robust_estimator[0] and stats is None and retries < robust_estimator[2] and \
+                not is_overflow(meas_curr) and glitch_flags(meas_curr, [(0, None)], robust_estimator[1])[0]:
+            print("Glitch detected (plain and robust estimates disagree), repeating measurement")
+            retries += 1
+            SMU.initiate('ACQuire', timeout=1000)
+            meas_curr = SMU.get_current()
+            ttime = SMU.get_time()
+        glitch = robust_estimator[0] and stats is None and not is_overflow(meas_curr) and \
+            glitch_flags(meas_curr, [(0, None)], robust_estimator[1])[0]
+        if glitch:
+            print(f"Glitch still present after {retries} repeats, step is kept and flagged in the raw data.")
+        # Where the first points put this step: at the noise floor more points do not make it count for the LDR
+        # (photocurrent vs its std), near the knee (onset of saturation) they are worth twice the precision.
+        zone = 'linear'
+        if linearity_monitor[0] and not is_overflow(meas_curr):
+            first_mean, first_std = (stats["mean"], stats["std"]) if stats is not None else \
+                (np.mean(meas_curr), np.std(meas_curr))
+            zone = linearity.zone(pinc, first_mean - dark_mean, np.hypot(first_std, dark_std))
+        if adaptive_sampling[0] and not is_overflow(meas_curr) and zone != 'floor':  # light is still on: add points
+            target_precision = adaptive_sampling[1] / 2 if zone == 'knee' else None
+            if stats is not None:
+                stats = sampler.extend_statistics(stats, offset=dark_mean, target_precision=target_precision)
+            else:
+                extra_curr, extra_time = sampler.extend(meas_curr, offset=dark_mean, t_last=ttime[-1],
+                                                        target_precision=target_precision)
+                meas_curr, ttime = meas_curr + extra_curr, ttime + extra_time
         LB.move('block')  # blocks the light beam.
-        while np.any(np.isnan(meas_curr)) or any(x > 1 for x in meas_curr):
+        while is_overflow(meas_curr):
             print("Overflow detected, repeating measurement with higher range")
             LB.move('unblock')  # blocks the light beam.
-            IRange = IRange * 10
+            IRange = ranger.overflow()
             print(IRange)
             SMU.set_current_range(IRange)
             SMU.initiate('ACQuire', timeout=1000)
@@ -228,85 +396,95 @@ for meas_num in range(number_of_measurements):
         # issue because there is no charge extraction being done before the next measurement is executed.
         #LB.move('block')  # block the incident light path to keep DUT in dark.
         # LS.laser_output('OFF')
-        # For each of the values (dark, light, photo), the average and standard deviation is calculated
-        Output_Current.append(np.mean(meas_curr))  # Average to get the point
-        Current_Error.append(np.std(meas_curr))  # Standard deviation to get error
-        Dark_Current.append(i_d)
-        Dark_Error.append(i_d - i_d)
-        Photocurrent.append(Output_Current[-1] - i_d)
-        Photocurrent_Error.append(Current_Error)
+        # The trace goes into the run results, from here on meas_curr/ttime are views of it. For each of the values
+        # (dark, light, photo), the average and standard deviation is calculated.
+        results.append(meas_num, meas_curr, ttime, Incident_Power=pinc, Current_Range=IRange, Dark_Current=dark_mean,
+                       Dark_Error=dark_std)
+        meas_curr, ttime = results.trace(meas_num)
+        if stats is not None:  # statistics of the SMU, the trace is empty
+            light_mean, light_std = stats["mean"], stats["std"]
+            peak_current = max(abs(stats["min"]), abs(stats["max"]))
+        else:
+            light_mean, light_std = np.mean(meas_curr), np.std(meas_curr)  # average to get the point, std to get error
+            peak_current = np.max(np.abs(meas_curr))
+        results.update(meas_num, Output_Current=light_mean, Current_Error=light_std,
+                       Photocurrent=light_mean - dark_mean, Photocurrent_Error=np.sqrt(light_std ** 2 + dark_std ** 2))
+        last = results.step(meas_num)
 
-        # So this part in some cases will be problematic, because it does not change the current if going from high to low.
-        # This may be the case if your dark current is negative (<-20pA), and current goes to positive values
-        # during the measurement. This script is built on the assumption that photocurrent is always positive.
-        if IRange < detect_range(1.2*Output_Current[-1]):  # 1.2 is arbitrary, using previous average for comparison
-            IRange = detect_range(1.2*Output_Current[-1])
-            print("need range change")
-            need_range_change = True
+        # Feedback for the range prediction of the next step
+        ranger.update(pinc, light_mean, dark_mean, peak_current=peak_current)
+        if linearity_monitor[0]:  # refits photocurrent vs Pinc, decides whether the sweep goes on
+            linearity.update(pinc, last["Photocurrent"], last["Photocurrent_Error"])
         # *******************************************************************************
 
-        # Section to save file with raw data
-        # Naming convention can be changed according to ones needs
-        file_name = f"Results dump/Raw data {device_name} {Pinc[-1]}W LDR-High-{meas_num+1}" \
-                    f"{filter_pos[i]} {voltage}V {measurement_speed} {N_pts}pts {sampling_time}s.csv"
-        file_path = os.path.join(folder_path, file_name)
-        # Write data to the CSV file
-        with open(file_path, 'w', newline='') as file:
-            writer = csv.writer(file, delimiter='\t')
-            writer.writerow(["Time", "Current"])  # write header
-            for t, c, in zip(ttime, meas_curr):
-                writer.writerow([t, c])  # write data
+        # Section to save raw data. A step measured with statistics_fetch keeps its statistics instead of a trace.
+        if run_store is not None:
+            statistics = {} if stats is None else {f"light_{name}": value for name, value in stats.items()}
+            pipeline.submit(run_store.write_step, f"measurement{meas_num+1}/{filter_pos[i]}", ["Time", "Current"],
+                            ttime, meas_curr, Pinc=pinc, current_range=IRange,
+                            dark_window=(0, 0), illum_window=(0, acq_points), extra_start=acq_points,
+                            dark_mean=dark_mean, dark_std=dark_std, retries=retries, glitch=bool(glitch),
+                            nplc=step_nplc, sampling_time=sampler.sampling_time, **statistics)  # all illuminated
+            pipeline.submit(run_store.flush)
+        elif stats is None:
+            # Naming convention can be changed according to ones needs
+            file_name = f"Results dump/Raw data {device_name} {Pinc[-1]}W LDR-High-{meas_num+1}" \
+                        f"{filter_pos[i]} {voltage}V {measurement_speed} {N_pts}pts {sampling_time}s.csv"
+            file_path = os.path.join(folder_path, file_name)
+            # Write data to the CSV file
+            pipeline.submit(write_columns, file_path, ["Time", "Current"], ttime, meas_curr)
+        if checkpoint is not None:
+            checkpoint.save_step(meas_num, i, current_range=IRange,
+                                 **{name: last[name] for name in step_names})
         # *******************************************************************************
 
-        # Plot the data (updating plot)
-        # Clear the axes
-        ax1.cla()
-        ax2.cla()
-        # Plot the new line with error bars
-        ax1.errorbar(Pinc[:len(Dark_Current)], Dark_Current, label='Dark Current', fmt='o')
-        ax1.errorbar(Pinc[:len(Dark_Current)], Output_Current, yerr=Current_Error, label='Light Current', fmt='o')
-        ax2.errorbar(Pinc[:len(Dark_Current)], Photocurrent, fmt='o')
-        # Set log-log or log-linear scale
-        ax1.set_xscale('log')
-        ax2.set_xscale('log')
-        ax2.set_yscale('log')
-        ax1.grid(True)
-        ax2.grid(True)
-        # Auto-scale
-        ax1.relim()
-        ax1.autoscale_view()
-        ax1.legend()
-        ax2.relim()
-        ax2.autoscale_view()
-        # Redraw the figure
-        fig.canvas.draw()
-        fig.canvas.flush_events()
-        # Small pause to ensure plot updates
-        plt.pause(0.1)
+        # Plot the data (updating plot). The new points are appended, the figure is redrawn at most every 0.5 s.
+        live.append("dark", pinc, last["Dark_Current"])
+        live.append("light", pinc, last["Output_Current"], last["Current_Error"])
+        live.append("photo", pinc, last["Photocurrent"])
+        live.refresh()
+        timeline.end(f"step {filter_pos[i]}")
         # *******************************************************************************
 
+    # Step results of this loop (views into the run results)
+    loop = results.columns(meas_num)
     # Current vs intensity data
     file_name = f"LDR-High current output {device_name} {voltage}V measurement{meas_num+1}" \
                 f" {measurement_speed} {N_pts}pts {sampling_time}s.csv"
     file_path = os.path.join(folder_path, file_name)
     # Write data to the CSV file
-    with open(file_path, 'w', newline='') as file:
-        writer = csv.writer(file, delimiter='\t')
-        writer.writerow(["Incident_Power", "Dark_Current", "Dark_Error", "Current", "Current_Error"])  # write header
-        for p, d, der, i, er in zip(Pinc, Dark_Current, Dark_Error, Output_Current, Current_Error):
-            writer.writerow([p, d, der, i, er])  # write data
+    pipeline.submit(write_columns, file_path, ["Incident_Power", "Dark_Current", "Dark_Error", "Current",
+                    "Current_Error"], loop["Incident_Power"], loop["Dark_Current"], loop["Dark_Error"],
+                    loop["Output_Current"], loop["Current_Error"])
 
     # Photocurrent vs intensity data
     file_name = f"LDR-High photocurrent {device_name} {voltage}V measurement{meas_num+1}" \
                 f" {measurement_speed} {N_pts}pts {sampling_time}s.csv"
     file_path = os.path.join(folder_path, file_name)
     # Write data to the CSV file
-    with open(file_path, 'w', newline='') as file:
-        writer = csv.writer(file, delimiter='\t')
-        writer.writerow(["Incident_Power", "Photocurrent", "Photocurrent_Error"])  # write header
-        for p, ph, er in zip(Pinc, Photocurrent, Photocurrent_Error):
-            writer.writerow([p, ph, er])  # write data
+    pipeline.submit(write_columns, file_path, ["Incident_Power", "Photocurrent", "Photocurrent_Error"],
+                    loop["Incident_Power"], loop["Photocurrent"], loop["Photocurrent_Error"])
+    if run_store is not None:  # summary of the loop, next to its raw traces
+        pipeline.submit(run_store.write_step, f"measurement{meas_num+1}/summary", ["Incident_Power", "Dark_Current",
+                        "Dark_Error", "Current", "Current_Error", "Photocurrent", "Photocurrent_Error"],
+                        *[loop[name] for name in ["Incident_Power"] + step_names])
 
+    if checkpoint is not None:
+        checkpoint.finish_loop(meas_num)
+    ldr = linear_dynamic_range(loop["Incident_Power"], loop["Photocurrent"], loop["Photocurrent_Error"])
+    print(f"Linear dynamic range: {ldr['ldr_db']:.1f} dB (photocurrent {ldr['i_min']:.3g} to {ldr['i_max']:.3g} A, "
+          f"responsivity {ldr['responsivity']:.3g} A/W)")
+    ranger.report()
+    if linearity_monitor[0]:
+        linearity.report()
+    if use_dark_cache[0]:
+        dark_cache.report()
+    if aperture_optimizer[0]:
+        apertures.report()
+        apertures.save()
+    if adaptive_sampling[0]:
+        sampler.report()
+    live.refresh(force=True)  # make sure the last step is on the plot before it is saved
     if save_plots:
         file_path = os.path.join(folder_path, f"LDR-High {device_name} measurement{meas_num+1}"
                                               f"{voltage}V {measurement_speed} {N_pts}pts.png")
@@ -316,6 +494,22 @@ for meas_num in range(number_of_measurements):
         plt.pause(show_plots[1])
         plt.close()
 
+# Photocurrent vs intensity averaged over the measurement loops, with the spread between them
+if number_of_measurements > 1:
+    averages = [results.average(name) for name in ("Incident_Power", "Photocurrent")]
+    file_name = f"LDR-High photocurrent {device_name} {voltage}V mean of {number_of_measurements} measurements" \
+                f" {measurement_speed} {N_pts}pts {sampling_time}s.csv"
+    pipeline.submit(write_columns, os.path.join(folder_path, file_name), ["Incident_Power", "Photocurrent",
+                    "Photocurrent_Spread", "Loops"], averages[0][0], averages[1][0], averages[1][1], averages[1][2])
+if run_store is not None:
+    pipeline.submit(run_store.close)
+pipeline.close()  # waits until all queued data is on disk
+if checkpoint is not None:
+    checkpoint.finish()  # the run is complete, nothing to resume
+if timing:  # where the time went: per-operation latencies and the timeline of the whole run
+    timeline.report()
+    timeline.save(os.path.join(folder_path, f"Timeline {device_name} LDR-High {voltage}V {measurement_speed}.json"))
+
 # Disconnect with the instruments
 SMU.write_command(":SOURce:VOLTage:LEVel:IMMediate:AMPLitude 0")
 FM.disconnect()
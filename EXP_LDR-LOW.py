@@ -10,6 +10,8 @@ Suggestions:\n
 4. Install XiLab software package from Standa (WS) with its drivers to control motorized wheelset controller.\n
 5. Install Thorlabs optical powermeter related software with its drivers to control its display console.\n
 6. Similarly Keysight's software with drivers for controlling the SMU.\n
+7. Raw data is saved as one CSV per filter position by default. raw_data_format = 'hdf5' keeps all raw traces of a run\n
+    in one file instead, and needs the h5py package (pip install h5py).\n
 """
 
 from FlipMirror import FlipMirror
@@ -22,10 +24,22 @@ import numpy as np
 import matplotlib.pyplot as plt
 from ctypes import byref,create_string_buffer,c_bool,c_int16,c_double,c_voidp
 from TLPM import TLPM
-import math
 import time
 import os
-import csv
+from DataWriter import write_columns
+from RunStore import RunStore
+from OutputPipeline import OutputPipeline
+from LivePlot import LivePlot
+from AutoRange import RangePredictor, detect_range, is_overflow
+from AdaptiveSampling import AdaptiveSampler
+from DarkCurrent import DarkCurrentCache
+from Aperture import ApertureOptimizer
+from Checkpoint import RunCheckpoint
+from Linearity import LinearityMonitor
+from RunResults import RunResults
+from LineFrequency import LineFrequency
+from Timing import timeline, instrument
+from LDRAnalysis import ldr_windows, window_statistics, linear_dynamic_range, glitch_flags
 import threading
 
 ### USER TO SET/DEFINE VALUES HERE ###
@@ -37,6 +51,15 @@ voltage = 0.5 # applied voltage bias in V, where - or + is also dependent on the
 measurement_speed = 5  # denotes NPLC. Duration of 1NPLC = 1/national-powergrid-AC-frequency-in-Hz.
 save_plots = True  # "true" for plots to be saved as .png files.
 show_plots = [True, 10]  # "true" for plots to be shown after each measurement. Second number shows duration in s.
+raw_data_format = 'csv'  # 'csv': one file per filter position. 'hdf5': all raw traces of a run in one file (h5py).
+adaptive_sampling = [False, 0.005, 8, 256]  # [on/off, target relative SEM of photocurrent, min & max illuminated pts]
+use_dark_cache = [False, 1800, 8]  # [on/off, max. age (in s) of a cached dark current, re-measure every N steps]
+aperture_optimizer = [False, 200]  # [on/off, target SNR of a step (photocurrent/SEM, 200 = adaptive_sampling 0.5 %)]
+linearity_monitor = [False, 0.1, 2]  # [on/off, allowed deviation from the linear fit, steps past a knee to stop]
+robust_estimator = [False, 'sigma_clip', 2]  # [on/off, 'sigma_clip'/'median'/'hampel', max. re-acquisitions of a step]
+line_sync = [False, 0]  # [on/off, mains frequency in Hz (50 or 60), 0: found from the mains pickup of the DUT]
+resume_run = [False, 12]  # [on/off, max. age in h] a crashed run with the same settings continues where it stopped.
+timing = False  # "true": every instrument call is timed, saved as a Chrome trace and summed up per operation.
 #######################################
 N_d_prior = 6  # Number of measured points to be ignored prior to dark current signal recording.
 N_d_after = 6  # Number of measured points to be ignored after the dark current signal recording.
@@ -53,7 +76,9 @@ N_dark = N_d_prior + datapoints + N_d_after
 # cut_end_pts_dark = ((cut_end_time_dark) / (sampling_time)) + 1
 # cut_start_pts_illum = ((cut_start_time_illum) / (sampling_time)) + 1
 # cut_end_pts_illum = ((cut_end_time_illum) / (sampling_time)) + 1
-N_illum = N_i_prior + datapoints + N_i_after
+# With adaptive sampling the illuminated window starts at the minimum and is extended until it is precise enough.
+illum_points = adaptive_sampling[2] if adaptive_sampling[0] else datapoints
+N_illum = N_i_prior + illum_points + N_i_after
 total_points = N_dark + N_illum # This is set into SMU setting in line 178, along with sampling_time.
 # *******************************************************************
 
@@ -105,19 +130,47 @@ tlPM.setWavelength(OPM_wl)
 print("Wavelength on OPM set to:", wl, "nm")
 tlPM.setPowerUnit(c_int16(0))
 print("Unit of optical power set to: Watt (W).")
+if timing:
+    instrument(SMU, WH, FM, LB, tlPM)  # see Timing.py
+# Mains frequency on SMU and OPM (see LineFrequency.py). Sampling periods become whole numbers of line periods.
+mains = LineFrequency()
+if line_sync[0]:
+    mains.setup(SMU, tlPM, line_sync[1])
+    sampling_time = mains.sync_period(sampling_time)
+    mains.check_nplc(measurement_speed)
 # *******************************************************************
 
-# Detect range function. It is vulnerable to float conversion errors, change to string handling for redundancy
-def detect_range(current):
-    allowed_ranges = [20e-12, 200e-12, 2e-9, 20e-9, 200e-9, 2e-6, 20e-6, 200e-6, 2e-3, 20e-3]
-    detected_range = None
-    for current_range in allowed_ranges:  # Loop through all ranges from lowest to highest
-        if np.abs(current) <= current_range:
-            detected_range = current_range
-            break  # stop when correct range found
-    if detected_range is None:
-        print("Could not detect current range.")
-    return detected_range
+# Acquires one step. With a measured dark window the shutter opens after N_dark points (threading timer), without
+# it (dark current taken from the cache) the shutter opens right away and the trace holds only the illuminated part.
+def acquire_step(with_dark):
+    if with_dark:
+        timer = threading.Timer(sampler.sampling_time * (N_dark), lambda: LB.move('unblock'))
+        timer.start()  # Threading timer has to be defined and stopped every time it is used
+    else:
+        LB.move('unblock')
+    SMU.initiate('ACQuire', timeout=1000)
+    meas_curr = SMU.get_current()
+    ttime = SMU.get_time()  # double t to avoid confusing with other functions
+    if with_dark:
+        timer.cancel()
+    return meas_curr, ttime
+
+# Sets up the live LDR plot of one loop. Each filter step only appends its points to it (see LivePlot.py).
+def create_ldr_plot():
+    fig, (ax1, ax2) = plt.subplots(2, 1)
+    live = LivePlot(fig, min_interval=0.5)
+    live.add_series("dark", ax1, yerr=True, label='Dark Current')
+    live.add_series("light", ax1, yerr=True, label='Light Current')
+    live.add_series("photo", ax2, yerr=True)
+    # Set log-log or log-linear scale
+    ax1.set_xscale('log')
+    ax2.set_xscale('log')
+    ax2.set_yscale('log')
+    ax1.grid(True)
+    ax2.grid(True)
+    ax1.legend()
+    plt.show(block=False)
+    return fig, live
 # *******************************************************************
 
 # Selecting a folder to save the results
@@ -131,31 +184,70 @@ if not folder_path:
 # Create folder for results if it doesn't already exist
 if not os.path.exists(os.path.join(folder_path, 'Results dump')):
     os.makedirs(os.path.join(folder_path, 'Results dump'))
+# Disk writes are handed to an output pipeline, so the SMU does not wait for them
+pipeline = OutputPipeline(maxsize=8)
+# Dark currents per device, voltage, NPLC and range are kept across steps and runs (see DarkCurrent.py), in the
+# results folder: runs saved elsewhere (other devices) do not share them
+dark_cache = DarkCurrentCache(os.path.join(folder_path, "Dark_Current_Cache.json"), max_age=use_dark_cache[1],
+                              refresh_every=use_dark_cache[2])
+# Noise vs NPLC per range, measured once and kept in Aperture_Table.json of the results folder (see Aperture.py)
+apertures = ApertureOptimizer(os.path.join(folder_path, "Aperture_Table.json"), line_frequency=mains.frequency)
+# With 'hdf5', the raw traces of the run go into one HDF5 file, one dataset per filter position (see RunStore.py)
+run_store = None
+if raw_data_format == 'hdf5':
+    run_store = RunStore(os.path.join(folder_path, f"Raw data {device_name} LDR-Low {voltage}V {measurement_speed} "
+                                                   f"{total_points}pts {sampling_time}s.h5"),
+                         device=device_name, wavelength_nm=wl, voltage_V=voltage, NPLC=measurement_speed,
+                         sampling_time_s=sampling_time, points=total_points)
+# Completed steps, optical references and SMU range are saved after every filter step (see Checkpoint.py)
+checkpoint = None
+if resume_run[0]:
+    checkpoint_name = f"Checkpoint {device_name} LDR-Low {voltage}V {measurement_speed} {total_points}pts " \
+                      f"{sampling_time}s.json"
+    checkpoint = RunCheckpoint(os.path.join(folder_path, checkpoint_name),
+                               settings=dict(device=device_name, wavelength_nm=wl, voltage_V=voltage,
+                                             NPLC=measurement_speed, datapoints=datapoints,
+                                             sampling_time_s=sampling_time, total_points=total_points,
+                                             number_of_measurements=number_of_measurements),
+                               max_age=resume_run[1] * 3600)
+# Raw traces and step results of all loops, in arrays allocated once (see RunResults.py). The arrays grow if the
+# adaptive points make a trace longer than expected.
+results = RunResults(number_of_measurements, int(np.count_nonzero(~np.isnan(np.array(calibration, dtype=float)))),
+                     total_points + (adaptive_sampling[3] if adaptive_sampling[0] else 0))
+step_names = ["Dark_Current", "Dark_Error", "Output_Current", "Current_Error", "Photocurrent", "Photocurrent_Error"]
 # *******************************************************************
 
 
 # EXPERIMENTATIONS ARE NOW ON !!!
 
 for meas_num in range(number_of_measurements):
+    if checkpoint is not None and checkpoint.loop_done(meas_num):
+        print(f"Measurement loop number {meas_num+1} was completed before, skipping it.")
+        continue
+    references = checkpoint.references(meas_num) if checkpoint is not None else None
     # 1st step -- Re-orienting the motorized wheetset to 1-1 position
     print("Blocking the light beam path, preventing unrequired exposure of DUT to maximum optical power.")
     LB.move('block') # block the light beam path, preventing DUT exposure to maximum optical power.
     WH.calibrate() # ensures slot#1 on both wheels (No NDFs) in to the light beam path.
-    # 2nd step -- Record optical power in dark (OPM_dark)
-    print("Beam-splitter moved in to the light beam path.")
-    FM.move('on')  # move beam-splitter into the light beam path.
-    print('Initiating optical power measurement in dark condition.')
-    Optical_power_dark = []
-    OPM_dark = []  # optical power (in W) when light-beam blocked by blocker (LB).
-    for j in range(11):  # Measures optical power in dark, for number_of_points one-by-one
-        power = c_double()
-        tlPM.measPower(byref(power))
-        Optical_power_dark.append(power.value)
-        print("Dark measurement", j + 1, "/11:", Optical_power_dark[j], "W")
-        time.sleep(1) # makes the script wait 1 second before taking next record of the optical power.
-        OPM_dark = np.mean(Optical_power_dark[1:]) # Helps take average of the last 10 datapoints measured.
-    print("Average Optical Power in Dark condition:", OPM_dark, "W")
-    print("Technically, this is the offset within the OPM (powermeter).")
+    # 2nd step -- Record optical power in dark (OPM_dark). A resumed loop uses the references it measured before.
+    if references is None:
+        print("Beam-splitter moved in to the light beam path.")
+        FM.move('on')  # move beam-splitter into the light beam path.
+        print('Initiating optical power measurement in dark condition.')
+        Optical_power_dark = []
+        OPM_dark = []  # optical power (in W) when light-beam blocked by blocker (LB).
+        for j in range(11):  # Measures optical power in dark, for number_of_points one-by-one
+            power = c_double()
+            tlPM.measPower(byref(power))
+            Optical_power_dark.append(power.value)
+            print("Dark measurement", j + 1, "/11:", Optical_power_dark[j], "W")
+            time.sleep(1) # makes the script wait 1 second before taking next record of the optical power.
+            OPM_dark = np.mean(Optical_power_dark[1:]) # Helps take average of the last 10 datapoints measured.
+        print("Average Optical Power in Dark condition:", OPM_dark, "W")
+        print("Technically, this is the offset within the OPM (powermeter).")
+    else:
+        OPM_dark = references["OPM_dark"]
+        print("Resumed loop, average Optical Power in Dark condition:", OPM_dark, "W")
     # 3rd step -- Measure initial current from DUT in dark -- only to assess lowest current range
     FM.move('off')  # move beam-splitter out of the light beam path.
     SMU.trigger_settings(mtype="AINT", count=30, period=None)  # initial current measurement -- won't be recorded.
@@ -176,21 +268,28 @@ for meas_num in range(number_of_measurements):
     print(f"SMU condition. Total points per scan set to: {total_points} pts. (Datapoints reqd.:  {datapoints} pts)")
     SMU.measurement_speed(measurement_speed) # SETS NPLC VALUE ON SMU
     print(f"SMU condition. NPLC set to: {measurement_speed}.")
-    need_range_change = False  # a bool, used to check whether range change is needed, so no to do it every time.
+    ranger = RangePredictor(IRange)  # predicts the range of each filter step from the previous one (AutoRange.py)
+    sampler = AdaptiveSampler(SMU, sampling_time, total_points, target_precision=adaptive_sampling[1],
+                              chunk_points=illum_points, max_points=adaptive_sampling[3])
+    linearity = LinearityMonitor(tolerance=linearity_monitor[1], confirm=linearity_monitor[2])
+    step_nplc = measurement_speed  # NPLC set on the SMU, changed per step by the aperture optimiser
     # 4th step -- Record maximum optical power (laser_power)
-    print("Unblocking the light beam path to record optical power.")
-    LB.move('unblock')  # unblocks the light beam path.
-    FM.move('on')  # move beam-splitter into the light beam path, for optical power measurement.
-    power_meas_1 = [] # a list to store floating point numbers
-    ginti = 0 # Counter for measuring opticalpower. Average of 10 measurements is considered.
-    while ginti < 11: # to record optical power 11 times.
-        power_1 = c_double()
-        tlPM.measPower(byref(power_1))
-        power_meas_1.append(power_1.value)
-        print("Measurement", ginti + 1, "/11:", power_meas_1[ginti], "W")
-        ginti += 1
-        time.sleep(1) # hold time (in s) between two adjacent optical power measurements.
-    laser_power = np.mean(power_meas_1[1:]) - OPM_dark # Takes average of the last 10 datapoints measured.
+    if references is None:
+        print("Unblocking the light beam path to record optical power.")
+        LB.move('unblock')  # unblocks the light beam path.
+        FM.move('on')  # move beam-splitter into the light beam path, for optical power measurement.
+        power_meas_1 = [] # a list to store floating point numbers
+        ginti = 0 # Counter for measuring opticalpower. Average of 10 measurements is considered.
+        while ginti < 11: # to record optical power 11 times.
+            power_1 = c_double()
+            tlPM.measPower(byref(power_1))
+            power_meas_1.append(power_1.value)
+            print("Measurement", ginti + 1, "/11:", power_meas_1[ginti], "W")
+            ginti += 1
+            time.sleep(1) # hold time (in s) between two adjacent optical power measurements.
+        laser_power = np.mean(power_meas_1[1:]) - OPM_dark # Takes average of the last 10 datapoints measured.
+    else:
+        laser_power = references["laser_power"]
     print(f"Mean of max. optical power = {laser_power} W")
     calibration = np.array(calibration)  #
     Pinc = calibration[~np.isnan(calibration)]  # Remove 'nan' values. They are used to skip measurements
@@ -198,134 +297,209 @@ for meas_num in range(number_of_measurements):
     print("Blocking the light beam path.")
     LB.move('block') # block the incident light path to keep DUT in dark.
     FM.move('off')  # move beam-splitter out of the light beam path.
-
-    # Some arrays to store results
-    Output_Current = []
-    Current_Error = []
-    Dark_Current = []
-    Dark_Error = []
-    Photocurrent = []
-    Photocurrent_Error = []
+    if checkpoint is not None and references is None:
+        checkpoint.set_references(meas_num, OPM_dark=OPM_dark, laser_power=laser_power, IRange=IRange)
 
     # Create a figure and axis for concurrent display
-    fig, (ax1, ax2) = plt.subplots(2, 1)
+    fig, live = create_ldr_plot()
 
     # 5th step -- Loop over each position (see file) of the Motorized Wheelset
     for i in range(len(filter_pos)):
         WH.move(move_pos[i])
+        if linearity_monitor[0] and linearity.stopped:  # past the knee: the wheel still makes the remaining moves
+            linearity.skipped_steps += int(not np.isnan(calibration[i]))
+            continue
         print("Moving to: ", filter_pos[i], "for measurement loop number", meas_num+1)
         # In some cases, for the wheel to reach required position, two moves are needed. To avoid measuring after the
         # first of such moves, NaN is used in transmittance column. When script finds this, it skips the measurement.
         if np.isnan(calibration[i]):
             print("NaN detected - skipping measurement (normal procedure)")
             continue
-        if need_range_change:  # This is to prevent sending set range command every time
+        # Steps measured before a crash are taken from the checkpoint (the wheel still moves through them, its
+        # position depends on the moves before)
+        done = checkpoint.step(meas_num, i) if checkpoint is not None else None
+        if done is not None:
+            print("Measured before (checkpoint) - skipping measurement")
+            results.append(meas_num, Incident_Power=Pinc[results.count[meas_num]], Current_Range=done["current_range"],
+                           **{name: done[name] for name in step_names})
+            last = results.step(meas_num)
+            ranger.update(last["Incident_Power"], last["Output_Current"], last["Dark_Current"])
+            linearity.update(last["Incident_Power"], last["Photocurrent"], last["Photocurrent_Error"])
+            ranger.current_range = done["current_range"]
+            live.append("dark", last["Incident_Power"], last["Dark_Current"], last["Dark_Error"])
+            live.append("light", last["Incident_Power"], last["Output_Current"], last["Current_Error"])
+            live.append("photo", last["Incident_Power"], last["Photocurrent"], last["Photocurrent_Error"])
+            continue
+        timeline.begin(f"step {filter_pos[i]}")
+        pinc = Pinc[results.count[meas_num]]  # incident power of this step
+        # The range for this step is predicted (previous photocurrent x ratio of incident powers) before acquiring,
+        # so it can go up ahead of an overflow, and down again if the light gets weaker.
+        next_range = ranger.predict(pinc)
+        if next_range != IRange:  # This is to prevent sending set range command every time
+            IRange = next_range
             SMU.set_current_range(IRange)
-            need_range_change = False
         # A single measurement is split into two parts, half of it is in dark, half under illumination.
         # Threading is used to allow two commands run concurrently. It helps in controlling the conditions of
-        # dark current measurement while also ensuring timely shutter-movement for measurement under illumination. 
-        timer = threading.Timer(sampling_time * (N_dark), lambda: LB.move('unblock'))
-        timer.start()
-        # print("measurement started")
-        SMU.initiate('ACQuire', timeout=1000)
-        # print("measurement ended")
-        meas_curr = SMU.get_current()
-        ttime = SMU.get_time()  # double t to avoid confusing with other functions
-        timer.cancel()  # Threading timer has to be defined and stopped every time it is used
+        # dark current measurement while also ensuring timely shutter-movement for measurement under illumination.
+        # NPLC and sampling period of this step (Aperture.py): longer than measurement_speed/sampling_time where
+        # they do not reach the target SNR on this range. Never shorter: the windows have to cover the shutter moves.
+        if aperture_optimizer[0]:
+            if apertures.table(device_name, voltage, IRange) is None:
+                apertures.characterise(SMU, device_name, voltage, IRange)  # the light is blocked here
+                step_nplc, sampler.base_points = None, None  # NPLC and trigger settings are sent again
+            nplc, period = apertures.choose(device_name, voltage, IRange,
+                                            ranger.expected_photocurrent(pinc),
+                                            aperture_optimizer[1], illum_points, min_period=sampling_time,
+                                            min_nplc=measurement_speed,
+                                            line_period=mains.period if line_sync[0] else None)
+            if nplc is None:  # nothing to go by yet (first step): the settings of the data entry section
+                nplc, period = measurement_speed, sampling_time
+            if nplc != step_nplc:
+                SMU.measurement_speed(nplc)
+                step_nplc = nplc
+            if period != sampler.sampling_time:
+                sampler.sampling_time, sampler.base_points = period, None
+        # If a recent dark current for this device/voltage/NPLC/range is cached, the dark half is skipped.
+        cached_dark = dark_cache.lookup(device_name, voltage, step_nplc, IRange) if use_dark_cache[0] else None
+        with_dark = cached_dark is None
+        step_points = total_points if with_dark else N_illum
+        if step_points != sampler.base_points:  # trigger count is only sent when it changes
+            SMU.trigger_settings(mtype="TIMer", count=step_points, period=sampler.sampling_time)
+            sampler.base_points = step_points
+        # Sample ranges of the dark and illuminated window in this trace (see LDRAnalysis.py)
+        dark_window, illum_window = ldr_windows(N_d_prior, datapoints, N_d_after, N_i_prior, illum_points, with_dark)
+        meas_curr, ttime = acquire_step(with_dark)
+        # A glitch (range switch, spike) makes the plain and robust estimates of a window disagree. Only such steps
+        # are acquired again, an overflowed trace is left to the overflow check below.
+        windows = [dark_window, illum_window] if with_dark else [illum_window]
+        retries = 0
+        while robust_estimator[0] and retries < robust_estimator[2] and not is_overflow(meas_curr) and \
+                glitch_flags(meas_curr, windows, robust_estimator[1])[0]:
+            print("Glitch detected (plain and robust estimates disagree), repeating measurement")
+            retries += 1
+            LB.move('block')  # shutter was opened for the previous try, the dark window has to be dark again
+            meas_curr, ttime = acquire_step(with_dark)
+        glitch = robust_estimator[0] and not is_overflow(meas_curr) and glitch_flags(meas_curr, windows,
+                                                                                       robust_estimator[1])[0]
+        if glitch:
+            print(f"Glitch still present after {retries} repeats, step is kept and flagged in the raw data.")
 
         # Checks for overflow, if found, increases the range by 1 order and remeasures. This works best, when
         # the photocurrent measured by SMU under reverse bias is positive magnitude. So, connnect accordingly.
-        while np.any(np.isnan(meas_curr)) or any(x > 1 for x in meas_curr):
+        while is_overflow(meas_curr):
             print("Overflow detected, repeating measurement with higher range")
-            IRange = IRange * 10
+            IRange = ranger.overflow()
             print(IRange)
             SMU.set_current_range(IRange)
-            timer = threading.Timer(sampling_time * (N_dark), lambda: LB.move('unblock') )
-            timer.start()
-            SMU.initiate('ACQuire', timeout=1000)
-            meas_curr = SMU.get_current()
-            ttime = SMU.get_time()
-            timer.cancel()
+            LB.move('block')  # shutter was opened for the previous try, the dark window has to be dark again
+            meas_curr, ttime = acquire_step(with_dark)
+        if with_dark:
+            dark = window_statistics(meas_curr, dark_window)
+            dark_mean, dark_std = dark["mean"][0], dark["std"][0]
+        else:
+            dark_mean, dark_std = cached_dark["mean"], cached_dark["std"]
+        extra_curr, extra_time = [], []
+        # Where the first illuminated points put this step: at the noise floor more points do not make it count
+        # for the LDR (photocurrent vs its std), near the knee they are worth twice the precision.
+        zone = 'linear'
+        if linearity_monitor[0]:
+            first = window_statistics(meas_curr, illum_window)
+            zone = linearity.zone(pinc, first["mean"][0] - dark_mean, np.hypot(first["std"][0], dark_std))
+        if adaptive_sampling[0] and zone != 'floor':  # light is still on: extend the illuminated window
+            target_precision = adaptive_sampling[1] / 2 if zone == 'knee' else None
+            extra_curr, extra_time = sampler.extend(meas_curr[illum_window[0]:illum_window[1]], offset=dark_mean,
+                                                    t_last=ttime[-1], target_precision=target_precision)
         LB.move('block')  # blocks the incident light path to keep DUT in dark.
-        
+
         # Calculations
-        # Mean dark current is "Dark_Current" here.
-        Dark_Current.append(np.mean(meas_curr[int(math.ceil(N_d_prior)):int(math.ceil(N_d_prior + datapoints))])))
-        Dark_Error.append((np.std(meas_curr[int(math.ceil(N_d_prior)):int(math.ceil(N_d_prior + datapoints))])))
-        # Mean of measured current under illumination is "Output_Current" here.
-        Output_Current.append(np.mean(meas_curr[int(math.ceil(N_dark + N_i_prior)):int(
-            math.ceil(N_dark + N_i_prior + datapoints))])))
-        Current_Error.append(np.std(meas_curr[int(math.ceil(N_dark + N_i_prior)):int(
-            math.ceil(N_dark + N_i_prior + datapoints))])))
-        # Mean photocurrent is "Photocurrent" here
-        Photocurrent.append(Output_Current[-1] - Dark_Current[-1])
-        Photocurrent_Error.append(np.sqrt((np.square(Current_Error[-1])) + (np.square(Dark_Error[-1]))))
-        if IRange < detect_range(1.2*Output_Current[-1]):  # 1.2 is arbitrary, using previous average for comparison
-            IRange = detect_range(1.2*Output_Current[-1])
-            print("need range change")
-            need_range_change = True
+        if with_dark and use_dark_cache[0]:
+            dark_cache.store(device_name, voltage, step_nplc, IRange,
+                             meas_curr[dark_window[0]:dark_window[1]])
+        # The trace goes into the run results (adaptive points after it), from here on meas_curr/ttime are views of it.
+        # Mean dark current is "Dark_Current" here. A cached value comes with the uncertainty it was measured with.
+        results.append(meas_num, meas_curr + extra_curr, ttime + extra_time, Incident_Power=pinc, Current_Range=IRange,
+                       Dark_Current=dark_mean, Dark_Error=dark_std)
+        meas_curr, ttime = results.trace(meas_num)
+        # Mean of measured current under illumination is "Output_Current" here, mean photocurrent is "Photocurrent"
+        light = window_statistics(meas_curr, [illum_window, (step_points, None)])
+        results.update(meas_num, Output_Current=light["mean"][0], Current_Error=light["std"][0],
+                       Photocurrent=light["mean"][0] - dark_mean,
+                       Photocurrent_Error=np.hypot(light["std"][0], dark_std))
+        last = results.step(meas_num)
+        # Feedback for the range prediction of the next step
+        ranger.update(pinc, last["Output_Current"], last["Dark_Current"], peak_current=np.max(np.abs(meas_curr)))
+        if linearity_monitor[0]:  # refits photocurrent vs Pinc, decides whether the sweep goes on
+            linearity.update(pinc, last["Photocurrent"], last["Photocurrent_Error"])
         # *******************************************************************************
 
-        # Section to save file with raw data
-        file_name = f"Results dump/Raw data {device_name} {Pinc[-1]}W low_intensity measurement{meas_num+1}" \
-                    f"{filter_pos[i]} {voltage}V {measurement_speed} {total_points}pts {sampling_time}s.csv"
-        file_path = os.path.join(folder_path, file_name)
-        # Write data to the CSV file
-        with open(file_path, 'w', newline='') as file:
-            writer = csv.writer(file, delimiter='\t')
-            writer.writerow(["Time", "Current"])  # write header
-            for t, c, in zip(ttime, meas_curr):
-                writer.writerow([t, c])  # write data
+        # Section to save raw data
+        if run_store is not None:
+            pipeline.submit(run_store.write_step, f"measurement{meas_num+1}/{filter_pos[i]}", ["Time", "Current"],
+                            ttime, meas_curr, Pinc=pinc, current_range=IRange,
+                            dark_source='measured' if with_dark else 'cache', dark_window=dark_window,
+                            illum_window=illum_window, extra_start=step_points, dark_mean=dark_mean,
+                            dark_std=dark_std, retries=retries, glitch=bool(glitch), nplc=step_nplc,
+                            sampling_time=sampler.sampling_time)
+            pipeline.submit(run_store.flush)
+        else:
+            file_name = f"Results dump/Raw data {device_name} {Pinc[-1]}W low_intensity measurement{meas_num+1}" \
+                        f"{filter_pos[i]} {voltage}V {measurement_speed} {total_points}pts {sampling_time}s.csv"
+            file_path = os.path.join(folder_path, file_name)
+            # Write data to the CSV file
+            pipeline.submit(write_columns, file_path, ["Time", "Current"], ttime, meas_curr)
+        if checkpoint is not None:
+            checkpoint.save_step(meas_num, i, current_range=IRange,
+                                 **{name: last[name] for name in step_names})
         # *******************************************************************************
 
-        # Plot the data (updating plot)
-        # Clear the axes
-        ax1.cla()
-        ax2.cla()
-        # Plot the new line with error bars
-        ax1.errorbar(Pinc[:len(Dark_Current)], Dark_Current, yerr=Dark_Error, label='Dark Current', fmt='o')
-        ax1.errorbar(Pinc[:len(Dark_Current)], Output_Current, yerr=Current_Error, label='Light Current', fmt='o')
-        ax2.errorbar(Pinc[:len(Dark_Current)], Photocurrent, yerr=Photocurrent_Error, fmt='o')
-        # Set log-log or log-linear scale
-        ax1.set_xscale('log')
-        ax2.set_xscale('log')
-        ax2.set_yscale('log')
-        ax1.grid(True)
-        ax2.grid(True)
-        # Auto-scale
-        ax1.relim()
-        ax1.autoscale_view()
-        ax1.legend()
-        ax2.relim()
-        ax2.autoscale_view()
-        fig.canvas.draw() # Redraw the figure
-        fig.canvas.flush_events()
-        plt.pause(0.1) # Small pause to ensure plot updates
+        # Plot the data (updating plot). The new points are appended, the figure is redrawn at most every 0.5 s.
+        live.append("dark", pinc, last["Dark_Current"], last["Dark_Error"])
+        live.append("light", pinc, last["Output_Current"], last["Current_Error"])
+        live.append("photo", pinc, last["Photocurrent"], last["Photocurrent_Error"])
+        live.refresh()
+        timeline.end(f"step {filter_pos[i]}")
         # *******************************************************************************
 
+    # Step results of this loop (views into the run results)
+    loop = results.columns(meas_num)
     # Measured current vs optical power data
     file_name = f"Low intensity current output {device_name} {voltage}V measurement{meas_num+1}" \
                 f" {measurement_speed} {total_points}pts {sampling_time}s.csv"
     file_path = os.path.join(folder_path, file_name)
     # Write data to the CSV file
-    with open(file_path, 'w', newline='') as file:
-        writer = csv.writer(file, delimiter='\t')
-        writer.writerow(["Incident_Power", "Dark_Current", "Dark_Error", "Current", "Current_Error"])  # write header
-        for p, d, der, i, er in zip(Pinc, Dark_Current, Dark_Error, Output_Current, Current_Error):
-            writer.writerow([p, d, der, i, er])  # write data
+    pipeline.submit(write_columns, file_path, ["Incident_Power", "Dark_Current", "Dark_Error", "Current",
+                    "Current_Error"], loop["Incident_Power"], loop["Dark_Current"], loop["Dark_Error"],
+                    loop["Output_Current"], loop["Current_Error"])
 
     # Photocurrent vs optical power data
     file_name = f"Low intensity photocurrent {device_name} {voltage}V measurement{meas_num+1}" \
                 f" {measurement_speed} {total_points}pts {sampling_time}s.csv"
     file_path = os.path.join(folder_path, file_name)
     # Write data to the CSV file
-    with open(file_path, 'w', newline='') as file:
-        writer = csv.writer(file, delimiter='\t')
-        writer.writerow(["Incident_Power", "Photocurrent", "Photocurrent_Error"])  # write header
-        for p, ph, er in zip(Pinc, Photocurrent, Photocurrent_Error):
-            writer.writerow([p, ph, er])  # write data
+    pipeline.submit(write_columns, file_path, ["Incident_Power", "Photocurrent", "Photocurrent_Error"],
+                    loop["Incident_Power"], loop["Photocurrent"], loop["Photocurrent_Error"])
+    if run_store is not None:  # summary of the loop, next to its raw traces
+        pipeline.submit(run_store.write_step, f"measurement{meas_num+1}/summary", ["Incident_Power", "Dark_Current",
+                        "Dark_Error", "Current", "Current_Error", "Photocurrent", "Photocurrent_Error"],
+                        *[loop[name] for name in ["Incident_Power"] + step_names])
 
+    if checkpoint is not None:
+        checkpoint.finish_loop(meas_num)
+    ldr = linear_dynamic_range(loop["Incident_Power"], loop["Photocurrent"], loop["Photocurrent_Error"])
+    print(f"Linear dynamic range: {ldr['ldr_db']:.1f} dB (photocurrent {ldr['i_min']:.3g} to {ldr['i_max']:.3g} A, "
+          f"responsivity {ldr['responsivity']:.3g} A/W)")
+    ranger.report()
+    if linearity_monitor[0]:
+        linearity.report()
+    if use_dark_cache[0]:
+        dark_cache.report()
+        dark_cache.save()
+    if aperture_optimizer[0]:
+        apertures.report()
+        apertures.save()
+    if adaptive_sampling[0]:
+        sampler.report()
+    live.refresh(force=True)  # make sure the last step is on the plot before it is saved
     if save_plots:
         file_path = os.path.join(folder_path, f"Low intensity measurement {device_name} measurement{meas_num+1}"
                                               f"{voltage}V {measurement_speed} {total_points}pts.png")
@@ -335,6 +509,22 @@ for meas_num in range(number_of_measurements):
         plt.pause(show_plots[1])
         plt.close()
 
+# Photocurrent vs optical power averaged over the measurement loops, with the spread between them
+if number_of_measurements > 1:
+    averages = [results.average(name) for name in ("Incident_Power", "Photocurrent")]
+    file_name = f"Low intensity photocurrent {device_name} {voltage}V mean of {number_of_measurements} measurements" \
+                f" {measurement_speed} {total_points}pts {sampling_time}s.csv"
+    pipeline.submit(write_columns, os.path.join(folder_path, file_name), ["Incident_Power", "Photocurrent",
+                    "Photocurrent_Spread", "Loops"], averages[0][0], averages[1][0], averages[1][1], averages[1][2])
+if run_store is not None:
+    pipeline.submit(run_store.close)
+pipeline.close()  # waits until all queued data is on disk
+if checkpoint is not None:
+    checkpoint.finish()  # the run is complete, nothing to resume
+if timing:  # where the time went: per-operation latencies and the timeline of the whole run
+    timeline.report()
+    timeline.save(os.path.join(folder_path, f"Timeline {device_name} LDR-Low {voltage}V {measurement_speed}.json"))
+
 # Disconnect with the instruments
 SMU.write_command(":SOURce:VOLTage:LEVel:IMMediate:AMPLitude 0")
 FM.disconnect()
@@ -0,0 +1,398 @@
+"""
+By: Siddhartha Saggar and Giedrius Puidokas\n
+Aim: Record photocurrent as function of incident optical power (CW mode) at several voltage biases in one session.\n
+Each filter position is reached once. The SMU then runs a list sweep over all biases, first in dark and then under\n
+illumination, so wheel moves, OPM references and range discovery are shared by all biases.\n
+==================\n
+Suggestions:\n
+1. This script depends on libraries: SMU.py, LightBlock.py, Flipmirror.py, TLPM.py, and Wheels.py.\n
+2. Also dependent on Wheel_Calibration.txt for NDF transmittance values corresponding to defined wavelength.\n
+3. Same procedure as EXP_LDR-LOW.py for a single bias. Adaptive sampling is not used here: its extra points\n
+would be sourced at one bias only.\n
+4. Install XiLab software package from Standa (WS) with its drivers to control motorized wheelset controller.\n
+5. Install Thorlabs optical powermeter related software with its drivers to control its display console.\n
+6. Similarly Keysight's software with drivers for controlling the SMU.\n
+7. Raw data is saved as one CSV per filter position by default. raw_data_format = 'hdf5' keeps all raw traces of a run\n
+    in one file instead, and needs the h5py package (pip install h5py).\n
+"""
+
+from FlipMirror import FlipMirror
+from SMU import SMUDevice
+from Wheels import Filters
+from LightBlock import LightBlock
+import tkinter as tk
+from tkinter import filedialog
+import numpy as np
+import matplotlib.pyplot as plt
+from ctypes import byref,create_string_buffer,c_bool,c_int16,c_double,c_voidp
+from TLPM import TLPM
+import time
+import os
+from DataWriter import write_columns
+from RunStore import RunStore
+from OutputPipeline import OutputPipeline
+from LivePlot import LivePlot
+from AutoRange import RangePredictor, detect_range, is_overflow
+from DarkCurrent import DarkCurrentCache
+import threading
+
+### USER TO SET/DEFINE VALUES HERE ###
+device_name = 'devicename'  # Filename of saved rawdata includes this name. Ensure keeping the name in ' '.
+wl = 532  # wl=wavelength in nm, with 3 significant digits & no decimals. Script assumes monochromatic light source.
+datapoints = 32  # Number of points to be recorded per bias (dark and illuminated each), as a function of time.
+sampling_time = 0.1  # Time period (in s) between any two adjacent datapoints recorded.
+voltages = [0.5, 1.0, 2.0]  # applied voltage biases in V, measured in this order at every filter position.
+measurement_speed = 5  # denotes NPLC. Duration of 1NPLC = 1/national-powergrid-AC-frequency-in-Hz.
+save_plots = True  # "true" for plots to be saved as .png files.
+show_plots = [True, 10]  # "true" for plots to be shown after each measurement. Second number shows duration in s.
+raw_data_format = 'csv'  # 'csv': one file per filter position. 'hdf5': all raw traces of a run in one file (h5py).
+use_dark_cache = [False, 1800, 8]  # [on/off, max. age (in s) of a cached dark current, re-measure every N steps]
+#######################################
+N_d_prior = 6  # Number of measured points to be ignored after a bias change, prior to dark current recording.
+N_d_after = 6  # Number of measured points to be ignored after the dark current signal recording.
+N_i_prior = 6  # Number of measured points to be ignored after a bias change, prior to illuminated recording.
+N_i_after = 6  # Number of measured points to be ignored after the current signal under illumination recording.
+number_of_measurements = 1  # in number of loops. Repeats the whole experiment again and saves all data uniquely.
+###### END OF DATA ENTRY SECTION ######
+
+start_time = time.time()  # Only to keep a check on how long time the script takes to be executed.
+
+# Points per bias in dark and under illumination. The list sweep of a step is: all biases in dark, then all biases
+# under illumination (the shutter moves only once per step).
+N_dark = N_d_prior + datapoints + N_d_after
+N_illum = N_i_prior + datapoints + N_i_after
+dark_list = [v for v in voltages for _ in range(N_dark)]
+illum_list = [v for v in voltages for _ in range(N_illum)]
+total_points = len(dark_list) + len(illum_list)
+if total_points > 2500:
+    print(f"{total_points} pts per step do not fit in one SMU list (max. 2500). Reduce datapoints or voltages.")
+    quit()
+# *******************************************************************
+
+# Importing calibration stuff (If trying to understand the code, check out the file)
+filter_pos = []
+move_pos = []
+calibration = []
+wavelength = str(wl) # defining "wavelength" as string, so searching in Wheel_Calibration.txt is possible.
+file_path = "Wheel_Calibration.txt"
+with open(file_path, 'r') as file:
+    next(file)  # Skip the header line
+    for line in file:
+        columns = line.strip().split()  # Split the line into columns
+        if len(columns) >= 3:  # Check if the line has enough columns
+            filter_pos.append(columns[0])
+            move_pos.append(int(columns[1]))
+            if wavelength.lower() == '532':
+                calibration.append(float(columns[2]))
+            elif wavelength.lower() == '407':
+                calibration.append(float(columns[3]))
+            elif wavelength.lower() == '639':
+                calibration.append(float(columns[4]))
+            else:
+                print("Problem with acquiring wheel calibration data. Check the file for data related to ", wl,"nm.")
+        else:
+            print("Problem with number of columns in calibration file (check whitespace rows)")
+# *******************************************************************
+
+# Device initialization and abbreviating (giving shorthand alias to) instrument-names for ease of command-writing
+SMU = SMUDevice()
+WH = Filters()
+FM = FlipMirror()
+LB = LightBlock()
+LB.connect() # initiating connection of the system to instruments/devices.
+print("Light blocker (LB) connected.")
+FM.connect()
+print("Motorized flipper (FM) beamsplitting filter connected.")
+SMU.connect()
+print("Keysight electrometer (SMU) connected.")
+SMU.write_command(f":SOURce:VOLTage:LEVel:IMMediate:AMPLitude {voltages[0]}")
+
+# Initialize optical powermeter connection
+tlPM = TLPM()
+resourceName = create_string_buffer(b'USB0::0x1313::0x8075::P5001149::INSTR') # specific address of Thorlabs PM400
+tlPM.open(resourceName, c_bool(True), c_bool(True))
+print("Optical powermeter (OPM) connected.")
+OPM_wl = c_double(wl)
+tlPM.setWavelength(OPM_wl)
+print("Wavelength on OPM set to:", wl, "nm")
+tlPM.setPowerUnit(c_int16(0))
+print("Unit of optical power set to: Watt (W).")
+# *******************************************************************
+
+# Uploads the list sweep of one step: with_dark=False (all dark currents cached) leaves out the dark part.
+def set_step_list(with_dark):
+    sweep = dark_list + illum_list if with_dark else illum_list
+    SMU.set_voltage_list(sweep)
+    SMU.trigger_settings(mtype="TIMer", count=len(sweep), period=sampling_time, layer="ALL")
+    return len(sweep)
+
+# Acquires one step. With the dark part the shutter opens after all dark points (threading timer), without it the
+# shutter opens right away.
+def acquire_step(with_dark):
+    if with_dark:
+        timer = threading.Timer(sampling_time * len(dark_list), lambda: LB.move('unblock'))
+        timer.start()  # Threading timer has to be defined and stopped every time it is used
+    else:
+        LB.move('unblock')
+    SMU.initiate('ALL', timeout=1000)
+    meas_curr = SMU.get_current()
+    ttime = SMU.get_time()  # double t to avoid confusing with other functions
+    vsource = SMU.get_source()
+    if with_dark:
+        timer.cancel()
+    return meas_curr, ttime, vsource
+
+# Sets up the live plot of one loop: current under illumination and photocurrent, one series per bias.
+def create_ldr_plot():
+    fig, (ax1, ax2) = plt.subplots(2, 1)
+    live = LivePlot(fig, min_interval=0.5)
+    for v in voltages:
+        live.add_series(f"light {v}", ax1, yerr=True, label=f'Light Current {v} V')
+        live.add_series(f"photo {v}", ax2, yerr=True, label=f'Photocurrent {v} V')
+    # Set log-log or log-linear scale
+    ax1.set_xscale('log')
+    ax2.set_xscale('log')
+    ax2.set_yscale('log')
+    ax1.grid(True)
+    ax2.grid(True)
+    ax1.legend()
+    plt.show(block=False)
+    return fig, live
+# *******************************************************************
+
+# Selecting a folder to save the results
+root = tk.Tk()
+root.withdraw()
+folder_path = filedialog.askdirectory()
+print("Selected folder path to save results to:", folder_path)
+if not folder_path:
+    print('File selection cancelled.')
+    quit()
+# Create folder for results if it doesn't already exist
+if not os.path.exists(os.path.join(folder_path, 'Results dump')):
+    os.makedirs(os.path.join(folder_path, 'Results dump'))
+bias_str = "_".join(f"{v}" for v in voltages) + "V"  # all biases in file names, e.g. 0.5_1.0_2.0V
+# Disk writes are handed to an output pipeline, so the SMU does not wait for them
+pipeline = OutputPipeline(maxsize=8)
+# Dark currents per device, voltage, NPLC and range are kept across steps and runs (see DarkCurrent.py), in the
+# results folder: runs saved elsewhere (other devices) do not share them
+dark_cache = DarkCurrentCache(os.path.join(folder_path, "Dark_Current_Cache.json"), max_age=use_dark_cache[1],
+                              refresh_every=use_dark_cache[2])
+# With 'hdf5', the raw traces of the run go into one HDF5 file, one dataset per filter position (see RunStore.py)
+run_store = None
+if raw_data_format == 'hdf5':
+    run_store = RunStore(os.path.join(folder_path, f"Raw data {device_name} LDR-MultiBias {bias_str} "
+                                                   f"{measurement_speed} {total_points}pts {sampling_time}s.h5"),
+                         device=device_name, wavelength_nm=wl, voltages_V=voltages, NPLC=measurement_speed,
+                         sampling_time_s=sampling_time, points=total_points)
+# *******************************************************************
+
+
+# EXPERIMENTATIONS ARE NOW ON !!!
+
+for meas_num in range(number_of_measurements):
+    # 1st step -- Re-orienting the motorized wheetset to 1-1 position
+    print("Blocking the light beam path, preventing unrequired exposure of DUT to maximum optical power.")
+    LB.move('block') # block the light beam path, preventing DUT exposure to maximum optical power.
+    WH.calibrate() # ensures slot#1 on both wheels (No NDFs) in to the light beam path.
+    # 2nd step -- Record optical power in dark (OPM_dark)
+    print("Beam-splitter moved in to the light beam path.")
+    FM.move('on')  # move beam-splitter into the light beam path.
+    print('Initiating optical power measurement in dark condition.')
+    Optical_power_dark = []
+    OPM_dark = []  # optical power (in W) when light-beam blocked by blocker (LB).
+    for j in range(11):  # Measures optical power in dark, for number_of_points one-by-one
+        power = c_double()
+        tlPM.measPower(byref(power))
+        Optical_power_dark.append(power.value)
+        print("Dark measurement", j + 1, "/11:", Optical_power_dark[j], "W")
+        time.sleep(1) # makes the script wait 1 second before taking next record of the optical power.
+        OPM_dark = np.mean(Optical_power_dark[1:]) # Helps take average of the last 10 datapoints measured.
+    print("Average Optical Power in Dark condition:", OPM_dark, "W")
+    print("Technically, this is the offset within the OPM (powermeter).")
+    # 3rd step -- Measure initial current from DUT in dark at the largest bias -- only to assess lowest current range
+    FM.move('off')  # move beam-splitter out of the light beam path.
+    SMU.write_command(":SOURce:VOLTage:MODE FIXed")
+    SMU.write_command(f":SOURce:VOLTage:LEVel:IMMediate:AMPLitude {max(voltages, key=abs)}")
+    SMU.trigger_settings(mtype="AINT", count=30, period=None)  # initial current measurement -- won't be recorded.
+    time.sleep(0.3)  # acts like hold time in s.
+    SMU.measurement_speed("MED")
+    time.sleep(0.3)  # acts like hold time in s.
+    SMU.set_current_range("AUTO")
+    time.sleep(0.3)  # acts like hold time in s.
+    print("Dummy initiate to stabilize")
+    SMU.initiate('ACQuire', timeout=1000)  # helps in determining the current range.
+    I_for_range = SMU.get_current()[-1]  # takes the final point from the measurement (can be changed).
+    print(f"Range determination from: {I_for_range} A")  # for check during troubleshooting.
+    IRange = detect_range(1.03 * I_for_range)  # the multiplier is used to give some room to avoid overflow.
+    SMU.set_current_range(IRange)  # SETS CURRENT RANGE (INITIAL) ON THE SMU.
+    print(f"SMU condition. Current range set to: {IRange} A.")
+    step_points = set_step_list(True)  # SETS THE LIST SWEEP, N and del(t) ON SMU (source and measure triggers).
+    print(f"SMU condition. Sampling time set to:  {sampling_time} s.")
+    print(f"SMU condition. List sweep over {voltages} V, {total_points} pts per step.")
+    SMU.measurement_speed(measurement_speed) # SETS NPLC VALUE ON SMU
+    print(f"SMU condition. NPLC set to: {measurement_speed}.")
+    # One range is used for the whole list sweep, so it is predicted from the bias with the largest current
+    ranger = RangePredictor(IRange)
+    # 4th step -- Record maximum optical power (laser_power)
+    print("Unblocking the light beam path to record optical power.")
+    LB.move('unblock')  # unblocks the light beam path.
+    FM.move('on')  # move beam-splitter into the light beam path, for optical power measurement.
+    power_meas_1 = [] # a list to store floating point numbers
+    ginti = 0 # Counter for measuring opticalpower. Average of 10 measurements is considered.
+    while ginti < 11: # to record optical power 11 times.
+        power_1 = c_double()
+        tlPM.measPower(byref(power_1))
+        power_meas_1.append(power_1.value)
+        print("Measurement", ginti + 1, "/11:", power_meas_1[ginti], "W")
+        ginti += 1
+        time.sleep(1) # hold time (in s) between two adjacent optical power measurements.
+    laser_power = np.mean(power_meas_1[1:]) - OPM_dark # Takes average of the last 10 datapoints measured.
+    print(f"Mean of max. optical power = {laser_power} W")
+    calibration = np.array(calibration)  #
+    Pinc = calibration[~np.isnan(calibration)]  # Remove 'nan' values. They are used to skip measurements
+    Pinc = np.multiply(Pinc, laser_power)  # Multiplies calculated laser power by transmittance array
+    print("Blocking the light beam path.")
+    LB.move('block') # block the incident light path to keep DUT in dark.
+    FM.move('off')  # move beam-splitter out of the light beam path.
+
+    # Some arrays to store results, one set per bias
+    results = {v: {"Dark_Current": [], "Dark_Error": [], "Output_Current": [], "Current_Error": [],
+                   "Photocurrent": [], "Photocurrent_Error": []} for v in voltages}
+    n_done = 0  # filter steps measured so far (NaN rows are skipped)
+
+    # Create a figure and axis for concurrent display
+    fig, live = create_ldr_plot()
+
+    # 5th step -- Loop over each position (see file) of the Motorized Wheelset
+    for i in range(len(filter_pos)):
+        WH.move(move_pos[i])
+        print("Moving to: ", filter_pos[i], "for measurement loop number", meas_num+1)
+        # In some cases, for the wheel to reach required position, two moves are needed. To avoid measuring after the
+        # first of such moves, NaN is used in transmittance column. When script finds this, it skips the measurement.
+        if np.isnan(calibration[i]):
+            print("NaN detected - skipping measurement (normal procedure)")
+            continue
+        next_range = ranger.predict(Pinc[n_done])
+        if next_range != IRange:  # This is to prevent sending set range command every time
+            IRange = next_range
+            SMU.set_current_range(IRange)
+        # The dark part is only left out if the dark currents of all biases are cached
+        cached_dark = [dark_cache.lookup(device_name, v, measurement_speed, IRange) if use_dark_cache[0] else None
+                       for v in voltages]
+        with_dark = any(entry is None for entry in cached_dark)
+        sweep_points = len(dark_list) + len(illum_list) if with_dark else len(illum_list)
+        if sweep_points != step_points:  # list and trigger count are only sent when they change
+            step_points = set_step_list(with_dark)
+        meas_curr, ttime, vsource = acquire_step(with_dark)
+
+        # Checks for overflow, if found, increases the range by 1 order and remeasures.
+        while is_overflow(meas_curr):
+            print("Overflow detected, repeating measurement with higher range")
+            IRange = ranger.overflow()
+            print(IRange)
+            SMU.set_current_range(IRange)
+            LB.move('block')  # shutter was opened for the previous try
+            meas_curr, ttime, vsource = acquire_step(with_dark)
+        LB.move('block')  # blocks the incident light path to keep DUT in dark.
+
+        # Calculations, bias by bias. Dark blocks come first (if measured), then the illuminated blocks.
+        illum_offset = len(dark_list) if with_dark else 0
+        largest = None  # bias with the largest current, feeds the range prediction
+        for k, v in enumerate(voltages):
+            res = results[v]
+            if with_dark:
+                dark_window = meas_curr[k * N_dark + N_d_prior:k * N_dark + N_d_prior + datapoints]
+                res["Dark_Current"].append(np.mean(dark_window))
+                res["Dark_Error"].append(np.std(dark_window))
+                if use_dark_cache[0]:
+                    dark_cache.store(device_name, v, measurement_speed, IRange, dark_window)
+            else:
+                res["Dark_Current"].append(cached_dark[k]["mean"])
+                res["Dark_Error"].append(cached_dark[k]["std"])
+            start = illum_offset + k * N_illum + N_i_prior
+            illum_window = meas_curr[start:start + datapoints]
+            res["Output_Current"].append(np.mean(illum_window))
+            res["Current_Error"].append(np.std(illum_window))
+            res["Photocurrent"].append(res["Output_Current"][-1] - res["Dark_Current"][-1])
+            res["Photocurrent_Error"].append(np.sqrt(np.square(res["Current_Error"][-1]) +
+                                                     np.square(res["Dark_Error"][-1])))
+            if largest is None or abs(res["Output_Current"][-1]) > abs(results[largest]["Output_Current"][-1]):
+                largest = v
+        n_done += 1
+        # Feedback for the range prediction of the next step
+        ranger.update(Pinc[n_done-1], results[largest]["Output_Current"][-1], results[largest]["Dark_Current"][-1],
+                      peak_current=np.max(np.abs(meas_curr)))
+        # *******************************************************************************
+
+        # Section to save raw data (time, sourced voltage and current of the whole list sweep)
+        if run_store is not None:
+            pipeline.submit(run_store.write_step, f"measurement{meas_num+1}/{filter_pos[i]}",
+                            ["Time", "Voltage", "Current"], ttime, vsource, meas_curr, Pinc=Pinc[n_done-1],
+                            current_range=IRange, dark_source='measured' if with_dark else 'cache')
+            pipeline.submit(run_store.flush)
+        else:
+            file_name = f"Results dump/Raw data {device_name} {Pinc[n_done-1]}W multibias measurement{meas_num+1}" \
+                        f"{filter_pos[i]} {bias_str} {measurement_speed} {total_points}pts {sampling_time}s.csv"
+            file_path = os.path.join(folder_path, file_name)
+            pipeline.submit(write_columns, file_path, ["Time", "Voltage", "Current"], ttime, vsource, meas_curr)
+        # *******************************************************************************
+
+        # Plot the data (updating plot). The new points are appended, the figure is redrawn at most every 0.5 s.
+        for v in voltages:
+            live.append(f"light {v}", Pinc[n_done-1], results[v]["Output_Current"][-1],
+                        results[v]["Current_Error"][-1])
+            live.append(f"photo {v}", Pinc[n_done-1], results[v]["Photocurrent"][-1],
+                        results[v]["Photocurrent_Error"][-1])
+        live.refresh()
+        # *******************************************************************************
+
+    # Data of each bias are saved in the same files as EXP_LDR-LOW.py writes for a single bias
+    for v in voltages:
+        res = results[v]
+        file_name = f"Low intensity current output {device_name} {v}V measurement{meas_num+1}" \
+                    f" {measurement_speed} {total_points}pts {sampling_time}s.csv"
+        pipeline.submit(write_columns, os.path.join(folder_path, file_name), ["Incident_Power", "Dark_Current",
+                        "Dark_Error", "Current", "Current_Error"], Pinc[:n_done], res["Dark_Current"],
+                        res["Dark_Error"], res["Output_Current"], res["Current_Error"])
+        file_name = f"Low intensity photocurrent {device_name} {v}V measurement{meas_num+1}" \
+                    f" {measurement_speed} {total_points}pts {sampling_time}s.csv"
+        pipeline.submit(write_columns, os.path.join(folder_path, file_name), ["Incident_Power", "Photocurrent",
+                        "Photocurrent_Error"], Pinc[:n_done], res["Photocurrent"], res["Photocurrent_Error"])
+        if run_store is not None:  # summary of the loop, next to its raw traces
+            pipeline.submit(run_store.write_step, f"measurement{meas_num+1}/summary {v}V", ["Incident_Power",
+                            "Dark_Current", "Dark_Error", "Current", "Current_Error", "Photocurrent",
+                            "Photocurrent_Error"], Pinc[:n_done], res["Dark_Current"], res["Dark_Error"],
+                            res["Output_Current"], res["Current_Error"], res["Photocurrent"],
+                            res["Photocurrent_Error"], voltage_V=v)
+
+    ranger.report()
+    if use_dark_cache[0]:
+        dark_cache.report()
+        dark_cache.save()
+    live.refresh(force=True)  # make sure the last step is on the plot before it is saved
+    if save_plots:
+        file_path = os.path.join(folder_path, f"Low intensity multibias measurement {device_name} "
+                                              f"measurement{meas_num+1} {bias_str} {measurement_speed} "
+                                              f"{total_points}pts.png")
+        plt.savefig(file_path)
+    if show_plots[0]:
+        plt.show(block=False)
+        plt.pause(show_plots[1])
+        plt.close()
+
+if run_store is not None:
+    pipeline.submit(run_store.close)
+pipeline.close()  # waits until all queued data is on disk
+
+# Disconnect with the instruments
+SMU.write_command(":SOURce:VOLTage:MODE FIXed")
+SMU.write_command(":SOURce:VOLTage:LEVel:IMMediate:AMPLitude 0")
+FM.disconnect()
+SMU.disconnect()
+WH.disconnect()
+LB.move('block')
+LB.disconnect()
+
+duration = time.time() - start_time
+print("The script took ", duration, " seconds to run.")
@@ -0,0 +1,359 @@
+"""
+By: Siddhartha Saggar and Giedrius Puidokas\n
+Aim: Record photocurrent as function of incident optical power (CW mode) for several pixels/DUTs in one run.\n
+The pixels are connected to the SMU one by one through a multiplexer. At every filter position all pixels are\n
+measured in dark and then all under illumination, so each (slow) wheel move serves every pixel.\n
+==================\n
+Suggestions:\n
+1. This script depends on libraries: SMU.py, LightBlock.py, Flipmirror.py, TLPM.py, Wheels.py and Multiplexer.py.\n
+2. Also dependent on Wheel_Calibration.txt for NDF transmittance values corresponding to defined wavelength.\n
+3. Set switch = ['simulated'] to try the script without the switch hardware (all pixels then are the same DUT).\n
+4. Install XiLab software package from Standa (WS) with its drivers to control motorized wheelset controller.\n
+5. Install Thorlabs optical powermeter related software with its drivers to control its display console.\n
+6. Similarly Keysight's software with drivers for controlling the SMU.\n
+7. Raw data is saved as one CSV per filter position by default. raw_data_format = 'hdf5' keeps all raw traces of a run\n
+    in one file instead, and needs the h5py package (pip install h5py).\n
+"""
+
+from FlipMirror import FlipMirror
+from SMU import SMUDevice
+from Wheels import Filters
+from LightBlock import LightBlock
+import tkinter as tk
+from tkinter import filedialog
+import numpy as np
+import matplotlib.pyplot as plt
+from ctypes import byref,create_string_buffer,c_bool,c_int16,c_double,c_voidp
+from TLPM import TLPM
+import time
+import os
+from DataWriter import write_columns
+from RunStore import RunStore
+from OutputPipeline import OutputPipeline
+from LivePlot import LivePlot
+from AutoRange import RangePredictor, detect_range, is_overflow
+from Multiplexer import SimulatedSwitch, VisaSwitch, PixelScheduler
+
+### USER TO SET/DEFINE VALUES HERE ###
+device_name = 'devicename'  # Filename of saved rawdata includes this name. Ensure keeping the name in ' '.
+pixels = {'P1': 1, 'P2': 2, 'P3': 3, 'P4': 4}  # pixel name: switch channel. File names include the pixel name.
+switch = ['simulated']  # ['simulated'] for testing, or ['visa', 'VISA address of the switch matrix/multiplexer']
+wl = 532  # wl=wavelength in nm, with 3 significant digits & no decimals. Script assumes monochromatic light source.
+datapoints = 32  # Number of points to be recorded as a function of time. Should be 2 to the power of an integer.
+sampling_time = 0.1  # Time period (in s) between any two adjacent datapoints recorded.
+voltage = 0.5 # applied voltage bias in V, where - or + is also dependent on the connections made in the setup.
+measurement_speed = 5  # denotes NPLC. Duration of 1NPLC = 1/national-powergrid-AC-frequency-in-Hz.
+save_plots = True  # "true" for plots to be saved as .png files.
+show_plots = [True, 10]  # "true" for plots to be shown after each measurement. Second number shows duration in s.
+raw_data_format = 'csv'  # 'csv': one file per filter position. 'hdf5': all raw traces of a run in one file (h5py).
+#######################################
+N_prior = 6  # Number of measured points to be ignored after switching pixel or shutter, prior to recording.
+N_after = 6  # Number of measured points to be ignored after the recording.
+number_of_measurements = 1  # in number of loops. Repeats the whole experiment again and saves all data uniquely.
+###### END OF DATA ENTRY SECTION ######
+
+start_time = time.time()  # Only to keep a check on how long time the script takes to be executed.
+
+# Every pixel gets one trace in dark and one under illumination, of the same length
+total_points = N_prior + datapoints + N_after
+# *******************************************************************
+
+# Importing calibration stuff (If trying to understand the code, check out the file)
+filter_pos = []
+move_pos = []
+calibration = []
+wavelength = str(wl) # defining "wavelength" as string, so searching in Wheel_Calibration.txt is possible.
+file_path = "Wheel_Calibration.txt"
+with open(file_path, 'r') as file:
+    next(file)  # Skip the header line
+    for line in file:
+        columns = line.strip().split()  # Split the line into columns
+        if len(columns) >= 3:  # Check if the line has enough columns
+            filter_pos.append(columns[0])
+            move_pos.append(int(columns[1]))
+            if wavelength.lower() == '532':
+                calibration.append(float(columns[2]))
+            elif wavelength.lower() == '407':
+                calibration.append(float(columns[3]))
+            elif wavelength.lower() == '639':
+                calibration.append(float(columns[4]))
+            else:
+                print("Problem with acquiring wheel calibration data. Check the file for data related to ", wl,"nm.")
+        else:
+            print("Problem with number of columns in calibration file (check whitespace rows)")
+# *******************************************************************
+
+# Device initialization and abbreviating (giving shorthand alias to) instrument-names for ease of command-writing
+SMU = SMUDevice()
+WH = Filters()
+FM = FlipMirror()
+LB = LightBlock()
+if switch[0] == 'visa':
+    MUX = VisaSwitch(switch[1])
+else:
+    MUX = SimulatedSwitch(pixels.values())
+LB.connect() # initiating connection of the system to instruments/devices.
+print("Light blocker (LB) connected.")
+FM.connect()
+print("Motorized flipper (FM) beamsplitting filter connected.")
+SMU.connect()
+print("Keysight electrometer (SMU) connected.")
+MUX.connect()
+print("Multiplexer (MUX) connected.")
+SMU.write_command(f":SOURce:VOLTage:LEVel:IMMediate:AMPLitude {voltage}")
+scheduler = PixelScheduler(MUX, pixels)
+
+# Initialize optical powermeter connection
+tlPM = TLPM()
+resourceName = create_string_buffer(b'USB0::0x1313::0x8075::P5001149::INSTR') # specific address of Thorlabs PM400
+tlPM.open(resourceName, c_bool(True), c_bool(True))
+print("Optical powermeter (OPM) connected.")
+OPM_wl = c_double(wl)
+tlPM.setWavelength(OPM_wl)
+print("Wavelength on OPM set to:", wl, "nm")
+tlPM.setPowerUnit(c_int16(0))
+print("Unit of optical power set to: Watt (W).")
+# *******************************************************************
+
+smu_range = {"range": None}  # range set on the SMU now, so it is only sent when the next pixel needs another one
+
+def set_range(current_range):
+    if current_range != smu_range["range"]:
+        SMU.set_current_range(current_range)
+        smu_range["range"] = current_range
+
+# Current range of a pixel in dark, from a short auto-ranged measurement (not recorded)
+def find_range(pixel):
+    SMU.trigger_settings(mtype="AINT", count=30, period=None)
+    SMU.set_current_range("AUTO")
+    smu_range["range"] = "AUTO"
+    time.sleep(0.3)  # acts like hold time in s.
+    SMU.initiate('ACQuire', timeout=1000)
+    I_for_range = SMU.get_current()[-1]
+    print(f"{pixel}: range determination from: {I_for_range} A")
+    return detect_range(1.03 * I_for_range)
+
+# Acquires one trace of the connected pixel. With pinc given, its range is predicted for this filter step first.
+def acquire_pixel(pixel, pinc=None):
+    ranger = rangers[pixel]
+    set_range(ranger.predict(pinc) if pinc is not None else ranger.current_range)
+    SMU.initiate('ACQuire', timeout=1000)
+    meas_curr = SMU.get_current()
+    ttime = SMU.get_time()
+    while is_overflow(meas_curr):
+        print(f"Overflow detected on {pixel}, repeating measurement with higher range")
+        set_range(ranger.overflow())
+        SMU.initiate('ACQuire', timeout=1000)
+        meas_curr = SMU.get_current()
+        ttime = SMU.get_time()
+    return ttime, meas_curr
+
+# Sets up the live plot of one loop: current under illumination and photocurrent, one series per pixel.
+def create_ldr_plot():
+    fig, (ax1, ax2) = plt.subplots(2, 1)
+    live = LivePlot(fig, min_interval=0.5)
+    for pixel in pixels:
+        live.add_series(f"light {pixel}", ax1, yerr=True, label=f'Light Current {pixel}')
+        live.add_series(f"photo {pixel}", ax2, yerr=True, label=f'Photocurrent {pixel}')
+    # Set log-log or log-linear scale
+    ax1.set_xscale('log')
+    ax2.set_xscale('log')
+    ax2.set_yscale('log')
+    ax1.grid(True)
+    ax2.grid(True)
+    ax1.legend()
+    plt.show(block=False)
+    return fig, live
+# *******************************************************************
+
+# Selecting a folder to save the results
+root = tk.Tk()
+root.withdraw()
+folder_path = filedialog.askdirectory()
+print("Selected folder path to save results to:", folder_path)
+if not folder_path:
+    print('File selection cancelled.')
+    quit()
+# Create folder for results if it doesn't already exist
+if not os.path.exists(os.path.join(folder_path, 'Results dump')):
+    os.makedirs(os.path.join(folder_path, 'Results dump'))
+# Disk writes are handed to an output pipeline, so the SMU does not wait for them
+pipeline = OutputPipeline(maxsize=8)
+# With 'hdf5', the raw traces of the run go into one HDF5 file, one dataset per pixel, filter position and shutter state
+run_store = None
+if raw_data_format == 'hdf5':
+    run_store = RunStore(os.path.join(folder_path, f"Raw data {device_name} LDR-Pixels {voltage}V {measurement_speed} "
+                                                   f"{total_points}pts {sampling_time}s.h5"),
+                         device=device_name, pixels=list(pixels), wavelength_nm=wl, voltage_V=voltage,
+                         NPLC=measurement_speed, sampling_time_s=sampling_time, points=total_points)
+# *******************************************************************
+
+
+# EXPERIMENTATIONS ARE NOW ON !!!
+
+for meas_num in range(number_of_measurements):
+    # 1st step -- Re-orienting the motorized wheetset to 1-1 position
+    print("Blocking the light beam path, preventing unrequired exposure of DUT to maximum optical power.")
+    LB.move('block') # block the light beam path, preventing DUT exposure to maximum optical power.
+    WH.calibrate() # ensures slot#1 on both wheels (No NDFs) in to the light beam path.
+    # 2nd step -- Record optical power in dark (OPM_dark)
+    print("Beam-splitter moved in to the light beam path.")
+    FM.move('on')  # move beam-splitter into the light beam path.
+    print('Initiating optical power measurement in dark condition.')
+    Optical_power_dark = []
+    OPM_dark = []  # optical power (in W) when light-beam blocked by blocker (LB).
+    for j in range(11):  # Measures optical power in dark, for number_of_points one-by-one
+        power = c_double()
+        tlPM.measPower(byref(power))
+        Optical_power_dark.append(power.value)
+        print("Dark measurement", j + 1, "/11:", Optical_power_dark[j], "W")
+        time.sleep(1) # makes the script wait 1 second before taking next record of the optical power.
+        OPM_dark = np.mean(Optical_power_dark[1:]) # Helps take average of the last 10 datapoints measured.
+    print("Average Optical Power in Dark condition:", OPM_dark, "W")
+    print("Technically, this is the offset within the OPM (powermeter).")
+    # 3rd step -- Measure initial current of every pixel in dark -- only to assess lowest current range
+    FM.move('off')  # move beam-splitter out of the light beam path.
+    SMU.measurement_speed("MED")
+    time.sleep(0.3)  # acts like hold time in s.
+    print("Dummy initiate to stabilize")
+    rangers = {pixel: RangePredictor(pixel_range) for pixel, pixel_range in scheduler.measure_all(find_range).items()}
+    SMU.trigger_settings(mtype="TIMer", count=total_points, period=sampling_time)  # SETS N and del(t) ON SMU.
+    print(f"SMU condition. Sampling time set to:  {sampling_time} s.")
+    print(f"SMU condition. Total points per scan set to: {total_points} pts. (Datapoints reqd.:  {datapoints} pts)")
+    SMU.measurement_speed(measurement_speed) # SETS NPLC VALUE ON SMU
+    print(f"SMU condition. NPLC set to: {measurement_speed}.")
+    # 4th step -- Record maximum optical power (laser_power)
+    print("Unblocking the light beam path to record optical power.")
+    LB.move('unblock')  # unblocks the light beam path.
+    FM.move('on')  # move beam-splitter into the light beam path, for optical power measurement.
+    power_meas_1 = [] # a list to store floating point numbers
+    ginti = 0 # Counter for measuring opticalpower. Average of 10 measurements is considered.
+    while ginti < 11: # to record optical power 11 times.
+        power_1 = c_double()
+        tlPM.measPower(byref(power_1))
+        power_meas_1.append(power_1.value)
+        print("Measurement", ginti + 1, "/11:", power_meas_1[ginti], "W")
+        ginti += 1
+        time.sleep(1) # hold time (in s) between two adjacent optical power measurements.
+    laser_power = np.mean(power_meas_1[1:]) - OPM_dark # Takes average of the last 10 datapoints measured.
+    print(f"Mean of max. optical power = {laser_power} W")
+    calibration = np.array(calibration)  #
+    Pinc = calibration[~np.isnan(calibration)]  # Remove 'nan' values. They are used to skip measurements
+    Pinc = np.multiply(Pinc, laser_power)  # Multiplies calculated laser power by transmittance array
+    print("Blocking the light beam path.")
+    LB.move('block') # block the incident light path to keep DUT in dark.
+    FM.move('off')  # move beam-splitter out of the light beam path.
+
+    # Some arrays to store results, one set per pixel
+    results = {pixel: {"Dark_Current": [], "Dark_Error": [], "Output_Current": [], "Current_Error": [],
+                       "Photocurrent": [], "Photocurrent_Error": []} for pixel in pixels}
+    n_done = 0  # filter steps measured so far (NaN rows are skipped)
+
+    # Create a figure and axis for concurrent display
+    fig, live = create_ldr_plot()
+
+    # 5th step -- Loop over each position (see file) of the Motorized Wheelset
+    for i in range(len(filter_pos)):
+        WH.move(move_pos[i])
+        print("Moving to: ", filter_pos[i], "for measurement loop number", meas_num+1)
+        # In some cases, for the wheel to reach required position, two moves are needed. To avoid measuring after the
+        # first of such moves, NaN is used in transmittance column. When script finds this, it skips the measurement.
+        if np.isnan(calibration[i]):
+            print("NaN detected - skipping measurement (normal procedure)")
+            continue
+        # All pixels in dark (range of each predicted for this step), then all pixels under illumination
+        dark_traces = scheduler.measure_all(lambda pixel: acquire_pixel(pixel, Pinc[n_done]))
+        LB.move('unblock')  # allowing the light beam to be incident on the DUTs.
+        light_traces = scheduler.measure_all(acquire_pixel)
+        LB.move('block')  # blocks the incident light path to keep DUTs in dark.
+        n_done += 1
+
+        # Calculations, pixel by pixel
+        for pixel in light_traces:
+            if pixel not in dark_traces:
+                continue  # could not be connected in dark
+            res = results[pixel]
+            dark_window = dark_traces[pixel][1][N_prior:N_prior + datapoints]
+            illum_window = light_traces[pixel][1][N_prior:N_prior + datapoints]
+            res["Dark_Current"].append(np.mean(dark_window))
+            res["Dark_Error"].append(np.std(dark_window))
+            res["Output_Current"].append(np.mean(illum_window))
+            res["Current_Error"].append(np.std(illum_window))
+            res["Photocurrent"].append(res["Output_Current"][-1] - res["Dark_Current"][-1])
+            res["Photocurrent_Error"].append(np.sqrt(np.square(res["Current_Error"][-1]) +
+                                                     np.square(res["Dark_Error"][-1])))
+            # Feedback for the range prediction of the next step
+            rangers[pixel].update(Pinc[n_done-1], res["Output_Current"][-1], res["Dark_Current"][-1],
+                                  peak_current=max(np.max(np.abs(dark_traces[pixel][1])),
+                                                   np.max(np.abs(light_traces[pixel][1]))))
+
+            # Section to save raw data
+            for state, (ttime, meas_curr) in (("dark", dark_traces[pixel]), ("light", light_traces[pixel])):
+                if run_store is not None:
+                    pipeline.submit(run_store.write_step, f"measurement{meas_num+1}/{pixel}/{filter_pos[i]}/{state}",
+                                    ["Time", "Current"], ttime, meas_curr, Pinc=Pinc[n_done-1],
+                                    current_range=rangers[pixel].current_range)
+                else:
+                    file_name = f"Results dump/Raw data {device_name}-{pixel} {Pinc[n_done-1]}W {state} " \
+                                f"measurement{meas_num+1}{filter_pos[i]} {voltage}V {measurement_speed} " \
+                                f"{total_points}pts {sampling_time}s.csv"
+                    pipeline.submit(write_columns, os.path.join(folder_path, file_name), ["Time", "Current"],
+                                    ttime, meas_curr)
+
+            # Plot the data (updating plot)
+            live.append(f"light {pixel}", Pinc[n_done-1], res["Output_Current"][-1], res["Current_Error"][-1])
+            live.append(f"photo {pixel}", Pinc[n_done-1], res["Photocurrent"][-1], res["Photocurrent_Error"][-1])
+        if run_store is not None:
+            pipeline.submit(run_store.flush)
+        live.refresh()
+        # *******************************************************************************
+
+    # Data of each pixel are saved in the same files as EXP_LDR-LOW.py writes for a single device
+    for pixel in pixels:
+        res = results[pixel]
+        file_name = f"Low intensity current output {device_name}-{pixel} {voltage}V measurement{meas_num+1}" \
+                    f" {measurement_speed} {total_points}pts {sampling_time}s.csv"
+        pipeline.submit(write_columns, os.path.join(folder_path, file_name), ["Incident_Power", "Dark_Current",
+                        "Dark_Error", "Current", "Current_Error"], Pinc[:len(res["Output_Current"])],
+                        res["Dark_Current"], res["Dark_Error"], res["Output_Current"], res["Current_Error"])
+        file_name = f"Low intensity photocurrent {device_name}-{pixel} {voltage}V measurement{meas_num+1}" \
+                    f" {measurement_speed} {total_points}pts {sampling_time}s.csv"
+        pipeline.submit(write_columns, os.path.join(folder_path, file_name), ["Incident_Power", "Photocurrent",
+                        "Photocurrent_Error"], Pinc[:len(res["Output_Current"])], res["Photocurrent"],
+                        res["Photocurrent_Error"])
+        if run_store is not None:  # summary of the loop, next to its raw traces
+            pipeline.submit(run_store.write_step, f"measurement{meas_num+1}/{pixel}/summary", ["Incident_Power",
+                            "Dark_Current", "Dark_Error", "Current", "Current_Error", "Photocurrent",
+                            "Photocurrent_Error"], Pinc[:len(res["Output_Current"])], res["Dark_Current"],
+                            res["Dark_Error"], res["Output_Current"], res["Current_Error"], res["Photocurrent"],
+                            res["Photocurrent_Error"])
+        print(pixel, end=" ")
+        rangers[pixel].report()
+
+    scheduler.report()
+    live.refresh(force=True)  # make sure the last step is on the plot before it is saved
+    if save_plots:
+        file_path = os.path.join(folder_path, f"Low intensity pixels measurement {device_name} "
+                                              f"measurement{meas_num+1} {voltage}V {measurement_speed} "
+                                              f"{total_points}pts.png")
+        plt.savefig(file_path)
+    if show_plots[0]:
+        plt.show(block=False)
+        plt.pause(show_plots[1])
+        plt.close()
+
+if run_store is not None:
+    pipeline.submit(run_store.close)
+pipeline.close()  # waits until all queued data is on disk
+
+# Disconnect with the instruments
+SMU.write_command(":SOURce:VOLTage:LEVel:IMMediate:AMPLitude 0")
+MUX.disconnect()
+FM.disconnect()
+SMU.disconnect()
+WH.disconnect()
+LB.move('block')
+LB.disconnect()
+
+duration = time.time() - start_time
+print("The script took ", duration, " seconds to run.")
@@ -0,0 +1,143 @@
+########################################################
+##         Hysteresis metrics of double IV sweeps     ##
+##  Primary goal: compare the forward and the reverse ##
+##  half of a double (there and back) sweep, so the   ##
+##  dependence of an IV curve on the sweep rate can   ##
+##  be put in a few numbers. Also Voc, Isc, the       ##
+##  rectification ratio and ideality factor of each   ##
+##  half, for many sweeps in one summary table.       ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import numpy as np
+
+THERMAL_VOLTAGE_PER_K = 8.617333e-5  # kT/q per kelvin, in V/K
+
+
+# Area under y(x) (trapezoidal rule), signed by the direction of x
+def area(x, y):
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    return float(np.sum(0.5 * (y[1:] + y[:-1]) * np.diff(x)))
+
+
+# Splits a double sweep into its forward and reverse half. The reverse half is flipped, so both halves run over
+# the same voltages in the same order (a double staircase repeats the forward voltages backwards).
+def split_double_sweep(source, current):
+    source, current = np.asarray(source, dtype=float), np.asarray(current, dtype=float)
+    n = len(source) // 2
+    return (source[:n], current[:n]), (source[n:2 * n][::-1], current[n:2 * n][::-1])
+
+
+# Repeated sweeps, one after the other in the arrays, as (sweeps, branches, points) arrays of voltage and current.
+# Double sweeps have 2 branches, forward and reverse, the reverse one flipped as in split_double_sweep. Points left
+# over after the last whole sweep are not used.
+def split_sweeps(source, current, points, double=True):
+    source, current = np.asarray(source, dtype=float), np.asarray(current, dtype=float)
+    branches = 2 if double else 1
+    sweeps = len(source) // (branches * points)
+    if len(source) != sweeps * branches * points:
+        print(f"Warning: {len(source) - sweeps * branches * points} points after the last whole sweep not used.")
+    voltage = source[:sweeps * branches * points].reshape(sweeps, branches, points).copy()
+    current = current[:sweeps * branches * points].reshape(sweeps, branches, points).copy()
+    if double:
+        voltage[:, 1], current[:, 1] = voltage[:, 1, ::-1].copy(), current[:, 1, ::-1].copy()
+    return voltage, current
+
+
+# Metrics of one double sweep:
+#   area: area of the loop between forward and reverse current (in A*V)
+#   index: loop area relative to the area under |forward current| (0 = no hysteresis)
+#   max_difference, v_max_difference: largest |I_forward - I_reverse| and the voltage it is found at
+def hysteresis_metrics(source, current):
+    (v_fwd, i_fwd), (v_rev, i_rev) = split_double_sweep(source, current)
+    return branch_hysteresis(v_fwd, i_fwd, i_rev)
+
+
+# Metrics of hysteresis_metrics from the forward and the (flipped) reverse branch
+def branch_hysteresis(v_fwd, i_fwd, i_rev):
+    if len(v_fwd) < 2:
+        print("Not enough points for hysteresis metrics (double sweep needed).")
+        return {"area": np.nan, "index": np.nan, "max_difference": np.nan, "v_max_difference": np.nan}
+    difference = i_fwd - i_rev
+    loop_area = abs(area(v_fwd, difference))
+    reference = abs(area(v_fwd, np.abs(i_fwd)))
+    k = int(np.argmax(np.abs(difference)))
+    return {"area": loop_area, "index": loop_area / reference if reference > 0 else np.nan,
+            "max_difference": float(abs(difference[k])), "v_max_difference": float(v_fwd[k])}
+
+
+# IV parameters of one branch (any voltage order):
+#   voc: voltage of the zero crossing of the current closest to 0 V
+#   isc: current at 0 V
+#   rectification: |I(+v_rect)| / |I(-v_rect)|, by default at the largest voltage reached on both sides
+#   ideality, i0: diode equation I - Isc = i0 x (exp(V / (ideality x kT/q)) - 1) fitted to fit_points neighbouring
+#   points of the forward bias (the polarity with the larger current), where ln(I - Isc + i0) is steepest (series
+#   resistance flattens it at high currents), counting a slope only as far as its fit error allows, so noise does
+#   not make a window look steeper. Points below 3 kT/q are left out: the shunt current bends it there.
+# Values that the voltage range does not give are NaN.
+def iv_parameters(voltage, current, temperature=295, v_rect=None, fit_points=5, iterations=50):
+    order = np.argsort(voltage)
+    v, i = np.asarray(voltage, dtype=float)[order], np.asarray(current, dtype=float)[order]
+    isc = float(np.interp(0, v, i)) if v[0] <= 0 <= v[-1] else np.nan
+    crossing = np.nonzero(np.sign(i[:-1]) != np.sign(i[1:]))[0]
+    voc = np.nan
+    if crossing.size:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            zeros = v[crossing] - i[crossing] * (v[crossing + 1] - v[crossing]) / (i[crossing + 1] - i[crossing])
+        zeros = np.where(np.isfinite(zeros), zeros, v[crossing])
+        voc = float(zeros[np.argmin(np.abs(zeros))])
+    v_rect = min(v[-1], -v[0]) if v_rect is None else v_rect
+    rectification = np.nan
+    if v_rect > 0 and v[0] <= -v_rect and v[-1] >= v_rect:
+        i_positive, i_negative = np.interp([v_rect, -v_rect], v, i)
+        rectification = abs(i_positive) / abs(i_negative) if i_negative != 0 else np.nan
+    thermal_voltage = THERMAL_VOLTAGE_PER_K * temperature
+    forward = -1 if rectification < 1 else 1
+    shifted = forward * (i - (isc if np.isfinite(isc) else 0))
+    use = (forward * v > 3 * thermal_voltage) & (shifted > 0)
+    ideality, i0 = np.nan, np.nan
+    if np.count_nonzero(use) >= fit_points:
+        x = np.lib.stride_tricks.sliding_window_view(forward * v[use], fit_points)
+        dx = x - x.mean(axis=1, keepdims=True)
+        # I - Isc = I0 (exp(V / n kT/q) - 1): ln(I - Isc + I0) is a line in V. I0 is not known before the fit, so it
+        # starts at 0 (the -1 left out, which makes the low voltages too steep) and is refined with each fit.
+        offset = 0
+        for _ in range(iterations):
+            y = np.lib.stride_tricks.sliding_window_view(np.log(shifted[use] + offset), fit_points)
+            slopes = np.sum(dx * (y - y.mean(axis=1, keepdims=True)), axis=1) / np.sum(dx ** 2, axis=1)
+            residuals = y - y.mean(axis=1, keepdims=True) - slopes[:, None] * dx
+            slope_errors = np.sqrt(np.sum(residuals ** 2, axis=1) / (fit_points - 2) / np.sum(dx ** 2, axis=1))
+            k = int(np.argmax(slopes - 2 * slope_errors))
+            if not slopes[k] > 0:
+                ideality, i0 = np.nan, np.nan
+                break
+            ideality = float(1 / (slopes[k] * thermal_voltage))
+            i0 = float(np.exp(y[k].mean() - slopes[k] * x[k].mean()))
+            if np.isclose(i0, offset, rtol=1e-6, atol=0):
+                break
+            offset = i0
+    return {"voc": voc, "isc": isc, "rectification": float(rectification), "ideality": ideality, "i0": i0}
+
+
+# One table for repeated sweeps: a row per sweep with the hysteresis metrics (double sweeps only) and the IV
+# parameters of each branch. Returns {column name: array}, names as in the CSV files of the scripts.
+def sweep_summary(source, current, points, double=True, temperature=295, v_rect=None):
+    voltage, current = split_sweeps(source, current, points, double)
+    branches = ["Fwd", "Rev"] if double else ["Fwd"]
+    rows = []
+    for v, i in zip(voltage, current):
+        row = {}
+        if double:
+            metrics = branch_hysteresis(v[0], i[0], i[1])
+            row.update({"Hysteresis_Index": metrics["index"], "Loop_Area": metrics["area"],
+                        "Max_Difference": metrics["max_difference"], "V_Max_Difference": metrics["v_max_difference"]})
+        for branch, v_branch, i_branch in zip(branches, v, i):
+            parameters = iv_parameters(v_branch, i_branch, temperature, v_rect)
+            row.update({f"Voc_{branch}": parameters["voc"], f"Isc_{branch}": parameters["isc"],
+                        f"Rectification_{branch}": parameters["rectification"],
+                        f"Ideality_{branch}": parameters["ideality"], f"I0_{branch}": parameters["i0"]})
+        rows.append(row)
+    summary = {"Sweep": np.arange(1, len(rows) + 1)}
+    for name in (rows[0] if rows else {}):
+        summary[name] = np.array([row[name] for row in rows])
+    return summary
@@ -0,0 +1,390 @@
+########################################################
+##     Vectorised statistics of LDR current traces    ##
+##  Primary goal: dark/illuminated window statistics, ##
+##  photocurrent, errors, responsivity and LDR of all ##
+##  filter steps at once (steps x samples arrays), so ##
+##  archives of past runs are reprocessed quickly.    ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import os
+import re
+import warnings
+import numpy as np
+from DataWriter import write_columns
+from RunStore import load_run
+
+
+# Sample ranges [start, stop) of the dark and the illuminated window of one LDR acquisition (EXP_LDR-LOW.py layout:
+# dark prior | dark | dark after | illum prior | illum | illum after). Without a dark window (dark current from the
+# cache) the trace starts with the illuminated part and the dark window is empty.
+def ldr_windows(n_dark_prior, dark_points, n_dark_after, n_illum_prior, illum_points, with_dark=True):
+    if not with_dark:
+        return (0, 0), (n_illum_prior, n_illum_prior + illum_points)
+    n_dark = n_dark_prior + dark_points + n_dark_after
+    return (n_dark_prior, n_dark_prior + dark_points), (n_dark + n_illum_prior, n_dark + n_illum_prior + illum_points)
+
+
+# Boolean mask (steps x samples) of a window made of one or more segments (start, stop). start/stop are one value
+# for all steps or one per step, stop None means up to the end of the trace.
+def window_mask(shape, *segments):
+    steps, samples = shape
+    index = np.arange(samples)[None, :]
+    mask = np.zeros((steps, samples), dtype=bool)
+    for start, stop in segments:
+        start = np.broadcast_to(np.asarray(start), (steps,))[:, None]
+        stop = np.broadcast_to(np.asarray(samples if stop is None else stop), (steps,))[:, None]
+        mask |= (index >= start) & (index < stop)
+    return mask
+
+
+# Traces of different length (adaptive sampling, cached dark) as one steps x samples array, padded with NaN
+def stack_traces(traces):
+    traces = [np.asarray(trace, dtype=float) for trace in traces]
+    stacked = np.full((len(traces), max((len(trace) for trace in traces), default=0)), np.nan)
+    for k, trace in enumerate(traces):
+        stacked[k, :len(trace)] = trace
+    return stacked
+
+
+# Mean, std (as np.std, i.e. of the population, like the scripts always used), SEM and number of points of a window
+# in every step. traces: steps x samples (or one trace). window: a mask or one/several (start, stop) segments.
+# NaN samples (padding) are left out. Steps with an empty window get NaN.
+def window_statistics(traces, window):
+    traces = np.atleast_2d(np.asarray(traces, dtype=float))
+    if isinstance(window, np.ndarray) and window.dtype == bool:
+        mask = np.atleast_2d(window)
+    else:
+        mask = window_mask(traces.shape, *(window if isinstance(window, list) else [window]))
+    mask = mask & ~np.isnan(traces)
+    n = mask.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(mask, traces, 0).sum(axis=1) / n
+        squares = np.where(mask, traces - mean[:, None], 0) ** 2
+        std = np.sqrt(squares.sum(axis=1) / n)
+        sem = np.sqrt(squares.sum(axis=1) / (n - 1)) / np.sqrt(n)
+    return {"mean": mean, "std": std, "sem": sem, "n": n}
+
+
+# Window values of every step with everything outside the window (and padding) set to NaN
+def _window_values(traces, window):
+    traces = np.atleast_2d(np.asarray(traces, dtype=float))
+    if isinstance(window, np.ndarray) and window.dtype == bool:
+        mask = np.atleast_2d(window)
+    else:
+        mask = window_mask(traces.shape, *(window if isinstance(window, list) else [window]))
+    return np.where(mask, traces, np.nan)
+
+
+# Mean/std/SEM of the values that are not NaN, per step
+def _nan_statistics(values):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # steps with an empty window give NaN
+        n = np.count_nonzero(~np.isnan(values), axis=1)
+        mean = np.nanmean(values, axis=1)
+        std = np.nanstd(values, axis=1)
+        sem = np.nanstd(values, axis=1, ddof=1) / np.sqrt(n)
+    return {"mean": mean, "std": std, "sem": sem, "n": n}
+
+
+# Robust versions of window_statistics (same keys, plus "outliers": number of rejected points per step):
+# "sigma_clip": mean of the points within sigma x std of the median, iterated until nothing more is rejected.
+# "median": median, and 1.4826 x MAD as std (its SEM is 1.2533 x std / sqrt(n)).
+# "hampel": points further than sigma x 1.4826 x MAD from the median of their neighbourhood (half_width points on
+# each side) are rejected, mean of the rest. Good for single spikes on a drifting trace. A neighbourhood with a MAD
+# of 0 (flat or quantised currents at a fixed SMU range) rejects nothing.
+def robust_statistics(traces, window, method="sigma_clip", sigma=3, half_width=3, iterations=5):
+    values = _window_values(traces, window)
+    n_window = np.count_nonzero(~np.isnan(values), axis=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if method == "median":
+            median = np.nanmedian(values, axis=1)
+            std = 1.4826 * np.nanmedian(np.abs(values - median[:, None]), axis=1)
+            return {"mean": median, "std": std, "sem": 1.2533 * std / np.sqrt(n_window), "n": n_window,
+                    "outliers": np.zeros(len(values), dtype=int)}
+        if method == "sigma_clip":
+            for _ in range(iterations):
+                center = np.nanmedian(values, axis=1)[:, None]
+                outlier = np.abs(values - center) > sigma * np.nanstd(values, axis=1)[:, None]
+                if not np.any(outlier):
+                    break
+                values = np.where(outlier, np.nan, values)
+        elif method == "hampel":
+            padded = np.pad(values, ((0, 0), (half_width, half_width)), constant_values=np.nan)
+            neighbours = np.lib.stride_tricks.sliding_window_view(padded, 2 * half_width + 1, axis=1)
+            local_median = np.nanmedian(neighbours, axis=2)
+            local_mad = 1.4826 * np.nanmedian(np.abs(neighbours - local_median[:, :, None]), axis=2)
+            outlier = (local_mad > 0) & (np.abs(values - local_median) > sigma * local_mad)
+            values = np.where(outlier, np.nan, values)
+        else:
+            raise ValueError(f"Unknown robust estimator {method}, use 'sigma_clip', 'median' or 'hampel'.")
+    statistics = _nan_statistics(values)
+    statistics["outliers"] = n_window - statistics["n"]
+    return statistics
+
+
+# True for steps whose plain and robust estimates disagree: the means differ by more than threshold x the robust
+# SEM, or a few points blow up the std (more than std_ratio x the robust one). Such a step holds a glitch (range
+# switch, spike) and is worth acquiring again. windows: list of windows, a step is flagged if any of them is.
+def glitch_flags(traces, windows, method="sigma_clip", threshold=3, std_ratio=2, **options):
+    traces = np.atleast_2d(np.asarray(traces, dtype=float))
+    flags = np.zeros(len(traces), dtype=bool)
+    for window in windows:
+        plain = window_statistics(traces, window)
+        robust = robust_statistics(traces, window, method, **options)
+        with np.errstate(invalid='ignore'):
+            flags |= (np.abs(plain["mean"] - robust["mean"]) > threshold * robust["sem"]) | \
+                     (plain["std"] > std_ratio * robust["std"])
+    return flags
+
+
+# Statistics of two parts of one window ({"mean", "std", "min", "max", "count"}, e.g. from SMUDevice.get_statistics),
+# as if computed on all their points. std is the population one, as in window_statistics.
+def combine_statistics(first, second):
+    count = first["count"] + second["count"]
+    if not count:
+        return dict(first)
+    mean = (first["count"] * first["mean"] + second["count"] * second["mean"]) / count
+    squares = sum(part["count"] * (part["std"] ** 2 + (part["mean"] - mean) ** 2) for part in (first, second))
+    return {"mean": mean, "std": float(np.sqrt(squares / count)), "min": min(first["min"], second["min"]),
+            "max": max(first["max"], second["max"]), "count": count}
+
+
+# What keeps the statistics of a trace from standing in for the trace: 'empty', 'overflow' (a NaN or a reading
+# above the range, see AutoRange.is_overflow) or 'outlier' (min or max further than threshold x std from the mean:
+# a spike or a range switch, see glitch_flags). None if there is nothing. The threshold is capped below the largest
+# deviation `count` points can reach at all, (count - 1) / sqrt(count) x std.
+def statistics_anomaly(statistics, threshold=4):
+    count = statistics["count"]
+    values = [statistics[name] for name in ("mean", "std", "min", "max")]
+    if count < 1:
+        return 'empty'
+    if not np.all(np.isfinite(values)) or statistics["max"] > 1:
+        return 'overflow'
+    limit = min(threshold, 0.9 * (count - 1) / np.sqrt(count)) * statistics["std"]
+    if count > 2 and max(statistics["max"] - statistics["mean"], statistics["mean"] - statistics["min"]) > limit:
+        return 'outlier'
+    return None
+
+
+# Dark, illuminated and photocurrent statistics of all steps, with responsivity and LDR. dark: dark currents not in
+# the traces ({"mean", "std"[, "sem"]} per step, e.g. cached or the fixed i_d of EXP_LDR-HIGH.py), used for steps
+# whose dark window is empty. light: the same for illuminated currents not in the traces ({"mean", "std", "sem",
+# "n"}, e.g. statistics computed by the SMU), used for steps whose illuminated window is empty.
+def ldr_statistics(traces, dark_window, illum_window, pinc, dark=None, light=None):
+    traces = np.atleast_2d(np.asarray(traces, dtype=float))
+    pinc = np.asarray(pinc, dtype=float)
+    dark_stats = window_statistics(traces, dark_window)
+    light_stats = window_statistics(traces, illum_window)
+    for stats, given_stats, keys in ((dark_stats, dark, ("mean", "std", "sem")),
+                                     (light_stats, light, ("mean", "std", "sem", "n"))):
+        if given_stats is None:
+            continue
+        missing = stats["n"] == 0
+        for key in keys:
+            given = np.broadcast_to(np.asarray(given_stats.get(key, np.nan), dtype=float), missing.shape)
+            stats[key] = np.where(missing, given, stats[key])
+    light = light_stats
+    photocurrent = light["mean"] - dark_stats["mean"]
+    photocurrent_error = np.hypot(light["std"], dark_stats["std"])  # same propagation as in the scripts
+    with np.errstate(invalid='ignore', divide='ignore'):
+        responsivity = photocurrent / pinc
+        responsivity_error = photocurrent_error / pinc
+    results = {"pinc": pinc, "dark_current": dark_stats["mean"], "dark_error": dark_stats["std"],
+               "dark_sem": dark_stats["sem"], "current": light["mean"], "current_error": light["std"],
+               "current_sem": light["sem"], "photocurrent": photocurrent, "photocurrent_error": photocurrent_error,
+               "photocurrent_sem": np.hypot(light["sem"], dark_stats["sem"]), "responsivity": responsivity,
+               "responsivity_error": responsivity_error, "points": light["n"]}
+    results["ldr"] = linear_dynamic_range(pinc, photocurrent, photocurrent_error)
+    return results
+
+
+# Linear dynamic range in dB, 20*log10(I_max/I_min) over the steps whose photocurrent is significant (snr x its
+# error) and whose responsivity is within tolerance of the median responsivity of those steps.
+def linear_dynamic_range(pinc, photocurrent, photocurrent_error, tolerance=0.1, snr=3):
+    pinc = np.asarray(pinc, dtype=float)
+    photocurrent = np.asarray(photocurrent, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        significant = (pinc > 0) & (photocurrent > snr * np.asarray(photocurrent_error, dtype=float))
+        responsivity = photocurrent / pinc
+    result = {"ldr_db": np.nan, "i_min": np.nan, "i_max": np.nan, "p_min": np.nan, "p_max": np.nan,
+              "responsivity": np.nan, "linear": np.zeros(len(pinc), dtype=bool)}
+    if not np.any(significant):
+        return result
+    reference = np.median(responsivity[significant])
+    linear = significant & (np.abs(responsivity / reference - 1) <= tolerance)
+    if np.count_nonzero(linear) < 2:
+        return result
+    result.update(ldr_db=20 * np.log10(np.max(photocurrent[linear]) / np.min(photocurrent[linear])),
+                  i_min=np.min(photocurrent[linear]), i_max=np.max(photocurrent[linear]),
+                  p_min=np.min(pinc[linear]), p_max=np.max(pinc[linear]), responsivity=reference, linear=linear)
+    return result
+
+
+# All LDR loops of one run container (RunStore .h5). Returns {loop: ldr_statistics(...)}, steps sorted by Pinc.
+# Steps saved with their windows (dark_window/illum_window/extra_start attributes) are cut exactly as measured;
+# for older runs give windows=(dark_window, illum_window). Dark currents that are not in the trace come from the
+# step attributes or the loop summary, illuminated currents of steps saved without a trace (statistics_fetch of
+# EXP_LDR-HIGH.py) from their light_mean/light_std/light_count attributes.
+def reprocess_run(file_path, windows=None):
+    metadata, steps = load_run(file_path)
+    loops = {}
+    for name, (data, attributes) in steps.items():
+        loop, _, step = name.rpartition('/')
+        loops.setdefault(loop, {"steps": {}, "summary": None})
+        if step.startswith("summary"):
+            loops[loop]["summary"] = data
+        elif "Pinc" in attributes and "Current" in data:
+            loops[loop]["steps"][step] = (data["Current"], attributes)
+    return _reprocess_loops(file_path, loops, windows)
+
+
+# File names of the raw data CSVs of EXP_LDR-LOW.py and EXP_LDR-HIGH.py ("Results dump", raw_data_format 'csv'):
+# Pinc, loop number, filter position (one digit per wheel), points per trace and sampling time of every step
+RAW_CSV_NAME = re.compile(r"Raw data (?P<device>.+) (?P<pinc>[^ ]+)W (?P<script>low_intensity measurement|LDR-High-)"
+                          r"(?P<loop>\d+)(?P<position>\d-\d) (?P<voltage>[^ ]+)V (?P<nplc>[^ ]+) (?P<points>\d+)pts "
+                          r"(?P<sampling_time>[^ ]+)s\.csv")
+# Script of a raw data CSV and the start of the name of its "current output" CSV, saved next to "Results dump"
+RAW_CSV_SCRIPTS = {"low_intensity measurement": ("LDR-Low", "Low intensity current output"),
+                   "LDR-High-": ("LDR-High", "LDR-High current output")}
+
+
+# Windows of a raw data CSV of `points` samples as the scripts take them with their default settings: EXP_LDR-LOW.py
+# skips `skipped` points around each of its two windows, EXP_LDR-HIGH.py traces are illuminated only.
+def csv_windows(script, points, skipped=6):
+    if script == "LDR-High":
+        return (0, 0), (0, points)
+    datapoints = (points - 4 * skipped) // 2
+    return ldr_windows(skipped, datapoints, skipped, skipped, datapoints)
+
+
+# Columns of a tab separated CSV with a header row, as a structured array (one row per line)
+def read_columns(file_path, delimiter='\t'):
+    return np.atleast_1d(np.genfromtxt(file_path, delimiter=delimiter, names=True))
+
+
+# Pinc of every step of a CSV loop. The scripts name all raw data files of a loop after the highest Pinc of the
+# sweep, so a step gets the Pinc of the "current output" row whose Current is the mean of its illuminated points.
+# Without such a row the Pinc of the file name is kept.
+def _csv_step_pinc(steps, summary, windows):
+    unused = np.ones(len(summary), dtype=bool) if summary is not None else np.zeros(0, dtype=bool)
+    unmatched = 0
+    for step, (trace, attributes) in steps.items():
+        start, stop = attributes.get("illum_window", windows[1] if windows else (0, 0))
+        current = np.nanmean(np.concatenate([trace[start:stop], trace[attributes["extra_start"]:]]))
+        rows = np.flatnonzero(unused & np.isclose(summary["Current"], current, rtol=1e-6, atol=0)) \
+            if summary is not None and "Current" in summary.dtype.names else []
+        if len(rows):
+            attributes["Pinc"] = float(summary["Incident_Power"][rows[0]])
+            unused[rows[0]] = False
+        else:
+            unmatched += 1
+    return unmatched
+
+
+# All LDR loops of one run saved as raw data CSVs (file paths of the "Results dump/Raw data ... .csv" files of one
+# run), as reprocess_run gives them for a run container. Loop, filter position, points and sampling time come from
+# the file names, Pinc from the "current output" CSV next to "Results dump" (_csv_step_pinc), which also holds the
+# dark currents of EXP_LDR-HIGH.py. windows=(dark_window, illum_window) overrides those of the default script
+# settings (csv_windows); points after the first `points` of a trace (adaptive sampling) count as illuminated.
+def reprocess_csv_run(file_paths, windows=None):
+    loops = {}
+    for file_path in sorted(file_paths):
+        match = RAW_CSV_NAME.fullmatch(os.path.basename(file_path))
+        if match is None:
+            continue
+        script, summary_name = RAW_CSV_SCRIPTS[match["script"]]
+        points = int(match["points"])
+        attributes = {"Pinc": float(match["pinc"]), "filter_position": match["position"], "points": points,
+                      "sampling_time": float(match["sampling_time"]), "extra_start": points}
+        if windows is None:
+            attributes["dark_window"], attributes["illum_window"] = csv_windows(script, points)
+        loop = f"measurement{match['loop']}"
+        if loop not in loops:
+            summary_path = os.path.join(os.path.dirname(os.path.dirname(file_path)),
+                                        f"{summary_name} {match['device']} {match['voltage']}V {loop} "
+                                        f"{match['nplc']} {points}pts {match['sampling_time']}s.csv")
+            loops[loop] = {"steps": {}, "summary": read_columns(summary_path) if os.path.exists(summary_path) else None}
+        loops[loop]["steps"][match["position"]] = (read_columns(file_path)["Current"], attributes)
+    for loop, content in loops.items():
+        unmatched = _csv_step_pinc(content["steps"], content["summary"], windows)
+        if unmatched:
+            print(f"{os.path.dirname(file_paths[0])} {loop}: {unmatched} steps without a matching current output "
+                  f"row, their Pinc is the one of the file name (the highest Pinc of the sweep).")
+    return _reprocess_loops(os.path.dirname(file_paths[0]) if file_paths else "", loops, windows)
+
+
+# ldr_statistics of every loop of a run: {loop: {"steps": {step: (trace, attributes)}, "summary": data or None}}
+def _reprocess_loops(file_path, loops, windows):
+    results = {}
+    for loop, content in loops.items():
+        items = sorted(content["steps"].items(), key=lambda item: item[1][1]["Pinc"])
+        if not items:
+            continue
+        if windows is None and any("illum_window" not in attributes for _, (_, attributes) in items):
+            print(f"{file_path} {loop}: steps without saved windows, give windows=(dark, illum) to reprocess them.")
+            continue
+        traces = stack_traces([trace for _, (trace, _) in items])
+        pinc = np.array([attributes["Pinc"] for _, (_, attributes) in items], dtype=float)
+        dark_windows, illum_segments = [], []
+        dark = {"mean": np.full(len(items), np.nan), "std": np.full(len(items), np.nan)}
+        light = {key: np.full(len(items), np.nan) for key in ("mean", "std", "sem", "n")}
+        for k, (_, (trace, attributes)) in enumerate(items):
+            if not len(trace) and "light_mean" in attributes:
+                count, std = attributes.get("light_count", 0), attributes["light_std"]
+                light["mean"][k], light["std"][k], light["n"][k] = attributes["light_mean"], std, count
+                light["sem"][k] = std / np.sqrt(count - 1) if count > 1 else np.nan  # population std, as the SMU's
+            dark_window = tuple(attributes.get("dark_window", windows[0] if windows else (0, 0)))
+            illum_window = tuple(attributes.get("illum_window", windows[1] if windows else (0, 0)))
+            dark_windows.append(dark_window)
+            illum_segments.append((illum_window, int(attributes.get("extra_start", len(trace)))))
+            if len(trace) and len(trace) < max(dark_window[1], illum_window[1], illum_segments[-1][1]):
+                print(f"{file_path} {loop}/{items[k][0]}: trace of {len(trace)} points is shorter than its windows "
+                      f"(saved without its adaptive points?), its statistics use only what was saved.")
+            if "dark_mean" in attributes:
+                dark["mean"][k], dark["std"][k] = attributes["dark_mean"], attributes.get("dark_std", 0)
+            elif content["summary"] is not None:  # matched to the summary row of the same incident power
+                row = np.flatnonzero(np.isclose(content["summary"]["Incident_Power"], pinc[k], rtol=1e-9))
+                if len(row):
+                    dark["mean"][k] = content["summary"]["Dark_Current"][row[0]]
+                    dark["std"][k] = content["summary"]["Dark_Error"][row[0]]
+        dark_window = window_mask(traces.shape, ([w[0] for w in dark_windows], [w[1] for w in dark_windows]))
+        illum_window = window_mask(traces.shape, ([s[0][0] for s in illum_segments], [s[0][1] for s in illum_segments]),
+                                   ([s[1] for s in illum_segments], None))
+        results[loop] = ldr_statistics(traces, dark_window, illum_window, pinc, dark=dark, light=light)
+        results[loop]["steps"] = [step for step, _ in items]
+    return results
+
+
+# Reprocesses every run below folder_path, run containers (.h5) and runs saved as raw data CSVs alike, and writes one
+# summary row per loop (LDR, responsivity, ...) to "LDR archive summary.csv" in folder_path. Returns
+# {file path: reprocess_run(...)}; a CSV run is named after its raw data files without Pinc, loop and filter position.
+def reprocess_archive(folder_path, windows=None, summary_name="LDR archive summary.csv"):
+    archive = {}
+    csv_runs = {}
+    for directory, _, file_names in os.walk(folder_path):
+        for file_name in sorted(file_names):
+            file_path = os.path.join(directory, file_name)
+            match = RAW_CSV_NAME.fullmatch(file_name)
+            if file_name.endswith('.h5'):
+                try:
+                    archive[file_path] = reprocess_run(file_path, windows)
+                except (OSError, KeyError) as e:
+                    print(f"Could not reprocess {file_path}: {e}")
+            elif match is not None:
+                run = f"Raw data {match['device']} {RAW_CSV_SCRIPTS[match['script']][0]} {match['voltage']}V " \
+                      f"{match['nplc']} {match['points']}pts {match['sampling_time']}s"
+                csv_runs.setdefault(os.path.join(directory, run), []).append(file_path)
+    for run, file_paths in csv_runs.items():
+        try:
+            archive[run] = reprocess_csv_run(file_paths, windows)
+        except (OSError, ValueError) as e:
+            print(f"Could not reprocess {run}: {e}")
+    rows = [(os.path.relpath(file_path, folder_path), loop, len(r["pinc"]), r["ldr"]["ldr_db"], r["ldr"]["p_min"],
+             r["ldr"]["p_max"], r["ldr"]["responsivity"], np.nanmedian(r["dark_current"]))
+            for file_path, loops in archive.items() for loop, r in loops.items()]
+    write_columns(os.path.join(folder_path, summary_name), ["File", "Loop", "Steps", "LDR_dB", "P_min", "P_max",
+                  "Responsivity", "Median_Dark_Current"], *(zip(*rows) if rows else [[]] * 8))
+    print(f"Reprocessed {len(rows)} loops of {len(archive)} runs, summary saved to {summary_name}")
+    return archive
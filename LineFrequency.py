@@ -0,0 +1,107 @@
+########################################################
+##      Mains (line) frequency detection and setup    ##
+##  Primary goal: find the mains frequency from the   ##
+##  pickup in a short fast SMU trace, set it on the   ##
+##  SMU (NPLC apertures) and the powermeter, and turn ##
+##  sampling periods into whole line periods, so the  ##
+##  pickup averages out instead of aliasing.          ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import numpy as np
+from ctypes import c_int16
+
+LINE_FREQUENCIES = [50, 60]  # the ones both the SMU (:SYST:LFR) and the TLPM (setLineFrequency) accept
+
+
+# Amplitude of a sine at frequency (in Hz) in a trace, by least squares on its timestamps (which need not be even).
+# Also returns the standard deviation of what the sine and the mean leave.
+def sine_amplitude(current, ttime, frequency):
+    current = np.asarray(current, dtype=float)
+    ttime = np.asarray(ttime, dtype=float)
+    phase = 2 * np.pi * frequency * (ttime - ttime[0])
+    design = np.column_stack([np.ones(len(ttime)), np.cos(phase), np.sin(phase)])
+    fit, _, _, _ = np.linalg.lstsq(design, current, rcond=None)
+    residual = current - design @ fit
+    return float(np.hypot(fit[1], fit[2])), float(np.std(residual, ddof=3))
+
+
+# Mains frequency of the pickup in a trace: the candidate whose fundamental and second harmonic (rectifiers) are
+# strongest. None if neither stands out from the noise (snr) or from the other candidate (by a factor of ratio).
+# The trace should span a whole number of periods of both, e.g. 0.2 s for 50 and 60 Hz.
+def detect_line_frequency(current, ttime, candidates=LINE_FREQUENCIES, snr=5, ratio=2):
+    n = len(current)
+    scores = {}
+    noise = None
+    for frequency in candidates:
+        fundamental, residual = sine_amplitude(current, ttime, frequency)
+        harmonic, _ = sine_amplitude(current, ttime, 2 * frequency)
+        scores[frequency] = np.hypot(fundamental, harmonic)
+        noise = residual if noise is None else min(noise, residual)
+    ranked = sorted(candidates, key=lambda frequency: scores[frequency], reverse=True)
+    best = scores[ranked[0]]
+    amplitude_error = noise * np.sqrt(2 / n)  # of a sine amplitude fitted to n points with white noise
+    if best < snr * amplitude_error or (len(ranked) > 1 and best < ratio * scores[ranked[1]]):
+        return None
+    return ranked[0]
+
+
+class LineFrequency:
+    def __init__(self, frequency=50):
+        self.frequency = frequency  # in Hz, used until detect() or configure() changes it
+        self.detected = None  # what detect() found, None if it found nothing (or was not called)
+
+    @property
+    def period(self):
+        return 1 / self.frequency
+
+    # Takes `points` readings every `period` s at a short NPLC, on the range that is set, and looks for the mains
+    # pickup in them. Changes NPLC and trigger settings: the caller sets them again afterwards.
+    def detect(self, SMU, points=200, period=1e-3, nplc=0.01):
+        SMU.measurement_speed(nplc)
+        SMU.trigger_settings(mtype="TIMer", count=points, period=period)
+        SMU.initiate('ACQuire', timeout=1000)
+        current = np.asarray(SMU.get_current(), dtype=float)
+        ttime = np.asarray(SMU.get_time(), dtype=float)
+        self.detected = detect_line_frequency(current, ttime)
+        if self.detected is None:
+            print(f"Line frequency: no mains pickup found in the trace, keeping {self.frequency} Hz.")
+        else:
+            self.frequency = self.detected
+            print(f"Line frequency: mains pickup at {self.frequency} Hz.")
+        return self.detected
+
+    # Sets the line frequency on the SMU and/or the powermeter (TLPM). Not every powermeter model has the setting.
+    def configure(self, SMU=None, tlPM=None):
+        if SMU is not None:
+            SMU.line_frequency(self.frequency)
+        if tlPM is not None:
+            try:
+                tlPM.setLineFrequency(c_int16(self.frequency))
+            except NameError as error:  # TLPM.py raises NameError with the message of the driver
+                print(f"Warning: line frequency could not be set on the powermeter ({error}).")
+        print(f"Line frequency set to {self.frequency} Hz.")
+
+    # frequency: 50 or 60 Hz, or 0 to detect it with the SMU first (see detect)
+    def setup(self, SMU, tlPM=None, frequency=0):
+        if frequency:
+            self.frequency = frequency
+        else:
+            self.detect(SMU)
+        self.configure(SMU, tlPM)
+
+    # Sampling period (in s) rounded to a whole number of line periods, at least one. Mains pickup then falls on the
+    # same phase in every point and becomes a constant offset instead of a slow beat in the trace.
+    def sync_period(self, period):
+        synced = max(round(period * self.frequency), 1) / self.frequency
+        if not np.isclose(synced, period):
+            print(f"Line frequency: sampling period {period} s changed to {synced:.6g} s "
+                  f"({round(synced * self.frequency)} line periods).")
+        return float(f"{synced:.6g}")
+
+    # NPLC values that are not whole numbers leave part of a line period in each aperture, so the pickup is not
+    # integrated away
+    @staticmethod
+    def check_nplc(nplc):
+        if isinstance(nplc, (int, float)) and nplc >= 1 and not float(nplc).is_integer():
+            print(f"Warning: NPLC {nplc} is not a whole number of line periods, mains pickup is not rejected.")
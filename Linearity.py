@@ -0,0 +1,102 @@
+########################################################
+##   Online linearity check of LDR filter sweeps      ##
+##  Primary goal: fit photocurrent vs incident power  ##
+##  after every filter step, tell when the sweep has  ##
+##  gone past the noise floor or into saturation so   ##
+##  it can stop, and spend the most points on steps   ##
+##  near the knee.                                    ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import numpy as np
+
+
+class LinearityMonitor:
+    def __init__(self, tolerance=0.1, snr=3, confirm=2, min_points=3):
+        self.tolerance = tolerance  # relative deviation from the fit that counts as non-linear (as in LDRAnalysis.py)
+        self.snr = snr  # photocurrent below snr x its error is at the noise floor
+        self.confirm = confirm  # consecutive steps beyond a knee before the sweep is stopped
+        self.min_points = min_points  # linear steps needed before the fit is used
+        self.pinc = []
+        self.photocurrent = []
+        self.error = []
+        self.zones = []
+        self.fit = None  # (responsivity, offset) of photocurrent = responsivity x Pinc + offset
+        self.beyond = 0  # consecutive steps beyond the knee
+        self.stopped = False
+        self.stop_reason = None
+        self.skipped_steps = 0
+
+    # Photocurrent the linear fit expects at pinc (None until there are min_points linear steps)
+    def expected(self, pinc):
+        if self.fit is None:
+            return None
+        responsivity, offset = self.fit
+        return responsivity * pinc + offset
+
+    # Where a step lies: 'floor' (not above the noise), 'saturated' (below the fit, at a higher power than any
+    # linear step), 'knee' (close to either of them) or 'linear'. Also used on the first points of a step, before
+    # deciding how many more to take.
+    def zone(self, pinc, photocurrent, error):
+        if not photocurrent > self.snr * error:
+            return 'floor'
+        if photocurrent <= 2 * self.snr * error:
+            return 'knee'
+        expected = self.expected(pinc)
+        if expected is None:
+            return 'linear'
+        deviation = photocurrent / expected - 1
+        linear_pinc = [p for p, zone in zip(self.pinc, self.zones) if zone == 'linear']
+        if deviation < -self.tolerance and linear_pinc and pinc > max(linear_pinc):
+            return 'saturated'
+        if abs(deviation) > self.tolerance / 2:
+            return 'knee'
+        return 'linear'
+
+    # Adds a finished step and refits. The sweep is stopped after `confirm` saturated steps in a row, or after
+    # `confirm` steps in a row at the floor and at a lower power than any linear step (a sweep towards lower powers).
+    # Floor steps inside the linear range (a noisy or dim step of a sweep whose Pinc is not monotonic) do not count.
+    def update(self, pinc, photocurrent, error):
+        zone = self.zone(pinc, photocurrent, error)
+        linear_pinc = [p for p, z in zip(self.pinc, self.zones) if z == 'linear']
+        self.pinc.append(pinc)
+        self.photocurrent.append(photocurrent)
+        self.error.append(error)
+        self.zones.append(zone)
+        if zone in ('linear', 'knee'):
+            self.beyond = 0
+            self._refit()
+        elif zone == 'saturated' or (linear_pinc and pinc < min(linear_pinc)):
+            self.beyond += 1
+            if self.beyond >= self.confirm and not self.stopped:
+                self.stopped = True
+                self.stop_reason = 'saturation' if zone == 'saturated' else 'noise floor'
+                print(f"Linearity: {self.confirm} steps in a row at the {self.stop_reason}, stopping the sweep.")
+        else:
+            self.beyond = 0
+        return zone
+
+    # Least squares of the relative residuals, (photocurrent - responsivity x Pinc - offset) / photocurrent, so every
+    # decade counts the same and the offset (e.g. a dark current that was not subtracted exactly) does not bend the
+    # fit. Not weighted with the errors: the bright steps are the most precise ones and would decide the fit alone,
+    # right where the saturation starts. Fitted again without the steps further than tolerance/2 from the first fit.
+    def _refit(self):
+        used = [k for k, zone in enumerate(self.zones) if zone in ('linear', 'knee')]
+        if len(used) < self.min_points:
+            return
+        pinc = np.array(self.pinc)[used]
+        photocurrent = np.array(self.photocurrent)[used]
+        design = np.column_stack([pinc / photocurrent, 1 / photocurrent])
+        fit = np.linalg.lstsq(design, np.ones(len(used)), rcond=None)[0]
+        close = np.abs(design @ fit - 1) <= self.tolerance / 2
+        if np.count_nonzero(close) >= self.min_points:
+            fit = np.linalg.lstsq(design[close], np.ones(np.count_nonzero(close)), rcond=None)[0]
+        self.fit = tuple(fit)
+
+    def report(self):
+        counts = {zone: self.zones.count(zone) for zone in ('floor', 'knee', 'linear', 'saturated')}
+        fit = f"responsivity {self.fit[0]:.3g} A/W, offset {self.fit[1]:.3g} A" if self.fit is not None else "no fit"
+        print(f"Linearity: {counts['linear']} linear, {counts['knee']} knee, {counts['floor']} floor and "
+              f"{counts['saturated']} saturated steps, {fit}"
+              + (f", stopped at the {self.stop_reason} ({self.skipped_steps} steps not measured)." if self.stopped
+                 else "."))
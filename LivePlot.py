@@ -0,0 +1,132 @@
+########################################################
+##      Incremental live plot for measurement loops   ##
+##  Primary goal: add new points to existing artists  ##
+##  (no cla() + re-plot of the whole sweep), redraw   ##
+##  only the axes that changed (blitting), and limit  ##
+##  how often the figure is redrawn at all.           ##
+##   THIS FILE ACTS AS A LIBRARY FOR SMU.py AND EXP_. ##
+########################################################
+
+import time
+import numpy as np
+from Timing import span
+
+
+class LivePlot:
+    def __init__(self, fig, min_interval=0.2, headroom=0.5):
+        self.fig = fig
+        self.canvas = fig.canvas
+        self.min_interval = min_interval  # minimum time (in s) between two redraws
+        self.headroom = headroom  # extra room (fraction of the data span) given to the axes when they are rescaled
+        self.series = {}
+        self.last_refresh = 0
+        self.full_redraws = 0
+        self.blits = 0
+
+    # Adds an (empty) series to an axis. With yerr=True it is drawn as errorbar, otherwise as plain markers/line.
+    def add_series(self, name, ax, yerr=False, fmt='o', **kwargs):
+        if yerr:
+            container = ax.errorbar([], [], yerr=[], fmt=fmt, **kwargs)
+            line, bars = container.lines[0], container.lines[2][0]
+        else:
+            line, = ax.plot([], [], fmt, **kwargs)
+            bars = None
+        self.series[name] = {"ax": ax, "line": line, "bars": bars, "x": [], "y": [], "yerr": [], "dirty": False,
+                             "replaced": False}
+        return line
+
+    # Appends one point (or several) to a series; nothing is drawn until refresh()
+    def append(self, name, x, y, yerr=None):
+        series = self.series[name]
+        series["x"].extend(np.atleast_1d(x).tolist())
+        series["y"].extend(np.atleast_1d(y).tolist())
+        if yerr is not None:
+            series["yerr"].extend(np.atleast_1d(yerr).tolist())
+        series["dirty"] = True
+
+    # Replaces all data of a series (e.g. a new current-time trace)
+    def set_series(self, name, x, y, yerr=None):
+        series = self.series[name]
+        series["x"], series["y"] = list(np.ravel(x)), list(np.ravel(y))
+        series["yerr"] = list(np.ravel(yerr)) if yerr is not None else []
+        series["dirty"] = True
+        series["replaced"] = True  # old points have to be erased, so the next refresh redraws the whole figure
+
+    def _update_artists(self, series):
+        x, y = np.asarray(series["x"], dtype=float), np.asarray(series["y"], dtype=float)
+        series["line"].set_data(x, y)
+        if series["bars"] is not None and len(series["yerr"]) == len(y):
+            err = np.abs(np.asarray(series["yerr"], dtype=float))
+            segments = np.stack([np.column_stack([x, y - err]), np.column_stack([x, y + err])], axis=1)
+            series["bars"].set_segments(segments)
+        series["dirty"] = False
+
+    # True if some data of the axis lies outside its current view, i.e. the axis has to be rescaled
+    def _outside_view(self, ax):
+        x_low, x_high = sorted(ax.get_xlim())
+        y_low, y_high = sorted(ax.get_ylim())
+        for series in self.series.values():
+            if series["ax"] is not ax or not series["x"]:
+                continue
+            x, y = np.asarray(series["x"], dtype=float), np.asarray(series["y"], dtype=float)
+            valid = np.isfinite(x) & np.isfinite(y)
+            if ax.get_xscale() == 'log':
+                valid &= x > 0
+            if ax.get_yscale() == 'log':
+                valid &= y > 0
+            if np.any((x[valid] < x_low) | (x[valid] > x_high) | (y[valid] < y_low) | (y[valid] > y_high)):
+                return True
+        return False
+
+    # Rescales an axis to its data plus headroom, so the next points of a sweep still fit without another rescale
+    def _rescale(self, ax):
+        ax.relim()
+        limits = ((ax.dataLim.intervalx, ax.dataLim.minposx, ax.set_xlim, ax.get_xscale()),
+                  (ax.dataLim.intervaly, ax.dataLim.minposy, ax.set_ylim, ax.get_yscale()))
+        for (low, high), min_positive, set_lim, scale in limits:
+            if not (np.isfinite(low) and np.isfinite(high)):
+                continue  # no data on this axis yet
+            if scale == 'log':
+                if high <= 0:
+                    continue
+                low = max(low, min_positive)
+                span = max(np.log10(high / low), 1) * self.headroom  # in decades
+                set_lim(low / 10 ** span, high * 10 ** span)
+            else:
+                span = ((high - low) or abs(high) or 1) * self.headroom
+                set_lim(low - span, high + span)
+
+    # Redraws what changed. Returns False if skipped because the last redraw was less than min_interval ago.
+    def refresh(self, force=False):
+        if not force and time.time() - self.last_refresh < self.min_interval:
+            return False
+        changed_axes = []
+        replaced = False
+        for series in self.series.values():
+            replaced = replaced or series["replaced"]
+            series["replaced"] = False
+            if series["dirty"]:
+                self._update_artists(series)
+                if series["ax"] not in changed_axes:
+                    changed_axes.append(series["ax"])
+        rescale = force or replaced or self.full_redraws == 0 or any(self._outside_view(ax) for ax in changed_axes)
+        if rescale:  # limits change, so the whole figure has to be drawn again
+            with span("LivePlot full redraw", "plot"):
+                for ax in changed_axes:
+                    self._rescale(ax)
+                self.canvas.draw()
+            self.full_redraws += 1
+        else:  # points are only added, so drawing the series over the existing image is enough
+            with span("LivePlot blit", "plot"):
+                for ax in changed_axes:
+                    for series in self.series.values():
+                        if series["ax"] is ax:
+                            ax.draw_artist(series["line"])
+                            if series["bars"] is not None:
+                                ax.draw_artist(series["bars"])
+                    self.canvas.blit(ax.bbox)
+            self.blits += 1
+        with span("LivePlot flush_events", "plot"):
+            self.canvas.flush_events()
+        self.last_refresh = time.time()
+        return True
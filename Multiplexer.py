@@ -0,0 +1,103 @@
+########################################################
+##     Multiplexer for measuring several pixels/DUTs  ##
+##  Primary goal: connect one pixel at a time to the  ##
+##  SMU and measure ALL pixels under one optical      ##
+##  condition (wheel position + shutter state) before ##
+##  the light is changed. SimulatedSwitch is for      ##
+##  testing without the switch hardware.              ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import time
+import VisaPool
+
+
+# Stand-in for a switch matrix, only keeps track of the closed channel and waits switch_time per switch
+class SimulatedSwitch:
+    def __init__(self, channels, switch_time=0.01):
+        self.channels = list(channels)
+        self.switch_time = switch_time
+        self.closed = None
+
+    def connect(self):
+        print(f"Simulated switch connected, channels: {self.channels}")
+
+    def disconnect(self):
+        self.closed = None
+        print("Disconnected from simulated switch")
+
+    def select(self, channel):
+        if channel not in self.channels:
+            print(f"Warning: channel {channel} does not exist on the simulated switch.")
+            return False
+        time.sleep(self.switch_time)
+        self.closed = channel
+        return True
+
+
+# SCPI switch matrix/multiplexer (e.g. Keysight 34980A or DAQ970A), one channel closed at a time
+class VisaSwitch:
+    def __init__(self, address, settle_time=0.05):
+        self.address = address
+        self.settle_time = settle_time  # in s, after closing a relay, before the SMU measures
+        self.rm = VisaPool.resource_manager()
+        self.switch = None
+        self.closed = None
+
+    def connect(self):
+        self.switch = VisaPool.open_session(self.address)
+        print("Switch Identification:", VisaPool.identity(self.address))
+        self.switch.write(":ROUTe:OPEN:ALL")
+
+    def disconnect(self):
+        if self.switch:
+            self.switch.write(":ROUTe:OPEN:ALL")
+            VisaPool.release_session(self.address)
+            self.switch = None
+            self.closed = None
+            print("Disconnected from switch")
+        else:
+            print("No connection to switch")
+
+    def select(self, channel):
+        if self.closed is not None:
+            self.switch.write(f":ROUTe:OPEN (@{self.closed})")  # break before make
+        self.switch.write(f":ROUTe:CLOSe (@{channel})")
+        self.switch.query("*OPC?")
+        time.sleep(self.settle_time)
+        self.closed = channel
+        return True
+
+
+class PixelScheduler:
+    def __init__(self, switch, pixels):
+        self.switch = switch
+        self.pixels = pixels  # {pixel name: switch channel}, measured in this order
+        self.reverse = False
+        self.conditions = 0
+        self.switches = 0
+        self.switch_time = 0  # total time (in s) spent switching
+
+    # Runs measure(pixel) for every pixel under the present optical condition and returns {pixel: result}.
+    # The order alternates between conditions, so the last pixel of one condition is the first of the next
+    # and its relay does not have to be switched.
+    def measure_all(self, measure):
+        names = list(self.pixels)[::-1] if self.reverse else list(self.pixels)
+        results = {}
+        for name in names:
+            channel = self.pixels[name]
+            if self.switch.closed != channel:
+                t_start = time.time()
+                if not self.switch.select(channel):
+                    print(f"Could not connect {name}, skipping it.")
+                    continue
+                self.switch_time += time.time() - t_start
+                self.switches += 1
+            results[name] = measure(name)
+        self.reverse = not self.reverse
+        self.conditions += 1
+        return results
+
+    def report(self):
+        print(f"Pixel scheduler: {len(self.pixels)} pixels under {self.conditions} optical conditions, "
+              f"{self.switches} switches ({self.switch_time:.2f} s).")
@@ -0,0 +1,137 @@
+########################################################
+##    Current noise spectral density and detectivity  ##
+##  Primary goal: one-sided noise PSD of current-time ##
+##  traces (Welch or Lomb-Scargle, the SMU timestamps ##
+##  are not exactly even), averaged over repeated     ##
+##  traces as they arrive, and the specific           ##
+##  detectivity D* from it.                           ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import numpy as np
+from AutoRange import is_overflow
+
+
+# Trace on an even time grid t0 + k*dt (linear interpolation). dt defaults to the median interval; for evenly
+# timed traces the samples come back unchanged.
+def resample_uniform(current, ttime, dt=None, points=None):
+    current = np.asarray(current, dtype=float)
+    ttime = np.asarray(ttime, dtype=float)
+    if dt is None:
+        dt = float(np.median(np.diff(ttime)))
+    if points is None:
+        points = int(np.floor((ttime[-1] - ttime[0]) / dt + 1e-9)) + 1
+    grid = ttime[0] + dt * np.arange(points)
+    return np.interp(grid, ttime, current), dt
+
+
+# One-sided PSD (in A^2/Hz) by Welch's method: Hann-windowed segments of segment_points (default: the whole
+# trace) with the given overlap, each without its mean, periodograms averaged. Returns (frequencies, psd).
+def welch_psd(current, dt, segment_points=None, overlap=0.5):
+    current = np.asarray(current, dtype=float)
+    n = len(current) if not segment_points else min(segment_points, len(current))
+    step = max(int(n * (1 - overlap)), 1)
+    window = np.hanning(n + 2)[1:-1]  # Hann without its zero end points, they would waste two of few samples
+    starts = np.arange(0, len(current) - n + 1, step)
+    segments = np.stack([current[start:start + n] for start in starts])
+    segments = (segments - segments.mean(axis=1, keepdims=True)) * window
+    psd = np.mean(np.abs(np.fft.rfft(segments, axis=1)) ** 2, axis=0) * dt / np.sum(window ** 2)
+    psd[1:(n + 1) // 2] *= 2  # one-sided: negative frequencies folded in (not DC and Nyquist)
+    return np.fft.rfftfreq(n, dt), psd
+
+
+# One-sided PSD (in A^2/Hz) of an unevenly timed trace by the Lomb-Scargle periodogram, scaled so that it matches
+# the periodogram (|FFT|^2 x 2 dt / N) for even timing. Default frequencies: k / (N x mean dt), k = 1 .. N/2.
+def lomb_scargle_psd(current, ttime, frequencies=None):
+    current = np.asarray(current, dtype=float)
+    ttime = np.asarray(ttime, dtype=float)
+    n = len(current)
+    dt = (ttime[-1] - ttime[0]) / (n - 1)
+    if frequencies is None:
+        frequencies = np.arange(1, n // 2 + 1) / (n * dt)
+    frequencies = np.asarray(frequencies, dtype=float)
+    y = current - current.mean()
+    omega = 2 * np.pi * frequencies[:, None]  # frequencies x samples
+    tau = np.arctan2(np.sum(np.sin(2 * omega * ttime), axis=1), np.sum(np.cos(2 * omega * ttime), axis=1)) / 2
+    phase = omega * ttime - tau[:, None]
+    cos, sin = np.cos(phase), np.sin(phase)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        power = 0.5 * ((cos @ y) ** 2 / np.sum(cos ** 2, axis=1) + (sin @ y) ** 2 / np.sum(sin ** 2, axis=1))
+    return frequencies, np.nan_to_num(power) * 2 * dt
+
+
+# Specific detectivity D* (in Jones, cm Hz^1/2 / W) from responsivity (A/W), active area (cm^2) and the current
+# noise spectral density (A/Hz^1/2)
+def specific_detectivity(responsivity, area, noise_density):
+    with np.errstate(divide='ignore'):
+        return responsivity * np.sqrt(area) / np.asarray(noise_density, dtype=float)
+
+
+# Running average of the noise PSD over the traces of a run. The first trace fixes the time step and number of
+# points, later traces are put on the same grid (method 'welch') or the same frequencies ('lomb').
+class NoiseSpectrum:
+    def __init__(self, method='welch', segment_points=None):
+        if method not in ('welch', 'lomb'):
+            raise ValueError(f"Unknown noise spectrum method {method}, use 'welch' or 'lomb'.")
+        self.method = method
+        self.segment_points = segment_points
+        self.dt = None
+        self.points = None
+        self.frequencies = None
+        self.psd_sum = None
+        self.count = 0
+        self.max_jitter = 0  # largest deviation of a sampling interval from dt, relative to dt
+
+    # Adds one trace and returns the averaged (frequencies, psd) so far
+    def add(self, current, ttime):
+        current = np.asarray(current, dtype=float)
+        ttime = np.asarray(ttime, dtype=float)
+        if len(current) < 4 or is_overflow(current):
+            print("Noise spectrum: trace too short or overflowed, not used.")
+            return self.frequencies, self.psd
+        if self.dt is None:
+            self.dt = float(np.median(np.diff(ttime)))
+            self.points = len(current)
+        self.max_jitter = max(self.max_jitter, float(np.max(np.abs(np.diff(ttime) - self.dt)) / self.dt))
+        if len(current) != self.points:
+            print("Noise spectrum: trace has another number of points than the first one, not used.")
+            return self.frequencies, self.psd
+        if self.method == 'welch':
+            even, _ = resample_uniform(current, ttime, self.dt, self.points)
+            frequencies, psd = welch_psd(even, self.dt, self.segment_points)
+        else:
+            frequencies, psd = lomb_scargle_psd(current, ttime, self.frequencies)
+        self.frequencies = frequencies
+        self.psd_sum = psd if self.psd_sum is None else self.psd_sum + psd
+        self.count += 1
+        return self.frequencies, self.psd
+
+    @property
+    def psd(self):
+        return None if self.psd_sum is None else self.psd_sum / self.count
+
+    # Current noise spectral density in A/Hz^1/2
+    def noise_density(self):
+        return None if self.psd_sum is None else np.sqrt(self.psd)
+
+    # Noise density averaged (as power) over a frequency band. The default band leaves out DC, the lowest frequency
+    # (taken down by the mean removal and the window) and the Nyquist frequency.
+    def band_noise(self, f_low=None, f_high=None):
+        if self.psd_sum is None:
+            return np.nan
+        positive = self.frequencies[self.frequencies > 0]
+        f_low = positive[min(1, len(positive) - 1)] if f_low is None else f_low
+        f_high = positive[max(len(positive) - 2, 0)] if f_high is None else f_high
+        band = (self.frequencies >= f_low) & (self.frequencies <= f_high)
+        return float(np.sqrt(np.mean(self.psd[band]))) if np.any(band) else np.nan
+
+    def report(self, name=""):
+        if self.psd_sum is None:
+            print(f"Noise spectrum {name}: no traces.")
+            return
+        positive = self.frequencies[self.frequencies > 0]
+        print(f"Noise spectrum {name}: {self.count} traces ({self.method}), {self.band_noise():.3g} A/Hz^1/2 "
+              f"from {positive[0]:.3g} to {positive[-1]:.3g} Hz, timestamp jitter up to {100 * self.max_jitter:.2g} % "
+              f"of the sampling interval.")
+        if self.method == 'welch' and self.max_jitter > 0.01:
+            print("Uneven timestamps: resampling takes down the high frequencies, 'lomb' does not.")
@@ -0,0 +1,79 @@
+########################################################
+##   Background output pipeline for acquisition loops ##
+##  Primary goal: keep the SMU busy. The measurement  ##
+##  loop only hands over the fetched arrays, a worker ##
+##  thread writes them to disk. (Live plots must stay ##
+##  in the main thread, see LivePlot.py for those.)   ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import queue
+import threading
+import time
+import numpy as np
+from Timing import span
+
+
+class OutputPipeline:
+    def __init__(self, maxsize=8):
+        self.jobs = queue.Queue(maxsize=maxsize)  # bounded: the acquisition loop waits if the disk falls behind
+        self.errors = []
+        self.backpressure_time = 0  # total time (in s) the acquisition loop had to wait for the writer
+        self.jobs_done = 0
+        self.worker = threading.Thread(target=self._run, name="OutputPipeline writer", daemon=True)
+        self.worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    # Queues a disk job, e.g. submit(write_columns, path, header, ttime, meas_curr). Lists of numbers are frozen
+    # into arrays (other lists are copied), so the acquisition loop can go on appending to its own lists.
+    def submit(self, job, *args, **kwargs):
+        args = tuple(freeze(arg) for arg in args)
+        try:
+            self.jobs.put_nowait((job, args, kwargs))
+        except queue.Full:
+            wait_start = time.time()
+            with span("OutputPipeline backpressure", "output"):
+                self.jobs.put((job, args, kwargs))  # backpressure: blocks until the writer catches up
+            self.backpressure_time += time.time() - wait_start
+
+    def _run(self):
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                self.jobs.task_done()
+                return
+            job, args, kwargs = item
+            try:
+                with span(f"write {job.__name__}", "output"):
+                    job(*args, **kwargs)
+            except Exception as e:  # a failed write must not stop the measurement, it is reported at close()
+                self.errors.append(e)
+                print(f"Output pipeline: {job.__name__} failed: {e}")
+            self.jobs_done += 1
+            self.jobs.task_done()
+
+    # Waits until everything queued so far is written
+    def flush(self):
+        self.jobs.join()
+
+    def close(self):
+        if not self.worker.is_alive():
+            return
+        self.jobs.put(None)
+        self.worker.join()
+        print(f"Output pipeline: {self.jobs_done} jobs written, acquisition waited {self.backpressure_time:.2f} s "
+              f"for the writer, {len(self.errors)} errors.")
+
+
+def freeze(arg):
+    if isinstance(arg, list):
+        if all(isinstance(value, (int, float)) for value in arg):
+            return np.array(arg, dtype=float)
+        return list(arg)
+    return arg
@@ -0,0 +1,91 @@
+########################################################
+##      In-memory results of multi-loop LDR runs      ##
+##  Primary goal: keep the raw traces (loops x steps  ##
+##  x samples) and the per-step results (structured   ##
+##  array, loops x steps) of a whole run in arrays    ##
+##  allocated once, shared by the measurement loop,   ##
+##  the plots and the writers as views (no copies).   ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import numpy as np
+
+# Results of a filter step, names as in the checkpoints of the LDR scripts (see Checkpoint.py)
+STEP_FIELDS = ["Incident_Power", "Dark_Current", "Dark_Error", "Output_Current", "Current_Error", "Photocurrent",
+               "Photocurrent_Error", "Current_Range"]
+
+
+class RunResults:
+    # samples: expected longest trace of a step. Traces or loops that are longer make the arrays grow (doubling).
+    def __init__(self, loops, steps, samples, fields=STEP_FIELDS):
+        self.fields = list(fields)
+        self.current = np.full((loops, steps, samples), np.nan)
+        self.time = np.full((loops, steps, samples), np.nan)
+        self.lengths = np.zeros((loops, steps), dtype=int)  # samples of each trace
+        self.summary = np.full((loops, steps), np.nan, dtype=[(name, 'f8') for name in self.fields])
+        self.count = np.zeros(loops, dtype=int)  # steps appended to each loop
+
+    def _grow(self, steps, samples):
+        loops, old_steps, old_samples = self.current.shape
+        steps, samples = max(steps, old_steps), max(samples, old_samples)
+        for name in ("current", "time"):
+            grown = np.full((loops, steps, samples), np.nan)
+            grown[:, :old_steps, :old_samples] = getattr(self, name)
+            setattr(self, name, grown)
+        lengths = np.zeros((loops, steps), dtype=int)
+        lengths[:, :old_steps] = self.lengths
+        self.lengths = lengths
+        summary = np.full((loops, steps), np.nan, dtype=self.summary.dtype)
+        summary[:, :old_steps] = self.summary
+        self.summary = summary
+
+    # Adds a step to a loop: its trace (None for a step without one, e.g. taken from a checkpoint) and any of the
+    # fields. Returns the index of the step in the loop.
+    def append(self, loop, current=None, ttime=None, **values):
+        step = self.count[loop]
+        n = 0 if current is None else len(current)
+        _, steps, samples = self.current.shape
+        if step >= steps or n > samples:
+            self._grow(max(2 * steps, step + 1) if step >= steps else steps,
+                       max(2 * samples, n) if n > samples else samples)
+        if n:
+            self.current[loop, step, :n] = current
+            self.time[loop, step, :n] = ttime
+        self.lengths[loop, step] = n
+        self.count[loop] += 1
+        self.update(loop, step, **values)
+        return step
+
+    # Sets fields of a step that is already added (default: the last one of the loop)
+    def update(self, loop, step=None, **values):
+        step = self.count[loop] - 1 if step is None else step
+        for name, value in values.items():
+            self.summary[name][loop, step] = value
+
+    # Trace of a step as (current, time) views, default: the last step of the loop
+    def trace(self, loop, step=None):
+        step = self.count[loop] - 1 if step is None else step
+        n = self.lengths[loop, step]
+        return self.current[loop, step, :n], self.time[loop, step, :n]
+
+    # Results of a step as a record (last["Photocurrent"]), default: the last step of the loop
+    def step(self, loop, step=None):
+        return self.summary[loop, self.count[loop] - 1 if step is None else step]
+
+    # {field: view of its values over the steps of a loop so far}, for writers, plots and the LDR analysis
+    def columns(self, loop):
+        steps = self.summary[loop, :self.count[loop]]
+        return {name: steps[name] for name in self.fields}
+
+    # Mean and standard deviation of a field over the loops, per step, and the number of loops that measured each
+    # step. Steps a loop did not measure (skipped, stopped early) are left out.
+    def average(self, name):
+        values = self.summary[name][:, :max(self.count.max(), 1)]
+        counts = np.count_nonzero(~np.isnan(values), axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nansum(values, axis=0) / counts
+            std = np.sqrt(np.nansum((values - mean) ** 2, axis=0) / (counts - 1))
+        return mean, std, counts
+
+    def nbytes(self):
+        return self.current.nbytes + self.time.nbytes + self.lengths.nbytes + self.summary.nbytes
@@ -0,0 +1,107 @@
+########################################################
+##      Per-run binary container for measured data    ##
+##  Primary goal: keep all raw traces of one run in a ##
+##   single HDF5 file (one float64 dataset per step,  ##
+##  with the measurement conditions as attributes),   ##
+##   instead of one text CSV per filter position.     ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import os
+import numpy as np
+from DataWriter import write_columns
+
+try:
+    import h5py
+except ImportError:  # h5py is only needed when raw data is saved in the run container
+    h5py = None
+
+
+class RunStore:
+    def __init__(self, file_path, mode='a', chunk_rows=1024, **metadata):
+        if h5py is None:
+            raise ImportError("RunStore needs the h5py package (pip install h5py), or save raw data as 'csv'.")
+        self.file_path = file_path
+        self.chunk_rows = chunk_rows  # rows per HDF5 chunk, datasets grow by whole chunks when appending
+        self.file = h5py.File(file_path, mode)
+        self.set_metadata(**metadata)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    # Run-wide conditions (device, voltage, NPLC, wavelength, ...) are stored as attributes of the file itself
+    def set_metadata(self, **metadata):
+        for key, value in metadata.items():
+            self.file.attrs[key] = value
+
+    # Creates an empty, resizable dataset for a step. Step names may contain '/', e.g. "measurement1/6-8"
+    def create_step(self, name, header, **metadata):
+        if name in self.file:
+            del self.file[name]  # a re-measured step replaces the old one
+        dataset = self.file.create_dataset(name, shape=(0, len(header)), maxshape=(None, len(header)),
+                                           dtype='float64', chunks=(self.chunk_rows, len(header)))
+        dataset.attrs['columns'] = list(header)
+        for key, value in metadata.items():
+            dataset.attrs[key] = value
+        return dataset
+
+    # Appends rows (or columns of equal length) to a step, creating it on first use
+    def append(self, name, header, *columns, **metadata):
+        if name not in self.file:
+            self.create_step(name, header, **metadata)
+        dataset = self.file[name]
+        block = np.column_stack([np.asarray(column, dtype='float64') for column in columns])
+        start = dataset.shape[0]
+        dataset.resize(start + block.shape[0], axis=0)
+        dataset[start:] = block
+        return dataset
+
+    # Whole step in one go, the usual case for a trace fetched from the SMU
+    def write_step(self, name, header, *columns, **metadata):
+        self.create_step(name, header, **metadata)
+        return self.append(name, header, *columns)
+
+    def steps(self):
+        names = []
+        self.file.visititems(lambda name, item: names.append(name) if isinstance(item, h5py.Dataset) else None)
+        return names
+
+    # Returns ({column: array}, {attribute: value}) for one step
+    def read_step(self, name):
+        dataset = self.file[name]
+        data = dataset[()]
+        columns = [str(column) for column in dataset.attrs['columns']]
+        return ({column: data[:, k] for k, column in enumerate(columns)},
+                {key: value for key, value in dataset.attrs.items() if key != 'columns'})
+
+    # CSV export on demand, same tab-separated layout as the files in "Results dump"
+    def export_csv(self, folder_path, delimiter='\t'):
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        file_paths = []
+        for name in self.steps():
+            data, metadata = self.read_step(name)
+            file_path = os.path.join(folder_path, name.replace('/', ' ') + '.csv')
+            file_paths.append(write_columns(file_path, list(data.keys()), *data.values(), delimiter=delimiter))
+        return file_paths
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+
+
+# Reloads a whole run for analysis: returns run metadata and {step name: (data, metadata)}
+def load_run(file_path):
+    with RunStore(file_path, mode='r') as store:
+        metadata = dict(store.file.attrs.items())
+        steps = {name: store.read_step(name) for name in store.steps()}
+    return metadata, steps
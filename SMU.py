@@ -1,89 +1,167 @@
 import pyvisa
+import re
+import numpy as np
 import time
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
+from LivePlot import LivePlot
+import VisaPool
 
 
 class SMUDevice:
-    def __init__(self):
-        self.rm = pyvisa.ResourceManager()
+    # serial: find the SMU by (part of) its IDN, e.g. "MY61390205", instead of by address
+    def __init__(self, address="USB0::0x2A8D::0x9B01::MY61390205::0::INSTR", channel=1, serial=None,
+                 keep_open=True):
+        self.rm = VisaPool.resource_manager()  # one per process, shared by all instruments
         self.smu = None
+        self.address = address
+        self.channel = channel  # output channel of the SMU (2-channel models: 1 or 2)
+        self.serial = serial
+        self.keep_open = keep_open  # session stays open after disconnect(), the next connect() re-uses it
+
+    # Another channel of the same SMU, sharing this VISA session (connect this one first)
+    def channel_device(self, channel):
+        device = SMUDevice(self.address, channel, keep_open=self.keep_open)
+        device.smu = VisaPool.open_session(self.address)
+        return device
+
+    # Adds the channel to SOURce/SENSe/TRIGger/TRACe commands (":SOUR:VOLT 1" -> ":SOUR2:VOLT 1"), also in each
+    # command of a compound one (";" between them). Channel 1 is the default of the SMU, so its commands are sent
+    # unchanged.
+    def node(self, command):
+        if self.channel == 1:
+            return command
+        return re.sub(r"(^|;):(SOURce|SOUR|sour|SENSe|SENS|sens|TRIGger|TRIG|trig|TRACe|TRAC|trac)(?=:)",
+                      rf"\g<1>:\g<2>{self.channel}", command)
+
+    # Channel list for :INIT and :FETC, e.g. " (@2)". Empty for channel 1 only.
+    def channel_list(self, channels=None):
+        channels = channels if channels is not None else [self.channel]
+        if channels == [1]:
+            return ""
+        return " (@" + ",".join(str(channel) for channel in channels) + ")"
+
+    def write(self, command):
+        self.smu.write(self.node(command))
 
     def connect(self):
-        smu_address = "USB0::0x2A8D::0x9B01::MY61390205::0::INSTR"
-        self.smu = self.rm.open_resource(smu_address)
-        time.sleep(0.1)
-        # Send the *IDN? command to the SMU
-        self.smu.write("*IDN?")
-        time.sleep(1)  # Add a delay before reading the response.
-        response = self.smu.read()
-        print("SMU Identification:", response)
+        if self.serial is not None:
+            self.address = VisaPool.find(self.serial) or self.address
+        self.smu = VisaPool.open_session(self.address)  # timeout, chunk size and termination set for array fetches
+        # *IDN? is queried once per session (the read waits for the answer, no fixed delay needed)
+        print("SMU Identification:", VisaPool.identity(self.address))
 
     def disconnect(self):
         if not self.wait_for_completion():
             print("Warning: Operation did not complete within the timeout.")
         if self.smu:
-            self.smu.close()
+            VisaPool.release_session(self.address, close=not self.keep_open)
             self.smu = None
             print("Disconnected from SMU")
         else:
             print("No connection to SMU")
 
-    def trigger_settings(self, mtype=None, count=None, period=None):
+    # layer="ACQuire" triggers measurements only, layer="ALL" also steps the source (needed for list sweeps)
+    def trigger_settings(self, mtype=None, count=None, period=None, layer="ACQuire"):
         allowed_types = ["AINT", "BUS", "TIMer", "INT1", "INT2",
                          "LAN", "EXT1", "EXT2", "EXT3", "EXT4",
                          "EXT5", "EXT6", "EXT7", "TIN"]
 
         if mtype is not None and mtype in allowed_types:
-            type_str = f":TRIGger:ACQuire:SOURce {mtype}"
-            self.smu.write(type_str)
+            type_str = f":TRIGger:{layer}:SOURce {mtype}"
+            self.write(type_str)
 
         if count is not None and 1 <= count <= 100000:
-            count_str = f":TRIGger:ACQuire:COUNt {count}"
-            self.smu.write(count_str)
+            count_str = f":TRIGger:{layer}:COUNt {count}"
+            self.write(count_str)
 
         if period is not None and period >= 0.0001:
-            period_str = f":TRIGger:ACQuire:TIMer {period}"
-            self.smu.write(period_str)
+            period_str = f":TRIGger:{layer}:TIMer {period}"
+            self.write(period_str)
 
-    def vs_function(self, ftype=None, vstart=None, vend=None, points=None, speed=None):
-        allowed_types = ["single", "double", "off"]
+    # Voltage source function. "single"/"double": linear staircase sweep from vstart to vend (and back) in points
+    # steps. "list": any voltages (e.g. dense around 0 V), uploaded in one command. "off": fixed voltage.
+    def vs_function(self, ftype=None, vstart=None, vend=None, points=None, speed=None, voltages=None):
+        allowed_types = ["single", "double", "list", "off"]
+        ftype = ftype.lower() if ftype is not None else None
 
-        if ftype.lower() != "off" or None:
-            self.smu.write(":sour:volt:mode swe")
-            self.smu.write(f":TRIGger:COUNt {1}")
+        if ftype is not None and ftype not in allowed_types:
+            print("Warning: invalid measurement type syntax")
+            return
 
-        if ftype is not None and ftype.lower() in allowed_types:
-            if ftype.lower() == "off":
-                type_str = f":SOURce:VOLTage:MODE FIXED"
-            else:
-                type_str = f":SOURce:SWEep:STAir {ftype}"
-            self.smu.write(type_str)
+        if ftype == "off":
+            self.write(f":SOURce:VOLTage:MODE FIXED")
 
-        if ftype.lower() == "single":
-            self.smu.write(f":TRIGger:COUNt {points}")
+        if ftype in ["single", "double"]:
+            self.write(":sour:volt:mode swe")
+            self.write(f":TRIGger:COUNt {1}")
+            self.write(f":SOURce:SWEep:STAir {ftype}")
+            if points is not None:
+                self.write(f":TRIGger:COUNt {points if ftype == 'single' else 2 * points}")
 
-        if ftype.lower() == "double":
-            self.smu.write(f":TRIGger:COUNt {2 * points}")
-
-        if ftype.lower() not in allowed_types:
-            print("Warning: invalid measurement type syntax")
+        if ftype == "list":
+            if voltages is None or self.set_voltage_list(voltages) == 0:
+                print("Warning: list sweep needs a list of 1 to 2500 voltages")
+                return
+            self.write(f":TRIGger:COUNt {len(voltages)}")  # one source step and one measurement per voltage
 
         if vstart is not None:
             vstart_str = f":SOUR:VOLT:STAR {vstart}"
-            self.smu.write(vstart_str)
+            self.write(vstart_str)
 
         if vend is not None:
             vend_str = f":SOUR:VOLT:STOP {vend}"
-            self.smu.write(vend_str)
+            self.write(vend_str)
 
         if points is not None and 1 <= points <= 100000:
             points_str = f":SOURce:SWEep:POINts {points}"
-            self.smu.write(points_str)
+            self.write(points_str)
 
         if speed is not None:
             self.measurement_speed(speed)
 
-    def initiate(self, command_type, timeout=1000):
+    # Fast (transient) staircase sweep, synchronised by the timer: the source steps every period, with pulse_width
+    # set as pulses on top of base (None: DC steps). Each point is measured acq_delay after its step/pulse starts,
+    # with an aperture (in s) that fits into the pulse. double=True sweeps back to vstart (for hysteresis).
+    def transient_sweep(self, vstart, vend, points, period, pulse_width=None, acq_delay=None, aperture=None, base=0,
+                        double=False):
+        if pulse_width is not None and pulse_width >= period:
+            print("Warning: pulse width has to be shorter than the period, DC steps are used instead.")
+            pulse_width = None
+        window = pulse_width if pulse_width is not None else period  # time the DUT sits at the step voltage
+        if aperture is None:
+            aperture = window / 2
+        if acq_delay is None:
+            acq_delay = window / 4  # measurement ends at 3/4 of the pulse, away from both edges
+        if acq_delay + aperture > window:
+            print("Warning: acquire delay + aperture is longer than the pulse, the measurement runs over its edge.")
+        self.write(":SOURce:FUNCtion:MODE VOLTage")
+        if pulse_width is None:
+            self.write(":SOURce:FUNCtion:SHAPe DC")
+        else:
+            self.write(":SOURce:FUNCtion:SHAPe PULSe")
+            self.write(f":SOURce:VOLTage:LEVel:IMMediate:AMPLitude {base}")
+            self.write(":SOURce:PULSe:DELay 0")
+            self.write(f":SOURce:PULSe:WIDTh {pulse_width}")
+        self.vs_function(ftype="double" if double else "single", vstart=vstart, vend=vend, points=points)
+        self.write(f":SENSe:CURRent:APERture {aperture}")
+        self.write(":TRIGger:TRANsient:DELay 0")
+        self.write(f":TRIGger:ACQuire:DELay {acq_delay}")
+        self.trigger_settings(mtype="TIMer", period=period, layer="ALL")
+
+    # Uploads a list of voltages, sourced one per trigger (use trigger_settings(..., layer="ALL") and
+    # initiate('ALL') to run it). Returns the number of points in the list.
+    def set_voltage_list(self, voltages):
+        if not 1 <= len(voltages) <= 2500:
+            print(f"Warning: a voltage list holds 1 to 2500 points, {len(voltages)} were given.")
+            return 0
+        self.write(":SOURce:FUNCtion:MODE VOLTage")
+        self.write(":SOURce:VOLTage:MODE LIST")
+        self.write(":SOURce:LIST:VOLTage " + ",".join(f"{v:g}" for v in voltages))
+        return len(voltages)
+
+    # channels: start several channels of this SMU with one command, e.g. [1, 2] (default: this channel)
+    def initiate(self, command_type, timeout=1000, channels=None):
         if command_type == 'ACQuire':
             command = ":INITiate:ACQuire"
         elif command_type == 'TRANsient':
@@ -94,31 +172,63 @@ class SMUDevice:
             print("Invalid command type.")
             return
 
-        self.write_command(command, timeout)
+        self.write_command(command + self.channel_list(channels), timeout)
         if not self.wait_for_completion():
             print("Warning: Operation did not complete within the timeout.")
 
     def get_current(self):
-        current_str = self.smu.query(":fetc:arr:curr?")
+        current_str = self.smu.query(":fetc:arr:curr?" + self.channel_list())
         if not self.wait_for_completion():
             print("Warning: Query did not complete within the timeout.")
         current = [float(value) for value in current_str.split(',')]
         return current
 
     def get_source(self):
-        source_str = self.smu.query(":fetc:arr:sour?")
+        source_str = self.smu.query(":fetc:arr:sour?" + self.channel_list())
         if not self.wait_for_completion():
             print("Warning: Query did not complete within the timeout.")
         source = [float(value) for value in source_str.split(',')]
         return source
 
+    # Source, current and time of the last acquisition in one query, instead of three fetches with an *OPC? each
+    def get_arrays(self):
+        self.write(":FORMat:ELEMents:SENSe CURRent,TIME,SOURce")
+        values = [float(value) for value in self.smu.query(":FETCh:ARRay?" + self.channel_list()).split(',')]
+        return values[2::3], values[0::3], values[1::3]  # the SMU sends them as current, time, source
+
     def get_time(self):
-        time_str = self.smu.query(":fetc:arr:time?")
+        time_str = self.smu.query(":fetc:arr:time?" + self.channel_list())
         if not self.wait_for_completion():
             print("Warning: Query did not complete within the timeout.")
         ttime = [float(value) for value in time_str.split(',')]
         return ttime
 
+    # Arms the trace buffer for the next acquisition: it keeps the first `points` currents, so get_statistics() can
+    # ask the SMU for their statistics instead of fetching them. Call it before every initiate(). One compound
+    # command, so it costs a single bus transfer.
+    def trace_buffer(self, points):
+        self.write(f":TRACe:FEED:CONTrol NEVer;:TRACe:CLEar;:TRACe:FEED SENSe;:TRACe:POINts {points};"
+                   ":FORMat:ELEMents:SENSe CURRent;:TRACe:FEED:CONTrol NEXT")  # statistics of the current only
+
+    # Mean, std, min, max and count of the currents in the trace buffer (see trace_buffer), computed by the SMU and
+    # sent as one answer of a few tens of bytes instead of the whole trace. A point range (start, count) is not
+    # supported by the statistics of the SMU, its currents are fetched from the buffer and the statistics computed
+    # here.
+    def get_statistics(self, start=0, count=None):
+        if start == 0 and count is None:
+            names = ["mean", "std", "min", "max"]
+            query = ";".join(f":TRACe:STATistic:FORMat {form};:TRACe:STATistic:DATA?"
+                             for form in ["MEAN", "SDEViation", "MINimum", "MAXimum"])
+            values = self.smu.query(self.node(query + ";:TRACe:POINts:ACTual?")).split(';')
+            statistics = {name: float(value) for name, value in zip(names, values)}
+            statistics["count"] = int(float(values[-1]))
+            return statistics
+        if count is None:
+            count = int(float(self.smu.query(self.node(":TRACe:POINts:ACTual?")))) - start
+        values = [float(value) for value in self.smu.query(self.node(f":TRACe:DATA? {start},{count}")).split(',')]
+        return {"mean": float(np.mean(values)), "std": float(np.std(values)), "min": float(np.min(values)),
+                "max": float(np.max(values)), "count": len(values)}
+
     def wait_for_completion(self, timeout=400):
         self.smu.write("*OPC?")
         start_time = time.time()
@@ -146,7 +256,7 @@ class SMUDevice:
         return int(response) == 1
 
     def write_command(self, command, timeout=400):
-        self.smu.write(command)
+        self.write(command)
         if not self.wait_for_completion(timeout):
             print("Warning: Command did not complete within the timeout.")
 
@@ -159,7 +269,7 @@ class SMUDevice:
             command = ":SENS:CURR:DC:RANG:AUTO 1"
         else:
             command = f":SENS:CURR:DC:RANG {current_range}"
-        self.smu.write(command)
+        self.write(command)
         if not self.wait_for_completion():
             print("Warning: Operation did not complete within the timeout.")
         print(f"Current measurement range set to {current_range} A.")
@@ -172,34 +282,33 @@ class SMUDevice:
         time_data = []
         current_data = []
 
-        # Set up plot
+        # Set up plot. Points are appended to the existing line and redrawn at most every 0.2 s.
         plt.ion()
         fig, ax = plt.subplots()
-        line, = ax.plot(time_data, current_data)
+        live = LivePlot(fig, min_interval=0.2)
+        live.add_series("current", ax, fmt='-')
         ax.set_xlabel('Time (s)')
         ax.set_ylabel('Current (A)')
         ax.set_title('Time-Current Data')
+        plt.show(block=False)
 
         start_time = time.time()
         for i in range(num_points):
             # Measure current
-            current = self.smu.query(":MEAS:CURR?")
+            current = self.smu.query(":MEAS:CURR?" + self.channel_list())
             time.sleep(0.01)
             current = float(current)
             current_data.append(current)
             time_data.append(time.time() - start_time)
 
             # Update plot
-            line.set_xdata(time_data)
-            line.set_ydata(current_data)
-            ax.relim()
-            ax.autoscale_view(True, True, True)
-            plt.draw()
-            plt.pause(0.01)
+            live.append("current", time_data[-1], current_data[-1])
+            live.refresh()
 
             # Wait for the specified interval before next measurement
             time.sleep(interval)
 
+        live.refresh(force=True)
         plt.ioff()
         plt.show()
 
@@ -208,16 +317,66 @@ class SMUDevice:
     def measurement_speed(self, speed):
         if speed in ["SHOR", "MED", "LONG"]:
             time.sleep(0.1)
-            self.smu.write(f":SENS:CURR:APER:AUTO ON")
+            self.write(f":SENS:CURR:APER:AUTO ON")
             time.sleep(0.1)
-            self.smu.write(f":SENS:CURR:APER:AUTO:MODE {speed}")
+            self.write(f":SENS:CURR:APER:AUTO:MODE {speed}")
         else:
             try:
                 nplc = float(speed)  # check if speed is a valid number
-                self.smu.write(f":SENS:CURR:DC:NPLC {nplc}")
+                self.write(f":SENS:CURR:DC:NPLC {nplc}")
                 if speed > 100:
                     print("Warning: too slow measurement speed, the instrument will use the max of 100")
                 elif speed < 5e-4:
                     print("Warning: too high measurement speed, the instrument will use the min of 5e-4")
             except ValueError:
                 print(f"Invalid input: {speed}. Expected 'SHOR', 'MED', 'LONG' or a number.")
+
+    # Mains frequency the NPLC apertures are based on (1 NPLC = 1/line frequency). See LineFrequency.py.
+    def line_frequency(self, frequency):
+        if frequency not in [50, 60]:
+            print(f"Warning: line frequency {frequency} Hz is not supported, use 50 or 60.")
+            return
+        self.write(f":SYSTem:LFRequency {frequency}")
+
+
+# Several SMUs and/or channels used together, e.g. one DUT each under the same light step
+class SMUGroup:
+    def __init__(self, devices):
+        self.devices = devices
+        self.pool = ThreadPoolExecutor(max_workers=max(len(devices), 1))
+
+    # Devices grouped by VISA session: channels of one SMU share it and are driven from one thread
+    def sessions(self):
+        sessions = {}
+        for device in self.devices:
+            sessions.setdefault(id(device.smu), []).append(device)
+        return list(sessions.values())
+
+    # Same setting on every device, e.g. call("set_current_range", 2e-9). Returns the results in device order.
+    def call(self, method, *args, **kwargs):
+        return [getattr(device, method)(*args, **kwargs) for device in self.devices]
+
+    # Trigger source of all devices, e.g. "TIMer" (each SMU on its own timer) or a shared trigger line such
+    # as "EXT1", wired to all SMUs, so they sample on the same hardware edge.
+    def trigger_settings(self, mtype=None, count=None, period=None, layer="ACQuire"):
+        self.call("trigger_settings", mtype=mtype, count=count, period=period, layer=layer)
+
+    # Starts all devices together: one :INIT per SMU (all its channels in it), the SMUs in parallel threads,
+    # since initiate() waits for the acquisition to complete.
+    def initiate(self, command_type='ACQuire', timeout=1000):
+        def start(session):
+            session[0].initiate(command_type, timeout, channels=[device.channel for device in session])
+        list(self.pool.map(start, self.sessions()))
+
+    # Fetches current and time arrays of all devices concurrently. Returns [(current, time), ...] in device order.
+    def fetch(self):
+        def fetch_session(session):
+            return [(device, device.get_current(), device.get_time()) for device in session]
+        results = {}
+        for session_results in self.pool.map(fetch_session, self.sessions()):
+            for device, current, ttime in session_results:
+                results[id(device)] = (current, ttime)
+        return [results[id(device)] for device in self.devices]
+
+    def close(self):
+        self.pool.shutdown()
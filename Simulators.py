@@ -0,0 +1,616 @@
+########################################################
+##   Simulated instruments of the OPD measurement set ##
+##  Primary goal: run the EXP_/CALIB_ scripts without ##
+##  the optical bench. SMU (at VISA/SCPI level), the  ##
+##  wheel set, flippers and powermeter share one      ##
+##  simulated bench (light path + DUT) and wait as    ##
+##     long as the real instruments would.            ##
+##   THIS FILE ACTS AS A LIBRARY FOR BENCH_ SCRIPTS.  ##
+########################################################
+
+import bisect
+import re
+import sys
+import threading
+import time
+import types
+import numpy as np
+import pyvisa
+import VisaPool
+from LightBlock import LightBlock
+from FlipMirror import FlipMirror
+
+_sleep = time.sleep  # the simulation always waits in real time (scaled), also while time.sleep is patched
+_Timer = threading.Timer
+
+# Latencies of the real instruments (in s unless noted). Measured on the setup or taken from the manuals.
+LATENCY = {
+    "visa_write": 0.3e-3,  # USB-TMC write of a short command
+    "visa_read": 1e-3,  # round trip of a short answer (*OPC?, *IDN?)
+    "visa_bytes_per_s": 1e6,  # ASCII array transfer (:FETC:ARR?), about 16 bytes per value
+    "smu_init": 5e-3,  # arming the trigger system before the first point
+    "smu_point_overhead": 0.3e-3,  # per point, on top of the aperture (auto-zero, ADC readout)
+    "smu_range_change": 20e-3,  # relay switching on :SENS:CURR:RANG
+    "line_frequency": 50,  # in Hz, aperture of 1 NPLC = 1/line_frequency
+    "flipper_transit": 0.4,  # MFF102 flip time, the light path changes at its end
+    "flipper_connect": 1.0,
+    "wheel_speed": 400,  # in steps/s (200 steps per turn)
+    "wheel_settle": 0.1,  # after every move
+    "opm_read": 0.1,  # one measPower() of the PM400 at default averaging
+}
+
+SMU_ADDRESS = "USB0::0x2A8D::0x9B01::MY61390205::0::INSTR"
+OVERFLOW = 9.9e37  # what the SMU returns for a reading above its range
+
+
+# Value of a bench quantity (shutter, transmittance) as a function of time
+class _History:
+    def __init__(self, value):
+        self.times = [-np.inf]
+        self.values = [value]
+        self.lock = threading.Lock()
+
+    def set(self, value, at):
+        with self.lock:
+            k = bisect.bisect_right(self.times, at)
+            self.times.insert(k, at)
+            self.values.insert(k, value)
+
+    def at(self, t):
+        with self.lock:
+            return self.values[bisect.bisect_right(self.times, t) - 1]
+
+
+class OpticalBench:
+    # Light path: laser -> wheel set (transmittance) -> shutter (LightBlock) -> DUT / powermeter.
+    # DUT: photodiode with photocurrent responsivity * P, a shunt resistance and a capacitance (gives hysteresis
+    # in fast sweeps). With saturation_current the photocurrent levels off towards it, with diode_current (saturation
+    # current of the diode, in A) the dark current follows the diode equation as well. mains_pickup (amplitude in A)
+    # adds a sine at mains_frequency, averaged over each aperture like on the real SMU. time_scale < 1 makes every
+    # instrument (and time.sleep, once installed) that much faster.
+    def __init__(self, wavelength=532, laser_power=1e-3, responsivity=0.3, shunt_resistance=5e9, capacitance=1e-10,
+                 noise=1e-3, noise_floor=1e-13, opm_offset=2e-9, saturation_current=None, diode_current=0.0,
+                 ideality_factor=1.5, mains_pickup=0.0, mains_frequency=50, latency=None, time_scale=1.0, seed=0):
+        self.wavelength = wavelength
+        self.laser_power = laser_power  # in W, without filters
+        self.responsivity = responsivity  # in A/W
+        self.shunt_resistance = shunt_resistance  # in Ohm, dark current = V / R
+        self.capacitance = capacitance  # in F
+        self.noise = noise  # relative noise of the current and optical power
+        self.noise_floor = noise_floor  # in A
+        self.opm_offset = opm_offset  # in W, reading of the powermeter in dark
+        self.saturation_current = saturation_current  # in A, None for a linear photodiode
+        self.diode_current = diode_current  # in A, 0 for an ohmic (shunt resistance only) dark current
+        self.ideality_factor = ideality_factor  # of the diode, at 295 K
+        self.mains_pickup = mains_pickup  # in A
+        self.mains_frequency = mains_frequency  # in Hz, of the mains (the SMU is set to its own line frequency)
+        self.latency = dict(LATENCY, **(latency or {}))
+        self.time_scale = time_scale
+        self.rng = np.random.default_rng(seed)
+        self.shutter = _History(False)  # light blocked
+        self.transmittance = _History(1.0)  # no filters
+        self.activity = []  # (instrument, operation, start, end) in perf_counter time
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def record(self, instrument, operation, start, end):
+        with self.lock:
+            self.activity.append((instrument, operation, start, end))
+            self.counts[f"{instrument}.{operation}"] = self.counts.get(f"{instrument}.{operation}", 0) + 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    # The instrument is busy for duration (in instrument time), the caller waits for it
+    def wait(self, instrument, operation, duration):
+        start = time.perf_counter()
+        _sleep(max(duration, 0) * self.time_scale)
+        self.record(instrument, operation, start, time.perf_counter())
+
+    # Real time at which something that takes duration (in instrument time) from now is over
+    def later(self, duration, start=None):
+        return (start if start is not None else time.perf_counter()) + duration * self.time_scale
+
+    def power(self, t=None):
+        t = time.perf_counter() if t is None else t
+        return self.laser_power * self.transmittance.at(t) if self.shutter.at(t) else 0.0
+
+    # Noise is given for an aperture of 1 NPLC and averages down with longer apertures (white noise). The mains pickup
+    # is averaged over the aperture centred on t (perf_counter time): gone for whole mains periods.
+    def current(self, voltage, power, dv_dt=0.0, aperture=None, t=None):
+        photocurrent = self.responsivity * power
+        if self.saturation_current:
+            photocurrent = photocurrent / (1 + photocurrent / self.saturation_current)
+        current = voltage / self.shunt_resistance + photocurrent + self.capacitance * dv_dt
+        if self.diode_current:
+            current += self.diode_current * np.expm1(voltage / (self.ideality_factor * 8.617333e-5 * 295))
+        scale = np.sqrt(1 / (self.latency["line_frequency"] * aperture)) if aperture else 1
+        if self.mains_pickup:
+            t = time.perf_counter() if t is None else t
+            phase = 2 * np.pi * self.mains_frequency * t / self.time_scale  # in instrument time
+            current += self.mains_pickup * np.sin(phase) * np.sinc(self.mains_frequency * (aperture or 0))
+        return current + self.rng.normal(0, scale * (self.noise * abs(current) + self.noise_floor))
+
+    # Busy time of each instrument and of all of them together (overlaps counted once), within [start, end]
+    def busy(self, start, end):
+        intervals = {}
+        with self.lock:
+            for instrument, operation, t0, t1 in self.activity:
+                if t1 > start and t0 < end:
+                    intervals.setdefault(instrument, []).append((max(t0, start), min(t1, end)))
+        busy = {instrument: _union_length(spans) for instrument, spans in intervals.items()}
+        busy["any"] = _union_length([span for name, spans in intervals.items() if name != "script"
+                                     for span in spans])
+        busy["waiting"] = _union_length([span for spans in intervals.values() for span in spans])
+        return busy
+
+
+def _union_length(intervals):
+    total, reach = 0.0, -np.inf
+    for t0, t1 in sorted(intervals):
+        if t1 > reach:
+            total += t1 - max(t0, reach)
+            reach = t1
+    return total
+
+
+# SCPI short form of a header keyword: "SOURce" -> "SOUR", "ACQuire" -> "ACQ" (4 letters, 3 if the 4th is a vowel).
+# Keywords of up to 4 letters ("TIME", "MODE") are their own short form.
+def _short(keyword):
+    keyword = keyword.upper()
+    if len(keyword) <= 4:
+        return keyword
+    return keyword[:3] if keyword[3] in "AEIOU" else keyword[:4]
+
+
+class _Channel:
+    def __init__(self):
+        self.level = 0.0
+        self.mode = "FIX"
+        self.start, self.stop, self.points, self.stair = 0.0, 0.0, 1, "SING"
+        self.voltages = []
+        self.range = None  # None: auto range
+        self.aperture = 1 / 50
+        self.trigger_source, self.count, self.period = "AINT", 1, 2e-5
+        self.acquisition = None  # {"start", "end", "count", "period", "aperture", "voltages"}
+        self.data = None  # {"CURR", "TIME", "SOUR"} of the last acquisition, made when it is first fetched
+        self.trace_points, self.trace_feed, self.trace_statistic = 100000, "NEV", "MEAN"  # :TRAC settings
+        self.trace_acquisition = None  # acquisition that goes into the trace buffer (:TRAC:FEED:CONT NEXT)
+        self.trace = np.array([])  # currents in the trace buffer
+
+
+# pyvisa resource of a Keysight B2900 SMU. Understands the commands SMU.py sends.
+class SimulatedSMU:
+    def __init__(self, bench, address=SMU_ADDRESS):
+        self.bench = bench
+        self.address = address
+        self.timeout = 2000
+        self.chunk_size = 20 * 1024
+        self.read_termination = self.write_termination = '\n'
+        self.closed = False
+        self.channels = {1: _Channel(), 2: _Channel()}
+        self.line_frequency = bench.latency["line_frequency"]  # in Hz, :SYST:LFR, NPLC -> aperture
+        self.elements = ["CURR"]
+        self.answers = []
+
+    @property
+    def session(self):
+        if self.closed:
+            raise pyvisa.errors.InvalidSession()
+        return 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.closed = True
+
+    def query(self, command):
+        self.write(command)
+        return self.read()
+
+    def read(self):
+        answer = self.answers.pop(0)
+        self.bench.count("SMU.read_bytes", len(answer))
+        if answer == "*OPC?":  # answered once every channel is done, or times out like the real one
+            end = max((ch.acquisition["end"] for ch in self.channels.values() if ch.acquisition), default=0)
+            remaining = end - time.perf_counter()
+            if remaining > self.timeout / 1000 * self.bench.time_scale:
+                _sleep(self.timeout / 1000 * self.bench.time_scale)
+                self.answers.insert(0, answer)
+                raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_timeout)
+            _sleep(max(remaining, 0))
+            answer = "1"
+        self.bench.wait("SMU", "read", self.bench.latency["visa_read"] +
+                        len(answer) / self.bench.latency["visa_bytes_per_s"])
+        return answer
+
+    # A compound command (";" between the commands) is one transfer, the answers of its queries are sent together
+    def write(self, command):
+        self.bench.wait("SMU", "write", self.bench.latency["visa_write"])
+        answers = [answer for answer in (self._command(part) for part in command.split(";")) if answer is not None]
+        if answers:
+            self.answers.append(";".join(answers) if len(answers) > 1 else answers[0])
+
+    # Carries out one command, returns the answer of a query (None otherwise)
+    def _command(self, command):
+        header, _, argument = command.strip().partition(" ")
+        argument = argument.strip()
+        keywords = [keyword for keyword in header.strip(":").split(":") if keyword]
+        channel = 1
+        for k, keyword in enumerate(keywords):
+            match = re.fullmatch(r"([A-Za-z*]+)(\d*)(\??)", keyword)
+            if match is None:
+                continue
+            if match.group(2) and match.group(1).upper().startswith(("SOUR", "SENS", "TRIG", "TRAC")):
+                channel = int(match.group(2))
+            keywords[k] = _short(match.group(1)) + match.group(3)
+        if argument.startswith("(@"):  # channel list of :INIT / :FETC
+            channels = [int(ch) for ch in argument.strip("(@)").split(",")]
+        else:
+            channels = [channel]
+        node = ":".join(keywords)
+        state = self.channels.setdefault(channel, _Channel())
+        if node.endswith("?"):
+            return self._query(node, channels, state, argument)
+        if node.startswith("INIT"):
+            for ch in channels:
+                self._initiate(self.channels.setdefault(ch, _Channel()))
+        else:
+            self._set(node, argument, state)
+        return None
+
+    def _set(self, node, argument, state):
+        value = argument.upper()
+        if node in ("SOUR:VOLT:LEV:IMM:AMPL", "SOUR:VOLT", "SOUR:VOLT:LEV"):
+            state.level = float(argument)
+        elif node == "SOUR:VOLT:MODE":
+            state.mode = _short(value)
+        elif node == "SOUR:VOLT:STAR":
+            state.start = float(argument)
+        elif node == "SOUR:VOLT:STOP":
+            state.stop = float(argument)
+        elif node == "SOUR:SWE:POIN":
+            state.points = int(float(argument))
+        elif node == "SOUR:SWE:STA":
+            state.stair = _short(value)
+        elif node == "SOUR:LIST:VOLT":
+            state.voltages = [float(v) for v in argument.split(",")]
+        elif node in ("SENS:CURR:DC:RANG", "SENS:CURR:RANG"):
+            self.bench.wait("SMU", "range", self.bench.latency["smu_range_change"])
+            state.range = float(argument)
+        elif node in ("SENS:CURR:DC:RANG:AUTO", "SENS:CURR:RANG:AUTO"):
+            state.range = None if value in ("1", "ON") else state.range
+        elif node in ("SENS:CURR:DC:NPLC", "SENS:CURR:NPLC"):
+            state.aperture = float(argument) / self.line_frequency
+        elif node in ("SENS:CURR:APER", "SENS:CURR:DC:APER"):
+            state.aperture = float(argument)
+        elif node == "SENS:CURR:APER:AUTO:MODE":
+            nplc = {"SHOR": 0.01, "MED": 1, "LONG": 10}.get(_short(value), 1)
+            state.aperture = nplc / self.line_frequency
+        elif node.startswith("TRIG") and node.endswith("SOUR"):
+            state.trigger_source = _short(value)
+        elif node.startswith("TRIG") and node.endswith("COUN"):
+            state.count = int(float(argument))
+        elif node.startswith("TRIG") and node.endswith("TIM"):
+            state.period = float(argument)
+        elif node == "SYST:LFR":
+            self.line_frequency = float(argument)
+        elif node == "TRAC:POIN":
+            state.trace_points = int(float(argument))
+        elif node == "TRAC:FEED:CONT":
+            state.trace_feed = _short(value)
+        elif node == "TRAC:CLE":
+            state.trace_acquisition = None
+            state.trace = np.array([])
+        elif node == "TRAC:STAT:FORM":
+            state.trace_statistic = _short(value)
+        elif node == "FORM:ELEM:SENS":
+            self.elements = [_short(element) for element in argument.split(",")]
+        # anything else (pulse shape, delays, ...) does not change the simulated data
+
+    def _source_voltages(self, state, count):
+        if state.mode == "SWE":
+            voltages = list(np.linspace(state.start, state.stop, state.points))
+            if state.stair == "DOUB":
+                voltages = voltages + voltages[::-1]
+        elif state.mode == "LIST" and state.voltages:
+            voltages = list(state.voltages)
+        else:
+            voltages = [state.level]
+        return np.resize(np.asarray(voltages, dtype=float), count)  # repeated if the trigger count is longer
+
+    def _initiate(self, state):
+        latency = self.bench.latency
+        step = state.aperture + latency["smu_point_overhead"]
+        if state.trigger_source == "TIM":
+            step = max(step, state.period)
+        start = time.perf_counter()
+        duration = latency["smu_init"] + state.count * step
+        state.acquisition = {"start": self.bench.later(latency["smu_init"], start), "end": self.bench.later(duration,
+                             start), "count": state.count, "period": step, "aperture": state.aperture,
+                             "voltages": self._source_voltages(state, state.count), "range": state.range}
+        self._trace(state)  # the buffer keeps what it got from the acquisition before
+        state.data = None
+        if state.trace_feed == "NEXT":  # fills the buffer once, then the feed goes back to NEVer
+            state.trace_acquisition = state.acquisition
+            state.trace_feed = "NEV"
+        self.bench.record("SMU", "acquire", start, state.acquisition["end"])
+
+    # Currents of the last acquisition, with the light seen in the middle of each aperture
+    def _acquired(self, state):
+        if state.data is None and state.acquisition is not None:
+            acquisition = state.acquisition
+            _sleep(max(acquisition["end"] - time.perf_counter(), 0))
+            times = np.arange(acquisition["count"]) * acquisition["period"]
+            voltages = acquisition["voltages"]
+            dv_dt = np.diff(voltages, prepend=voltages[0]) / acquisition["period"]
+            aperture = acquisition["aperture"]
+            seen = [self.bench.later(t + aperture / 2, acquisition["start"]) for t in times]
+            currents = [self.bench.current(v, self.bench.power(t), dv, aperture, t)
+                        for t, v, dv in zip(seen, voltages, dv_dt)]
+            currents = np.asarray(currents)
+            if acquisition["range"] is not None:
+                currents[np.abs(currents) > 1.05 * acquisition["range"]] = OVERFLOW
+            state.data = {"CURR": currents, "TIME": times, "SOUR": voltages}
+        return state.data
+
+    # Currents in the trace buffer, taken from the acquisition that fed it the first time they are needed
+    def _trace(self, state):
+        if state.trace_acquisition is not None and state.trace_acquisition is state.acquisition:
+            state.trace = np.asarray(self._acquired(state)["CURR"][:state.trace_points])
+            state.trace_acquisition = None
+        return state.trace
+
+    def _query(self, node, channels, state, argument=""):
+        if node == "*IDN?":
+            return f"Keysight Technologies,B2912B,{self.address.split('::')[3]},simulated"
+        if node == "*OPC?":
+            return "*OPC?"
+        if node == "SYST:LFR?":
+            return f"{self.line_frequency:g}"
+        if node in ("MEAS:CURR?", "MEAS:CURR:DC?"):
+            self.bench.wait("SMU", "acquire", state.aperture + self.bench.latency["smu_point_overhead"])
+            return f"{self.bench.current(state.level, self.bench.power(), aperture=state.aperture):+.6E}"
+        if node.startswith("FETC:ARR"):
+            data = self._acquired(self.channels[channels[0]])
+            if data is None:
+                return ""
+            element = node[len("FETC:ARR:"):-1]
+            columns = [data[element]] if element else [data[name] for name in self.elements if name in data]
+            values = np.column_stack(columns).ravel()
+            return ",".join(f"{value:+.6E}" for value in values)
+        if node == "TRAC:POIN:ACT?":
+            return f"{len(self._trace(state)):+d}"
+        if node == "TRAC:STAT:DATA?":
+            trace = self._trace(state)
+            if not len(trace):
+                return f"{OVERFLOW:+.6E}"
+            statistic = {"MEAN": np.mean, "SDEV": np.std, "MIN": np.min, "MAX": np.max,
+                         "PKPK": np.ptp}[state.trace_statistic]
+            return f"{statistic(trace):+.6E}"
+        if node == "TRAC:DATA?":
+            trace = self._trace(state)
+            if argument:
+                offset, size = [int(float(value)) for value in argument.split(",")]
+                trace = trace[offset:offset + size]
+            return ",".join(f"{value:+.6E}" for value in trace)
+        return ""
+
+
+class SimulatedResourceManager:
+    def __init__(self, bench, resources=None):
+        self.bench = bench
+        self.resources = resources or {SMU_ADDRESS: SimulatedSMU}  # address: resource class
+
+    def list_resources(self, query="?*::INSTR"):
+        return tuple(self.resources)
+
+    def open_resource(self, address, open_timeout=None, **kwargs):
+        if address not in self.resources:
+            raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_resource_not_found)
+        return self.resources[address](self.bench, address)
+
+    def close(self):
+        pass
+
+
+# Thorlabs Kinesis FilterFlipper DLL of one flipper. Position 2 of the light blocker lets the light through.
+class SimulatedKinesis:
+    def __init__(self, bench, instrument, shutter=False):
+        self.bench = bench
+        self.instrument = instrument
+        self.shutter = shutter
+
+    def TLI_BuildDeviceList(self):
+        return 0
+
+    def FF_Open(self, serial_no):
+        return 0
+
+    def FF_StartPolling(self, serial_no, interval):
+        return True
+
+    def FF_StopPolling(self, serial_no):
+        return 0
+
+    def FF_Close(self, serial_no):
+        return 0
+
+    # Returns at once like the DLL, the flip itself takes flipper_transit (the drivers sleep over it)
+    def FF_MoveToPosition(self, serial_no, position):
+        start = time.perf_counter()
+        end = self.bench.later(self.bench.latency["flipper_transit"], start)
+        if self.shutter:
+            self.bench.shutter.set(position == 2, end)
+        self.bench.record(self.instrument, "move", start, end)
+        return 0
+
+
+class SimulatedLightBlock(LightBlock):
+    def connect(self):
+        self.flipper_dll = SimulatedKinesis(_bench, "LightBlock", shutter=True)
+        _bench.wait("LightBlock", "connect", _bench.latency["flipper_connect"])
+        print("Simulated light-blocker connected")
+
+
+class SimulatedFlipMirror(FlipMirror):
+    def connect(self):
+        self.flipper_dll = SimulatedKinesis(_bench, "FlipMirror")
+        _bench.wait("FlipMirror", "connect", _bench.latency["flipper_connect"])
+        print("Simulated flip mirror connected")
+
+
+# Standa wheel set (Wheels.Filters). The wheels take the transmittances of Wheel_Calibration.txt in the order of its
+# rows: a move to the position of the next row sets that row's transmittance (as the second wheel depends on the
+# moves before, only the row order is known). calibrate() brings both wheels to the open slot.
+class SimulatedFilters:
+    def __init__(self, calibration_file="Wheel_Calibration.txt"):
+        self.bench = _bench
+        self.position = 0
+        self.rows = load_calibration(calibration_file, self.bench.wavelength)
+        self.next_row = 0
+        print("Simulated wheels connected")
+
+    def get_position(self):
+        return self.position, 0
+
+    def disconnect(self):
+        print("Simulated wheels disconnected")
+
+    def set_speed(self, speed):
+        self.bench.latency["wheel_speed"] = speed
+
+    def move(self, position):
+        latency = self.bench.latency
+        self.bench.wait("Filters", "move", abs(position - self.position) / latency["wheel_speed"] +
+                        latency["wheel_settle"])
+        self.position = position
+        if self.next_row < len(self.rows) and self.rows[self.next_row][0] == position:
+            transmittance = self.rows[self.next_row][1]
+            if not np.isnan(transmittance):
+                self.bench.transmittance.set(transmittance, time.perf_counter())
+            self.next_row += 1
+            self.bench.count("Filters.step")
+
+    def wait_for_stop(self, interval):
+        pass
+
+    def calibrate(self):
+        self.move(290)
+        self.move(-290)
+        self.move(0)
+        self.next_row = 0
+        self.bench.transmittance.set(1.0, time.perf_counter())
+
+
+# [(move position, transmittance at wavelength)] of Wheel_Calibration.txt
+def load_calibration(file_path, wavelength):
+    column = {532: 2, 407: 3, 639: 4}.get(int(wavelength), 2)
+    rows = []
+    with open(file_path, 'r') as file:
+        next(file)
+        for line in file:
+            columns = line.strip().split()
+            if len(columns) > column:
+                rows.append((int(columns[1]), float(columns[column])))
+    return rows
+
+
+# Thorlabs PM400 (TLPM.TLPM). Only the functions the scripts use.
+class SimulatedTLPM:
+    def __init__(self):
+        self.bench = _bench
+        self.line_frequency = 50
+
+    def open(self, resourceName, IDQuery, resetDevice):
+        self.bench.wait("TLPM", "open", self.bench.latency["visa_read"])
+
+    def close(self):
+        pass
+
+    def setWavelength(self, wavelength):
+        self.bench.wait("TLPM", "write", self.bench.latency["visa_write"])
+
+    def setPowerUnit(self, powerUnit):
+        self.bench.wait("TLPM", "write", self.bench.latency["visa_write"])
+
+    def setLineFrequency(self, lineFrequency):
+        self.bench.wait("TLPM", "write", self.bench.latency["visa_write"])
+        self.line_frequency = lineFrequency.value
+
+    def getLineFrequency(self, lineFrequency):
+        lineFrequency._obj.value = self.line_frequency
+        return 0
+
+    def measPower(self, power):
+        t_mid = self.bench.later(self.bench.latency["opm_read"] / 2)
+        self.bench.wait("TLPM", "measPower", self.bench.latency["opm_read"])
+        light = self.bench.power(t_mid)
+        power._obj.value = self.opm_reading(light)
+        return 0
+
+    def opm_reading(self, light):
+        return self.bench.opm_offset + light + self.bench.rng.normal(0, self.bench.noise * light + 1e-11)
+
+
+_bench = OpticalBench()
+_saved = {}
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+
+def _scaled_sleep(seconds):
+    start = time.perf_counter()
+    _sleep(seconds * _bench.time_scale)
+    _bench.record("script", "sleep", start, time.perf_counter())
+
+
+class _ScaledTimer(_Timer):
+    def __init__(self, interval, function, args=None, kwargs=None):
+        super().__init__(interval * _bench.time_scale, function, args, kwargs)
+
+
+# Puts the simulated instruments in place of the real drivers: scripts imported (run) afterwards get them from
+# "import Wheels/LightBlock/FlipMirror/TLPM", and SMUDevice opens SimulatedSMU through VisaPool. With
+# bench.time_scale != 1 also time.sleep and threading.Timer of the scripts are scaled.
+def install(bench):
+    global _bench
+    _bench = bench
+    modules = {"Wheels": _module("Wheels", Filters=SimulatedFilters),
+               "LightBlock": _module("LightBlock", LightBlock=SimulatedLightBlock),
+               "FlipMirror": _module("FlipMirror", FlipMirror=SimulatedFlipMirror),
+               "TLPM": _module("TLPM", TLPM=SimulatedTLPM)}
+    for name, module in modules.items():
+        _saved.setdefault(("module", name), sys.modules.get(name))
+        sys.modules[name] = module
+    _saved.setdefault(("visa", "rm"), VisaPool._resource_manager)
+    VisaPool._resource_manager = SimulatedResourceManager(bench)
+    VisaPool._sessions.clear()
+    VisaPool._identities.clear()
+    if bench.time_scale != 1:
+        time.sleep = _scaled_sleep
+        threading.Timer = _ScaledTimer
+
+
+def uninstall():
+    for (kind, name), saved in _saved.items():
+        if kind == "module" and saved is not None:
+            sys.modules[name] = saved
+        elif kind == "module":
+            sys.modules.pop(name, None)
+    VisaPool._resource_manager = _saved.get(("visa", "rm"))
+    VisaPool._sessions.clear()
+    VisaPool._identities.clear()
+    _saved.clear()
+    time.sleep = _sleep
+    threading.Timer = _Timer
@@ -0,0 +1,127 @@
+########################################################
+##     Timing instrumentation of instruments/scripts  ##
+##  Primary goal: find out where a run spends its     ##
+##  time. Every call of an instrumented driver is a   ##
+##  span on a timeline, saved as Chrome trace JSON    ##
+##  (chrome://tracing or ui.perfetto.dev) and summed  ##
+##  up as latency histograms per operation.           ##
+##   THIS FILE ACTS AS A LIBRARY FOR EXP_ SCRIPTS.    ##
+########################################################
+
+import functools
+import json
+import os
+import threading
+import time
+import numpy as np
+
+
+class Timeline:
+    def __init__(self):
+        self.enabled = False  # nothing is recorded (and nothing wrapped) until enable()
+        self.events = []
+        self.durations = {}  # operation name: [durations in s]
+        self.t0 = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self.t0 = time.perf_counter()
+
+    def _event(self, event):
+        event["pid"] = os.getpid()
+        event["tid"] = threading.get_ident()
+        with self.lock:
+            self.events.append(event)
+
+    def record(self, name, category, start, duration):
+        self._event({"name": name, "cat": category, "ph": "X", "ts": (start - self.t0) * 1e6, "dur": duration * 1e6})
+        with self.lock:
+            self.durations.setdefault(name, []).append(duration)
+
+    # Open/close a span that does not fit in a with-block (e.g. one filter step of a loop with continue's)
+    def begin(self, name, category="script"):
+        if self.enabled:
+            self._event({"name": name, "cat": category, "ph": "B", "ts": (time.perf_counter() - self.t0) * 1e6})
+
+    def end(self, name, category="script"):
+        if self.enabled:
+            self._event({"name": name, "cat": category, "ph": "E", "ts": (time.perf_counter() - self.t0) * 1e6})
+
+    # Latency statistics per operation: {name: {count, total, mean, p50, p90, max}} (in s)
+    def statistics(self):
+        stats = {}
+        for name, durations in self.durations.items():
+            durations = np.asarray(durations)
+            stats[name] = {"count": len(durations), "total": float(np.sum(durations)),
+                           "mean": float(np.mean(durations)), "p50": float(np.percentile(durations, 50)),
+                           "p90": float(np.percentile(durations, 90)), "max": float(np.max(durations))}
+        return stats
+
+    # Counts per decade of latency, 10 us ... 100 s
+    def histogram(self, name):
+        edges = 10.0 ** np.arange(-5, 3)
+        counts, _ = np.histogram(np.clip(self.durations.get(name, []), edges[0], edges[-1]), bins=edges)
+        return edges, counts
+
+    # Operations sorted by total time, with their latency distribution as a text histogram
+    def report(self, top=20):
+        stats = self.statistics()
+        print(f"{'operation':<40}{'count':>7}{'total s':>10}{'mean ms':>10}{'p50 ms':>9}{'p90 ms':>9}{'max ms':>9}"
+              f"  10us|100us|1ms|10ms|100ms|1s|10s")
+        for name, s in sorted(stats.items(), key=lambda item: -item[1]["total"])[:top]:
+            edges, counts = self.histogram(name)
+            bars = " ".join(f"{count:>4}" if count else "   ." for count in counts)
+            print(f"{name[:39]:<40}{s['count']:>7}{s['total']:>10.2f}{1e3 * s['mean']:>10.2f}{1e3 * s['p50']:>9.2f}"
+                  f"{1e3 * s['p90']:>9.2f}{1e3 * s['max']:>9.2f}  {bars}")
+
+    def save(self, file_path):
+        with self.lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms",
+                     "otherData": {"statistics": self.statistics()}}
+        with open(file_path, 'w') as file:
+            json.dump(trace, file)
+        print(f"Timeline with {len(trace['traceEvents'])} events saved to {file_path}")
+
+
+timeline = Timeline()  # one per process, shared by all instruments and the output thread
+
+
+class span:
+    def __init__(self, name, category="script"):
+        self.name = name
+        self.category = category
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if timeline.enabled:
+            timeline.record(self.name, self.category, self.start, time.perf_counter() - self.start)
+        return False
+
+
+def _timed(method, name, category):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            timeline.record(name, category, start, time.perf_counter() - start)
+    return wrapper
+
+
+# Wraps every public method of the given driver instances (SMUDevice, Filters, LightBlock, FlipMirror, TLPM, ...)
+# in a span named Class.method, and turns recording on. Calls between methods of a driver (e.g. initiate ->
+# write_command -> wait_for_completion) show up nested on the timeline.
+def instrument(*drivers):
+    timeline.enable()
+    for driver in drivers:
+        category = type(driver).__name__
+        for attribute in dir(type(driver)):
+            method = getattr(driver, attribute, None)
+            if attribute.startswith("_") or not callable(method):
+                continue
+            setattr(driver, attribute, _timed(method, f"{category}.{attribute}", category))
@@ -0,0 +1,97 @@
+########################################################
+##       Shared VISA resource manager and sessions    ##
+##  Primary goal: one pyvisa ResourceManager for the  ##
+##  whole process, instruments found by IDN/serial    ##
+##  instead of fixed addresses, and open sessions     ##
+##  kept (and re-used) as long as the process lives,  ##
+##  with timeout/chunk size set for array transfers.  ##
+##  THIS FILE ACTS AS A LIBRARY FOR SMU.py & OTHERS.  ##
+########################################################
+
+import pyvisa
+
+# Session settings for large array fetches (:FETC:ARR? of 10^4..10^5 points is several 100 kB of ASCII)
+TIMEOUT = 2000  # in ms. wait_for_completion() polls with reads, so this is also its polling interval.
+CHUNK_SIZE = 1024 * 1024  # in bytes per read (pyvisa default is 20 kB, i.e. many reads per array)
+TERMINATION = '\n'
+
+_resource_manager = None
+_sessions = {}  # address: {"resource", "users", "idn"}
+_identities = {}  # address: *IDN? response, from discover() or from opening a session
+
+
+def resource_manager():
+    global _resource_manager
+    if _resource_manager is None:
+        _resource_manager = pyvisa.ResourceManager()
+    return _resource_manager
+
+
+# Asks every connected instrument for its identity. Returns {address: IDN}. Addresses that do not answer (or are
+# not SCPI instruments, e.g. serial ports) are skipped.
+def discover(query="?*::INSTR", timeout=1000):
+    rm = resource_manager()
+    for address in rm.list_resources(query):
+        if address in _identities:
+            continue
+        try:
+            if address in _sessions:
+                _identities[address] = _sessions[address]["resource"].query("*IDN?").strip()
+            else:
+                with rm.open_resource(address, open_timeout=timeout) as resource:
+                    resource.timeout = timeout
+                    _identities[address] = resource.query("*IDN?").strip()
+        except (pyvisa.errors.VisaIOError, ValueError):
+            continue
+    return dict(_identities)
+
+
+# Address of the instrument whose address or IDN contains identifier (e.g. its serial number), None if not found
+def find(identifier):
+    for address, idn in list(_identities.items()) + list(discover().items()):
+        if identifier in address or identifier in idn:
+            return address
+    print(f"No instrument found for {identifier}.")
+    return None
+
+
+# Opens the address, or hands out the session already open for it
+def open_session(address, timeout=TIMEOUT, chunk_size=CHUNK_SIZE, termination=TERMINATION):
+    session = _sessions.get(address)
+    if session is not None:
+        try:
+            session["resource"].session  # raises if the session was closed in the meantime
+            session["users"] += 1
+            return session["resource"]
+        except pyvisa.errors.InvalidSession:
+            del _sessions[address]
+    resource = resource_manager().open_resource(address)
+    resource.timeout = timeout
+    resource.chunk_size = chunk_size
+    resource.read_termination = termination
+    resource.write_termination = termination
+    _sessions[address] = {"resource": resource, "users": 1}
+    return resource
+
+
+def identity(address):
+    if address not in _identities and address in _sessions:
+        _identities[address] = _sessions[address]["resource"].query("*IDN?").strip()
+    return _identities.get(address)
+
+
+# A user is done with the session. It stays open for the next one unless close=True.
+def release_session(address, close=False):
+    session = _sessions.get(address)
+    if session is None:
+        return
+    session["users"] = max(session["users"] - 1, 0)
+    if close and session["users"] == 0:
+        session["resource"].close()
+        del _sessions[address]
+
+
+def close_all():
+    for session in _sessions.values():
+        session["resource"].close()
+    _sessions.clear()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The libraries are flat modules next to the EXP_ scripts, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+from DataWriter import write_columns
+from LDRAnalysis import RAW_CSV_NAME, read_columns, reprocess_archive, reprocess_csv_run, robust_statistics
+
+
+def test_hampel_constant_trace_has_no_outliers():
+    traces = np.full((2, 32), 1.5e-9)
+    statistics = robust_statistics(traces, (0, 32), method="hampel")
+    assert np.all(statistics["outliers"] == 0)
+    assert np.allclose(statistics["mean"], 1.5e-9)
+    assert np.all(statistics["n"] == 32)
+
+
+def test_hampel_quantised_trace_keeps_single_steps():
+    trace = np.full(32, 1e-10)
+    trace[[5, 17]] += 1e-13  # one quantisation step, the neighbourhoods around them have a MAD of 0
+    statistics = robust_statistics(trace, (0, 32), method="hampel")
+    assert statistics["outliers"][0] == 0
+    assert np.isclose(statistics["mean"][0], np.mean(trace))
+
+
+def test_hampel_rejects_spike_on_noisy_trace():
+    trace = 1e-9 + 1e-12 * np.random.default_rng(0).standard_normal(64)
+    trace[20] = 5e-9
+    statistics = robust_statistics(trace, (0, 64), method="hampel")
+    assert statistics["outliers"][0] >= 1
+    assert np.isclose(statistics["mean"][0], 1e-9, rtol=1e-2)
+
+
+# A loop of EXP_LDR-LOW.py saved as raw data CSVs: 88 points per trace (6 skipped | 32 dark | 6 | 6 | 32 light | 6),
+# every raw data file named after the highest Pinc of the sweep, as the script does
+def write_low_run(folder, pinc, dark=1e-10, responsivity=0.3):
+    os.makedirs(os.path.join(folder, "Results dump"))
+    positions = ["1-2", "3-1", "2-2"]
+    currents = []
+    for position, power in zip(positions, pinc):
+        trace = np.full(88, dark)
+        trace[44:] = dark + responsivity * power
+        trace[50:82] += 1e-13 * (np.arange(32) % 2)  # some noise inside the light window
+        currents.append(np.mean(trace[50:82]))
+        write_columns(os.path.join(folder, f"Results dump/Raw data dev A {max(pinc)}W low_intensity measurement1"
+                                           f"{position} 0.5V 5 88pts 0.1s.csv"), ["Time", "Current"],
+                      0.1 * np.arange(88), trace)
+    write_columns(os.path.join(folder, "Low intensity current output dev A 0.5V measurement1 5 88pts 0.1s.csv"),
+                  ["Incident_Power", "Dark_Current", "Dark_Error", "Current", "Current_Error"],
+                  pinc, [dark] * 3, [0] * 3, currents, [0] * 3)
+    return positions
+
+
+def test_raw_csv_name():
+    match = RAW_CSV_NAME.fullmatch("Raw data dev A 0.001W LDR-High-111-1 0.5V 5 32pts 0.1s.csv")
+    assert (match["device"], match["pinc"], match["loop"], match["position"]) == ("dev A", "0.001", "11", "1-1")
+    assert (match["points"], match["sampling_time"]) == ("32", "0.1")
+
+
+def test_reprocess_csv_run(tmp_path):
+    pinc = [1e-9, 1e-8, 1e-7]
+    write_low_run(str(tmp_path), pinc)
+    file_paths = [os.path.join(tmp_path, "Results dump", name) for name in os.listdir(tmp_path / "Results dump")]
+    result = reprocess_csv_run(file_paths)["measurement1"]
+    assert np.allclose(result["pinc"], pinc)  # from the current output rows, not from the file names
+    assert np.allclose(result["dark_current"], 1e-10)
+    assert np.allclose(result["photocurrent"], 0.3 * np.array(pinc), rtol=1e-3)
+    assert np.all(result["points"] == 32)
+
+
+def test_reprocess_archive_csv_runs(tmp_path):
+    write_low_run(str(tmp_path / "run 1"), [1e-9, 1e-8, 1e-7])
+    write_low_run(str(tmp_path / "run 2"), [2e-9, 2e-8, 2e-7], responsivity=0.5)
+    archive = reprocess_archive(str(tmp_path))
+    assert len(archive) == 2
+    summary = read_columns(os.path.join(tmp_path, "LDR archive summary.csv"))
+    assert len(summary) == 2
+    assert np.allclose(np.sort(summary["Responsivity"]), [0.3, 0.5], rtol=1e-3)